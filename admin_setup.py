@@ -6,13 +6,11 @@
 import json
 import os
 import getpass
-from argon2 import PasswordHasher, Type
+import passwords
 
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'admin_config.json')
 
 def setup_admin():
-    ph = PasswordHasher(type=Type.ID)  # type=Type.ID = argon2id
-
     print('=' * 40)
     print('  管理员密码设置工具')
     print('=' * 40)
@@ -34,7 +32,7 @@ def setup_admin():
             continue
         break
 
-    hashed = ph.hash(password)
+    hashed = passwords.hash_password(password)  # argon2id, same parameters as user passwords
     config = {'admin_password_hash': hashed}
 
     with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
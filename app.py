@@ -1,22 +1,65 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from flask_socketio import SocketIO, emit, join_room
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, g, Response,
+                   stream_with_context, send_file, abort)
+from flask_socketio import SocketIO, emit, join_room, rooms
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-import database as db
+import database
+import metrics
+import sqltrace
+import profiler
 import os
+import io
+import csv
 import json
+import math
 import uuid
 import time
+import hmac
+import inspect
+import functools
+import threading
 import mimetypes
-import logging
-from logging.handlers import RotatingFileHandler
+import applog
 
 mimetypes.add_type('application/javascript', '.js')
 mimetypes.add_type('text/css', '.css')
 
 from werkzeug.utils import secure_filename
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+import passwords
+import db_backends
+import group_avatars
+import assets
+from offload import PoolBusy, PoolTimeout, OffloadedModule
+from replay import ReplayLog
+from presence import Presence, PRESENCE_FLUSH
+from typing_state import TypingTracker, TYPING_FLUSH
+from fanout import FanoutQueue, FANOUT_LARGE_ROOM
+
+# ── Metrics (scraped from GET /metrics) ─────────────────────────────────────
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')   # unset: /metrics only answers localhost
+HTTP_REQUESTS  = metrics.Counter('chat_http_requests_total', 'HTTP requests by route and status',
+                                 ('method', 'route', 'status'))
+HTTP_LATENCY   = metrics.Histogram('chat_http_request_duration_seconds', 'HTTP request latency by route',
+                                   ('method', 'route'))
+SOCKET_EVENTS  = metrics.Counter('chat_socket_events_total', 'Socket.IO events handled', ('event', 'outcome'))
+SOCKET_LATENCY = metrics.Histogram('chat_socket_event_duration_seconds', 'Socket.IO handler latency by event',
+                                   ('event',))
+FANOUT         = metrics.Histogram('chat_emit_fanout_sockets', 'Sockets reached by each room broadcast',
+                                   ('event',), buckets=metrics.SIZE_BUCKETS)
+DB_CALLS       = metrics.Counter('chat_db_calls_total', 'database.py calls by function', ('function', 'outcome'))
+DB_LATENCY     = metrics.Histogram('chat_db_call_duration_seconds',
+                                   'database.py call latency by function, including pool queueing', ('function',))
+UPLOAD_BYTES   = metrics.Counter('chat_upload_bytes_total', 'Bytes accepted by the upload endpoints', ('kind',))
+
+
+def _observe_db_call(name, seconds, failed):
+    DB_CALLS.inc(name, 'error' if failed else 'ok')
+    DB_LATENCY.observe(seconds, name)
+
+
+# Every db.* call runs on database.pool's native threads once the pool is started,
+# so a slow query or a sqlite lock wait only parks the calling greenlet.
+db = OffloadedModule(database, database.pool, exempt=database.SELF_OFFLOADING, observe=_observe_db_call)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24).hex())
@@ -27,23 +70,18 @@ app.config.update(
 )
 
 # ── Logging Configuration ───────────────────────────────────────────────────
-if not os.path.exists('logs'):
-    os.mkdir('logs')
-
-file_handler = RotatingFileHandler('logs/app.log', maxBytes=1024 * 1024, backupCount=10)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-file_handler.setLevel(logging.INFO)
-app.logger.addHandler(file_handler)
-app.logger.setLevel(logging.INFO)
+# Queued to a background writer thread (logs/app.log, JSON lines); see applog.py.
+# sqltrace: slow-query and N+1 warnings; profiler: sampling profiles and blocked-hub reports.
+applog.setup(app.logger, sqltrace.logger, profiler.logger)
 app.logger.info('ChatRoom startup')
 
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
+    storage_uri="memory://",
+    # RATELIMIT_ENABLED=0 only for local load tests (loadtest.py logs everyone in from one IP)
+    enabled=os.environ.get('RATELIMIT_ENABLED', '1') != '0',
 )
 
 DEBUG = False  # set True for development
@@ -57,11 +95,251 @@ if DEBUG:
     socketio = SocketIO(app, cors_allowed_origins=socket_allowed_origins or None)
 else:
     socketio = SocketIO(app, cors_allowed_origins=socket_allowed_origins or None, async_mode='gevent')
+    # argon2 and DB calls run in native worker threads so they don't freeze every websocket
+    passwords.pool.start()
+    passwords.bulk_pool.start()
+    database.pool.start()
+    group_avatars.pool.start()
+    # log a stack trace whenever one greenlet holds the hub longer than HUB_BLOCK_MS
+    profiler.start_hub_monitor()
+
+# Minified, content-hashed front-end files served from /assets/ (see assets.py);
+# the debug server rebuilds them whenever a source changes.
+assets.auto_rebuild = DEBUG
+assets.build()
+app.jinja_env.globals.update(asset_url=assets.url, asset_scripts=assets.scripts, asset_preloads=assets.preloads)
+
+# ── Background maintenance ──────────────────────────────────────────────────
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', '3600'))   # seconds between passes
+MAINTENANCE_BATCH    = 1000   # messages per archive/purge batch
+STATS_ROLLUP_INTERVAL = int(os.environ.get('STATS_ROLLUP_INTERVAL', '60'))   # seconds between stats rollups
+DELETION_PAUSE       = float(os.environ.get('DELETION_PAUSE', '0.05'))   # seconds between deletion chunks
+DELETION_IDLE        = 2      # seconds between polls for new deletion jobs
+GROUP_AVATAR_INTERVAL = float(os.environ.get('GROUP_AVATAR_INTERVAL', '2'))   # seconds between composite passes
+_background_started = False
+
+
+def _drain(job):
+    """Run a batched db job until it reports no more work, yielding between batches."""
+    total = 0
+    while True:
+        n = job(MAINTENANCE_BATCH)
+        if not n:
+            return total
+        total += n
+        socketio.sleep(0.2)
+
+
+def _maintenance_loop():
+    while True:
+        try:
+            purged = _drain(db.purge_expired_messages)
+            archived = _drain(db.archive_cold_messages)
+            if purged or archived:
+                app.logger.info('Maintenance: purged %d expired, archived %d cold messages', purged, archived)
+            removed = group_avatars.pool.run(group_avatars.collect_garbage, db.group_avatar_urls())
+            if removed:
+                app.logger.info('Maintenance: removed %d unused group avatars', removed)
+        except Exception:
+            app.logger.exception('Maintenance pass failed')
+        socketio.sleep(MAINTENANCE_INTERVAL)
+
+
+def _stats_rollup_loop():
+    while True:
+        try:
+            db.rollup_stats()
+        except Exception:
+            app.logger.exception('Stats rollup failed')
+        socketio.sleep(STATS_ROLLUP_INTERVAL)
+
+
+def _deletion_loop():
+    while True:
+        try:
+            job = db.run_deletion_step()
+        except Exception:
+            app.logger.exception('Deletion step failed')
+            job = None
+        if job and job['status'] == 'done':
+            app.logger.info('Deletion job %s finished: %s %s (%s), %d rows',
+                            job['id'], job['kind'], job['target_id'], job['label'], job['deleted_rows'])
+        socketio.sleep(DELETION_PAUSE if job else DELETION_IDLE)
+
+
+def _group_avatar_loop():
+    while True:
+        groups = []
+        try:
+            groups = db.dirty_group_avatars(group_avatars.GROUP_AVATAR_BATCH, group_avatars.GROUP_AVATAR_CELLS)
+            if groups:
+                urls = group_avatars.pool.run(group_avatars.store_all, groups)
+                db.set_group_avatars([(g['id'], urls[g['id']], g['dirty']) for g in groups])
+                for g in groups:
+                    if urls[g['id']] != g['avatar_composite']:
+                        _emit_room('group_updated', {'conversation_id': g['id'], 'avatar_composite': urls[g['id']]},
+                                   f'conv_{g["id"]}', lightweight=True)
+        except Exception:
+            app.logger.exception('Group avatar pass failed')
+        socketio.sleep(0.2 if len(groups) == group_avatars.GROUP_AVATAR_BATCH else GROUP_AVATAR_INTERVAL)
+
+
+def _presence_loop():
+    while True:
+        try:
+            batches, went_offline = presence.flush()
+            for sid, updates in batches.items():
+                socketio.emit('presence', {'users': updates}, room=sid)
+            if went_offline:
+                db.set_last_seen(went_offline)
+        except Exception:
+            app.logger.exception('Presence flush failed')
+        socketio.sleep(PRESENCE_FLUSH)
+
+
+def _fanout_loop():
+    while True:
+        _fanout_wake.clear()
+        try:
+            served = fanout.step()
+        except Exception:
+            app.logger.exception('Fan-out step failed')
+            served = 0
+        if served:
+            socketio.sleep(0)   # let other greenlets run between slices
+        else:
+            _fanout_wake.wait(1)
+
+
+def _room_size(conv_id):
+    return len(socketio.server.manager.rooms.get('/', {}).get(f'conv_{conv_id}', ()))
+
+
+def _typing_loop():
+    while True:
+        try:
+            for conv_id, snapshot in typing_status.flush(_room_size):
+                _record_fanout('typing', f'conv_{conv_id}')
+                _emit_room('typing', snapshot, f'conv_{conv_id}', lightweight=True)
+        except Exception:
+            app.logger.exception('Typing flush failed')
+        socketio.sleep(TYPING_FLUSH)
+
+
+def _start_background_jobs():
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    socketio.start_background_task(_maintenance_loop)
+    socketio.start_background_task(_stats_rollup_loop)
+    socketio.start_background_task(_deletion_loop)
+    socketio.start_background_task(_presence_loop)
+    socketio.start_background_task(_typing_loop)
+    socketio.start_background_task(_fanout_loop)
+    socketio.start_background_task(_group_avatar_loop)
+
 
 # user_id -> set of sid
 online_users = {}
+presence = Presence()
+typing_status = TypingTracker()
 user_msg_timestamps = {}
 
+_POOLS = (database.pool, passwords.pool, passwords.bulk_pool)
+
+
+def _pool_metric(read):
+    return lambda: {(p.name,): read(p) for p in _POOLS}
+
+
+metrics.Callback('chat_online_users', 'Users with at least one socket', lambda: len(online_users))
+metrics.Callback('chat_online_sockets', 'Connected sockets of logged-in users',
+                 lambda: sum(len(sids) for sids in list(online_users.values())))
+metrics.Callback('chat_pool_pending', 'Calls queued or running in a worker pool',
+                 _pool_metric(lambda p: p.pending), labels=('pool',))
+metrics.Callback('chat_pool_rejected_total', 'Calls refused because the pool was saturated',
+                 _pool_metric(lambda p: p.rejected), labels=('pool',), kind='counter')
+metrics.Callback('chat_pool_timeouts_total', 'Calls abandoned after the pool deadline',
+                 _pool_metric(lambda p: p.timeouts), labels=('pool',), kind='counter')
+metrics.Callback('chat_pool_queue_wait_seconds_total', 'Time calls spent waiting for a worker thread',
+                 _pool_metric(lambda p: p.queue_wait.total), labels=('pool',), kind='counter')
+metrics.Callback('chat_pool_queue_waits_total', 'Calls picked up by a worker thread',
+                 _pool_metric(lambda p: p.queue_wait.count), labels=('pool',), kind='counter')
+metrics.Callback('chat_db_lock_wait_seconds_total', 'Time spent acquiring the database write lock',
+                 lambda: db_backends.lock_waits.total, kind='counter')
+metrics.Callback('chat_db_lock_waits_total', 'Write transactions that waited for the lock',
+                 lambda: db_backends.lock_waits.count, kind='counter')
+metrics.Callback('chat_db_lock_wait_max_seconds', 'Longest single write-lock wait since startup',
+                 lambda: db_backends.lock_waits.max)
+
+
+def socket_event(event):
+    """socketio.on(event) that also records the event count and handler latency, and traces its SQL."""
+    def decorator(fn):
+        takes_args = bool(inspect.signature(fn).parameters)
+
+        @functools.wraps(fn)
+        def handler(*args):
+            start = time.perf_counter()
+            log_context = applog.bind(request_id=uuid.uuid4().hex[:16], user_id=session.get('user_id'),
+                                      route=f'socket {event}', sid=request.sid)
+            trace = sqltrace.begin(f'socket {event}')
+            outcome = 'error'
+            try:
+                result = fn(*args) if takes_args else fn()
+                outcome = 'ok'
+                return result
+            finally:
+                sqltrace.end(trace)
+                applog.unbind(log_context)
+                SOCKET_EVENTS.inc(event, outcome)
+                SOCKET_LATENCY.observe(time.perf_counter() - start, event)
+        socketio.on(event)(handler)
+        return fn
+    return decorator
+
+
+def _record_fanout(event, room):
+    """Count the sockets a room broadcast reaches, read from the Socket.IO room table."""
+    FANOUT.observe(len(socketio.server.manager.rooms.get('/', {}).get(room, ())), event)
+
+
+def _send_to_sids(event, payload, sids):
+    socketio.emit(event, payload, to=sids)
+
+
+fanout = FanoutQueue(_send_to_sids)
+_fanout_wake = socketio.server.eio.create_event()
+metrics.Callback('chat_fanout_pending', 'Large-room broadcasts queued for sliced delivery',
+                 lambda: fanout.pending)
+
+
+def _emit_room(event, payload, room, lightweight=False):
+    """
+    Emit to a room.  Rooms above FANOUT_LARGE_ROOM sockets are served in slices by
+    _fanout_loop; lightweight events for them are dropped while that queue is saturated.
+    """
+    sids = socketio.server.manager.rooms.get('/', {}).get(room) or {}
+    if len(sids) <= FANOUT_LARGE_ROOM and not fanout.queued(room):
+        socketio.emit(event, payload, room=room)
+        return
+    if lightweight and fanout.saturated():
+        return
+    fanout.submit(room, event, payload, list(sids))
+    _fanout_wake.set()
+
+
+replay_log = ReplayLog()
+
+
+def _broadcast(event, payload, conv_id):
+    """Emit a message event to a conversation room, numbered so reconnecting clients can replay it."""
+    room = f'conv_{conv_id}'
+    payload = replay_log.record(room, event, payload)
+    _record_fanout(event, room)
+    _emit_room(event, payload, room)
+
 # ── Upload config ───────────────────────────────────────────────────────────
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
 ALLOWED_IMAGE  = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff', 'ico', 'avif'}
@@ -77,9 +355,67 @@ def add_security_headers(response):
     response.headers['X-Content-Type-Options'] = 'nosniff'
     return response
 
+@app.after_request
+def cache_group_avatars(response):
+    # Composite file names are content hashes: a changed avatar gets a new URL.
+    if response.status_code == 200 and request.path.startswith(group_avatars.GROUP_AVATAR_URL):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        HTTP_REQUESTS.inc(request.method, route, str(response.status_code))
+        HTTP_LATENCY.observe(time.perf_counter() - start, request.method, route)
+    return response
+
+@app.after_request
+def add_sql_trace_header(response):
+    trace = sqltrace.current()
+    if trace is not None:
+        response.headers['X-SQL-Trace'] = sqltrace.header_value(trace)
+    return response
+
+@app.after_request
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_context(exc):
+    # Teardown runs even when the view raised, so a keep-alive greenlet never
+    # inherits a stale SQL trace or log context.
+    sqltrace.end(g.pop('sql_trace', None))
+    applog.unbind(g.pop('log_context', None))
+
+@app.errorhandler(PoolBusy)
+def handle_pool_busy(e):
+    app.logger.warning('Shedding request to %s: %s', request.path, e, extra=applog.sampled('shed'))
+    response = jsonify({'ok': False, 'msg': '服务器繁忙，请稍后重试'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@socketio.on_error_default
+def on_socket_error(e):
+    if isinstance(e, PoolBusy):
+        app.logger.warning('Shedding socket event: %s', e, extra=applog.sampled('shed'))
+        emit('server_busy', {'msg': '服务器繁忙，请稍后重试'})
+        return {'ok': False, 'code': 'busy', 'msg': '服务器繁忙，请稍后重试'}
+    app.logger.exception('Unhandled socket event error')
+    return {'ok': False, 'code': 'error'}
+
 @app.before_request
 def before_req():
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    g.log_context = applog.bind(request_id=g.request_id, user_id=session.get('user_id'),
+                                route=f'{request.method} {request.path}')
+    g.sql_trace = sqltrace.begin(f'{request.method} {request.path}')
     db.init_db()
+    _start_background_jobs()
     
     # CSRF Protection for API
     if request.method in ('POST', 'PUT', 'DELETE') and request.path.startswith('/api/'):
@@ -123,6 +459,21 @@ def chat():
     return render_template('chat.html')
 
 
+@app.route('/assets/<filename>')
+@limiter.exempt
+def serve_asset(filename):
+    path, gzipped = assets.locate(filename, 'gzip' in request.accept_encodings)
+    if not path:
+        abort(404)
+    resp = send_file(path, mimetype=mimetypes.guess_type(filename)[0])
+    if gzipped:
+        resp.headers['Content-Encoding'] = 'gzip'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # The file name changes with the content, so the file itself never does.
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+
 # ---------- Auth API ----------
 
 @app.route('/api/register', methods=['POST'])
@@ -145,9 +496,9 @@ def register():
         return jsonify({'ok': False, 'msg': '用户名只能包含字母和数字'})
     ok, msg = db.create_user(username, password)
     if ok:
-        app.logger.info(f"New user registered: {username}")
+        app.logger.info('New user registered: %s', username)
     else:
-        app.logger.warning(f"Registration failed for {username}: {msg}")
+        app.logger.warning('Registration failed for %s: %s', username, msg)
     return jsonify({'ok': ok, 'msg': msg})
 
 
@@ -160,13 +511,13 @@ def api_login():
     user = db.verify_user(username, password)
     if user:
         if user.get('is_banned'):
-            app.logger.warning(f"Banned user attempted login: {username}")
+            app.logger.warning('Banned user attempted login: %s', username)
             return jsonify({'ok': False, 'msg': '账号已被封禁，请联系管理员'})
         session['user_id'] = user['id']
         session['username'] = user['username']
-        app.logger.info(f"User logged in: {username} (ID: {user['id']})")
+        app.logger.info('User logged in: %s (ID: %s)', username, user['id'], extra=applog.sampled('login'))
         return jsonify({'ok': True, 'user': {'id': user['id'], 'username': user['username']}})
-    app.logger.warning(f"Login failed for {username}")
+    app.logger.warning('Login failed for %s', username)
     return jsonify({'ok': False, 'msg': '用户名或密码错误'})
 
 
@@ -190,7 +541,12 @@ def get_conversations():
     if 'user_id' not in session:
         return jsonify({'ok': False}), 401
     convs = db.get_user_conversations(session['user_id'])
-    return jsonify({'ok': True, 'conversations': convs})
+    # The client renders its cached copy first and revalidates here; an unchanged
+    # list costs a 304 instead of the whole body.
+    resp = jsonify({'ok': True, 'conversations': convs})
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 
 @app.route('/api/conversations/private', methods=['POST'])
@@ -230,7 +586,7 @@ def create_group():
     if not member_ids:
         return jsonify({'ok': False, 'msg': '请至少选择一个成员'})
     conv_id = db.create_group_conversation(name, session['user_id'], member_ids)
-    app.logger.info(f"Group created: {name} (ID: {conv_id}) by user {session['user_id']}")
+    app.logger.info('Group created: %s (ID: %s) by user %s', name, conv_id, session['user_id'])
     # Notify members
     for uid in member_ids:
         if uid in online_users:
@@ -246,8 +602,25 @@ def get_messages(conv_id):
     if not db.is_member(conv_id, session['user_id']):
         return jsonify({'ok': False, 'msg': '无权限'}), 403
     before = request.args.get('before', type=float)
+    # Taken before reading, so changes racing with this page are picked up by the next sync.
+    cursor = None if before else db.current_sync_cursor()
     msgs = db.get_messages(conv_id, before=before)
-    return jsonify({'ok': True, 'messages': msgs})
+    return jsonify({'ok': True, 'messages': msgs, 'sync_cursor': cursor})
+
+
+@app.route('/api/sync')
+def sync_messages():
+    """Messages of one conversation inserted, edited or revoked since the client's cursor."""
+    if 'user_id' not in session:
+        return jsonify({'ok': False}), 401
+    conv_id = request.args.get('conversation_id', type=int)
+    if not conv_id or not db.is_member(conv_id, session['user_id']):
+        return jsonify({'ok': False, 'msg': '无权限'}), 403
+    try:
+        msgs, cursor, has_more = db.get_message_changes(conv_id, request.args.get('since', ''))
+    except ValueError:
+        return jsonify({'ok': False, 'msg': '无效的同步游标'}), 400
+    return jsonify({'ok': True, 'messages': msgs, 'cursor': cursor, 'has_more': has_more})
 
 
 @app.route('/api/messages/<int:message_id>/revoke', methods=['POST'])
@@ -263,13 +636,13 @@ def revoke_message(message_id):
     ok, msg_text = db.revoke_message(message_id, session['user_id'])
     if not ok:
         return jsonify({'ok': False, 'msg': msg_text}), 400
-    app.logger.info(f"Message {message_id} revoked by user {session['user_id']}")
+    app.logger.info('Message %s revoked by user %s', message_id, session['user_id'])
     emit_payload = {
         'message_id': message_id,
         'conversation_id': msg['conversation_id'],
         'sender_name': msg.get('sender_name')
     }
-    socketio.emit('message_revoked', emit_payload, room=f'conv_{msg["conversation_id"]}')
+    _broadcast('message_revoked', emit_payload, msg['conversation_id'])
     return jsonify({'ok': True})
 
 
@@ -295,7 +668,7 @@ def edit_message(message_id):
     if not ok:
         return jsonify({'ok': False, 'msg': msg_text}), 400
     updated = db.get_message_by_id(message_id)
-    socketio.emit('message_edited', updated, room=f'conv_{updated["conversation_id"]}')
+    _broadcast('message_edited', updated, updated['conversation_id'])
     return jsonify({'ok': True, 'message': updated})
 
 
@@ -318,22 +691,74 @@ def forward_message(message_id):
     if not db.is_member(original['conversation_id'], session['user_id']):
         return jsonify({'ok': False, 'msg': '无权限'}), 403
 
-    forwarded = 0
-    for conv_id in conversation_ids:
-        if not db.is_member(conv_id, session['user_id']):
+    targets = db.member_conversations(session['user_id'], _int_ids(conversation_ids), posting=True)
+    copies = db.forward_messages(session['user_id'], [original], targets, uuid.uuid4().hex)
+    _emit_forwarded(copies)
+    return jsonify({'ok': True, 'forwarded': len(copies)})
+
+
+FORWARD_MAX_MESSAGES = 100
+FORWARD_MAX_TARGETS = 20
+
+
+def _int_ids(values):
+    ids = []
+    for v in values:
+        try:
+            ids.append(int(v))
+        except (TypeError, ValueError):
             continue
-        new_msg = db.save_message(
-            conv_id,
-            session['user_id'],
-            original['content'],
-            msg_type=original['msg_type'],
-            media_url=original['media_url'],
-            original_message_id=original['id']
-        )
-        new_msg['sender_name'] = session.get('username')
-        socketio.emit('new_message', new_msg, room=f'conv_{conv_id}')
-        forwarded += 1
-    return jsonify({'ok': True, 'forwarded': forwarded})
+    return ids
+
+
+def _emit_forwarded(copies):
+    """One new_messages event per target room instead of one new_message per copy."""
+    for conv_id, msgs in copies.items():
+        fresh = [m for m in msgs if not m.pop('duplicate')]
+        if fresh:
+            _broadcast('new_messages', {'conversation_id': conv_id, 'messages': fresh}, conv_id)
+
+
+@app.route('/api/messages/forward', methods=['POST'])
+@limiter.limit("30 per minute")
+def forward_messages():
+    """Forward several messages to several conversations in one request.
+    Body: {message_ids, conversation_ids, batch_id?}; a retry with the same batch_id
+    does not store the copies twice."""
+    if 'user_id' not in session:
+        return jsonify({'ok': False}), 401
+    uid = session['user_id']
+    data = request.json or {}
+    message_ids = data.get('message_ids') or []
+    conversation_ids = data.get('conversation_ids') or []
+    batch_id = data.get('batch_id') or uuid.uuid4().hex
+    if not isinstance(message_ids, list) or not message_ids:
+        return jsonify({'ok': False, 'msg': '请选择要转发的消息'}), 400
+    if not isinstance(conversation_ids, list) or not conversation_ids:
+        return jsonify({'ok': False, 'msg': '请选择目标会话'}), 400
+    if len(message_ids) > FORWARD_MAX_MESSAGES:
+        return jsonify({'ok': False, 'msg': f'单次最多转发 {FORWARD_MAX_MESSAGES} 条消息'}), 400
+    if len(conversation_ids) > FORWARD_MAX_TARGETS:
+        return jsonify({'ok': False, 'msg': f'单次最多转发 {FORWARD_MAX_TARGETS} 个会话'}), 400
+    if not isinstance(batch_id, str) or len(batch_id) > CLIENT_MSG_ID_MAX:
+        return jsonify({'ok': False, 'msg': '无效的批次 ID'}), 400
+
+    originals = [m for m in db.get_messages_by_ids(_int_ids(message_ids)).values() if not m['is_revoked']]
+    if not originals:
+        return jsonify({'ok': False, 'msg': '没有可转发的消息'}), 400
+    targets = _int_ids(conversation_ids)
+    sources = db.member_conversations(uid, [m['conversation_id'] for m in originals])
+    if any(m['conversation_id'] not in sources for m in originals):
+        return jsonify({'ok': False, 'msg': '无权限'}), 403
+    targets = db.member_conversations(uid, targets, posting=True)
+    copies = db.forward_messages(uid, originals, targets, batch_id)
+    _emit_forwarded(copies)
+    return jsonify({
+        'ok': True,
+        'forwarded': sum(len(msgs) for msgs in copies.values()),
+        'conversations': len(copies),
+        'skipped': len(set(_int_ids(message_ids))) - len(originals),
+    })
 
 
 @app.route('/api/messages/<int:message_id>/favorite', methods=['POST'])
@@ -464,6 +889,7 @@ def upload_avatar():
         if os.path.exists(saved_path):
             os.remove(saved_path)
         return jsonify({'ok': False, 'msg': '云盘空间不足'})
+    UPLOAD_BYTES.inc('avatar', amount=file_size)
     db.update_profile(session['user_id'], avatar_url=url)
     return jsonify({'ok': True, 'url': url})
 
@@ -509,6 +935,7 @@ def upload_file():
         if os.path.exists(saved_path):
             os.remove(saved_path)
         return jsonify({'ok': False, 'msg': '云盘空间不足'})
+    UPLOAD_BYTES.inc(msg_type, amount=file_size)
     return jsonify({'ok': True, 'url': url, 'msg_type': msg_type,
                     'filename': safe_name or f'file.{ext}'})
 
@@ -628,7 +1055,7 @@ def pin_message(conv_id, message_id):
         return jsonify({'ok': False}), 401
     ok, msg = db.pin_message(conv_id, message_id, session['user_id'])
     if ok:
-        socketio.emit('pinned_updated', {'conversation_id': conv_id}, room=f'conv_{conv_id}')
+        _emit_room('pinned_updated', {'conversation_id': conv_id}, f'conv_{conv_id}', lightweight=True)
     return jsonify({'ok': ok, 'msg': msg})
 
 
@@ -638,10 +1065,39 @@ def unpin_message(conv_id, message_id):
         return jsonify({'ok': False}), 401
     ok, msg = db.unpin_message(conv_id, message_id, session['user_id'])
     if ok:
-        socketio.emit('pinned_updated', {'conversation_id': conv_id}, room=f'conv_{conv_id}')
+        _emit_room('pinned_updated', {'conversation_id': conv_id}, f'conv_{conv_id}', lightweight=True)
     return jsonify({'ok': ok, 'msg': msg})
 
 
+# ---------- Presence API ----------
+
+PRESENCE_QUERY_MAX = 200
+
+
+def _presence_snapshot(viewer_id, user_ids):
+    """Presence of the user_ids viewer_id may see, as a list of presence updates."""
+    visible = db.presence_visible(viewer_id, user_ids)
+    states = presence.status([uid for uid in dict.fromkeys(user_ids) if uid in visible])
+    unknown = [uid for uid, s in states.items() if not s['online'] and s['last_seen'] is None]
+    if unknown:
+        for uid, ts in db.get_last_seen(unknown).items():
+            states[uid]['last_seen'] = ts
+    return [dict(s, user_id=uid) for uid, s in states.items()]
+
+
+@app.route('/api/presence')
+def get_presence():
+    """Online / last-seen state of up to PRESENCE_QUERY_MAX users: ?ids=1,2,3"""
+    if 'user_id' not in session:
+        return jsonify({'ok': False}), 401
+    ids = _int_ids(v for v in request.args.get('ids', '').split(',') if v.strip())
+    if not ids:
+        return jsonify({'ok': False, 'msg': '请指定用户'}), 400
+    if len(ids) > PRESENCE_QUERY_MAX:
+        return jsonify({'ok': False, 'msg': f'单次最多查询 {PRESENCE_QUERY_MAX} 个用户'}), 400
+    return jsonify({'ok': True, 'users': _presence_snapshot(session['user_id'], ids)})
+
+
 # ---------- Group Settings API ----------
 
 @app.route('/api/conversations/<int:conv_id>/settings')
@@ -665,8 +1121,7 @@ def update_group_name(conv_id):
         return jsonify({'ok': False, 'msg': '群名不能为空'})
     ok, msg = db.update_group_name(conv_id, session['user_id'], new_name)
     if ok:
-        socketio.emit('group_updated', {'conversation_id': conv_id, 'name': new_name},
-                      room=f'conv_{conv_id}')
+        _emit_room('group_updated', {'conversation_id': conv_id, 'name': new_name}, f'conv_{conv_id}')
     return jsonify({'ok': ok, 'msg': msg})
 
 
@@ -679,10 +1134,10 @@ def update_group_announcement(conv_id):
         return jsonify({'ok': False, 'msg': '群公告最多 200 字'}), 400
     ok, msg = db.update_group_announcement(conv_id, session['user_id'], announcement)
     if ok:
-        socketio.emit('group_updated', {
+        _emit_room('group_updated', {
             'conversation_id': conv_id,
             'announcement': announcement
-        }, room=f'conv_{conv_id}')
+        }, f'conv_{conv_id}')
     return jsonify({'ok': ok, 'msg': msg})
 
 
@@ -698,13 +1153,36 @@ def update_group_avatar(conv_id):
             return jsonify({'ok': False, 'msg': '无效头像地址'}), 400
     ok, msg = db.update_group_avatar(conv_id, session['user_id'], avatar_url or None)
     if ok:
-        socketio.emit('group_updated', {
+        _emit_room('group_updated', {
             'conversation_id': conv_id,
             'avatar_url': avatar_url or None
-        }, room=f'conv_{conv_id}')
+        }, f'conv_{conv_id}')
+    return jsonify({'ok': ok, 'msg': msg})
+
+
+@app.route('/api/conversations/<int:conv_id>/admins-only', methods=['PUT'])
+def set_group_admins_only(conv_id):
+    if 'user_id' not in session:
+        return jsonify({'ok': False}), 401
+    enabled = bool((request.json or {}).get('enabled'))
+    ok, msg = db.set_group_admins_only(conv_id, session['user_id'], enabled)
+    if ok:
+        _emit_room('group_updated', {'conversation_id': conv_id, 'admins_only': int(enabled)}, f'conv_{conv_id}')
     return jsonify({'ok': ok, 'msg': msg})
 
 
+@app.route('/api/conversations/<int:conv_id>/members')
+def get_group_members(conv_id):
+    """One page of group members in user id order: ?after=<last user id>"""
+    if 'user_id' not in session:
+        return jsonify({'ok': False}), 401
+    if not db.is_member(conv_id, session['user_id']):
+        return jsonify({'ok': False, 'msg': '无权限'}), 403
+    after = request.args.get('after', default=0, type=int)
+    members = db.get_group_members_page(conv_id, database.GROUP_MEMBER_PAGE, after)
+    return jsonify({'ok': True, 'members': members, 'has_more': len(members) == database.GROUP_MEMBER_PAGE})
+
+
 @app.route('/api/conversations/<int:conv_id>/members', methods=['POST'])
 def add_group_member(conv_id):
     if 'user_id' not in session:
@@ -754,30 +1232,63 @@ def transfer_group_owner(conv_id):
     ok, msg = db.transfer_group_owner(conv_id, session['user_id'], new_owner_id)
     return jsonify({'ok': ok, 'msg': msg})
 
-@socketio.on('connect')
+@socket_event('connect')
 def on_connect():
     uid = session.get('user_id')
     if not uid:
         return False
-    if uid not in online_users:
-        online_users[uid] = set()
-    online_users[uid].add(request.sid)
     # Join all conversation rooms
-    convs = db.get_user_conversations(uid)
-    for conv in convs:
-        join_room(f'conv_{conv["id"]}')
+    try:
+        conv_ids = db.get_user_conversation_ids(uid)
+    except PoolBusy:
+        return False   # refuse; the client's reconnect backoff retries later
+    if uid not in online_users:
+        presence.connected(uid)
+    online_users.setdefault(uid, set()).add(request.sid)
+    for conv_id in conv_ids:
+        join_room(f'conv_{conv_id}')
 
 
-@socketio.on('disconnect')
+@socket_event('disconnect')
 def on_disconnect():
     uid = session.get('user_id')
+    presence.unwatch(request.sid)
     if uid and uid in online_users:
         online_users[uid].discard(request.sid)
         if not online_users[uid]:
             del online_users[uid]
+            presence.disconnected(uid)
+
+
+@socket_event('typing')
+def on_typing(data):
+    """{conversation_id, typing}: throttled and aggregated by typing_status, never re-emitted directly."""
+    uid = session.get('user_id')
+    conv_id = (data or {}).get('conversation_id')
+    # Room membership was checked when the socket joined, so no database query here.
+    if not uid or not isinstance(conv_id, int) or f'conv_{conv_id}' not in rooms():
+        return
+    if data.get('typing', True):
+        typing_status.start(conv_id, uid, session.get('username'))
+    else:
+        typing_status.stop(conv_id, uid)
+
+
+@socket_event('presence_subscribe')
+def on_presence_subscribe(data):
+    """Watch the presence of data.user_ids (replacing the previous set); the ack carries their current state."""
+    uid = session.get('user_id')
+    if not uid:
+        return {'ok': False, 'code': 'unauthorized', 'msg': '请先登录'}
+    user_ids = (data or {}).get('user_ids')
+    if not isinstance(user_ids, list):
+        return {'ok': False, 'code': 'invalid', 'msg': '无效的用户列表'}
+    snapshot = _presence_snapshot(uid, _int_ids(user_ids)[:presence.max_watch])
+    presence.watch(request.sid, [s['user_id'] for s in snapshot])
+    return {'ok': True, 'users': snapshot}
 
 
-@socketio.on('join_conversation')
+@socket_event('join_conversation')
 def on_join(data):
     conv_id = data.get('conversation_id')
     uid = session.get('user_id')
@@ -785,24 +1296,96 @@ def on_join(data):
         join_room(f'conv_{conv_id}')
 
 
-@socketio.on('send_message')
+@socket_event('resume')
+def on_resume(data):
+    """
+    Replay what a reconnecting client missed.  data.positions maps conversation id
+    to the last [epoch, seq] the client saw.  The ack carries the missed events per
+    room, the rooms whose buffer no longer covers the gap (resync from the database)
+    and the current position of every room the socket is in.
+    """
+    positions = (data or {}).get('positions') or {}
+    if not isinstance(positions, dict):
+        return {'ok': False, 'code': 'invalid', 'msg': '无效的同步位置'}
+    replayed, resync, current = {}, [], {}
+    for room in rooms():
+        if not room.startswith('conv_'):
+            continue
+        conv_id = room[len('conv_'):]
+        seen = positions.get(conv_id)
+        if seen is not None:
+            events = None
+            if isinstance(seen, list) and len(seen) == 2 and isinstance(seen[1], int):
+                events = replay_log.since(room, seen[0], seen[1])
+            if events is None:
+                resync.append(int(conv_id))
+            elif events:
+                replayed[conv_id] = [{'event': event, 'data': payload} for event, payload in events]
+        current[conv_id] = replay_log.position(room)
+    return {'ok': True, 'replay': replayed, 'resync': resync, 'positions': current}
+
+
+# Acknowledgement codes for send_message.  The client retries the retryable
+# ones with the same client_msg_id; the others mark the message as failed.
+SEND_RETRYABLE = ('rate_limited', 'busy', 'error')
+CLIENT_MSG_ID_MAX = 64
+
+
+def _send_error(code, msg):
+    return {'ok': False, 'code': code, 'msg': msg}
+
+
+def _send_ack_message(msg, filename):
+    """Add the quoted original and the upload's file name to a stored message."""
+    if msg.get('original_message_id'):
+        orig_msg = db.get_message_by_id(msg['original_message_id'])
+        if orig_msg:
+            msg['original_content'] = orig_msg['content']
+            msg['original_sender_name'] = orig_msg['sender_name']
+            msg['original_msg_type'] = orig_msg['msg_type']
+    if filename:
+        msg['filename'] = filename
+    return msg
+
+
+@socket_event('send_message')
 def on_send(data):
+    """
+    Save and broadcast a message.  The return value is the Socket.IO ack:
+    {'ok': True, 'message': ..., 'duplicate': bool} or {'ok': False, 'code', 'msg'}.
+    A resend carrying an already stored client_msg_id is acknowledged with the
+    stored message and not broadcast again.
+    """
     uid = session.get('user_id')
     if not uid:
-        return
+        return _send_error('unauthorized', '请先登录')
+    if not isinstance(data, dict):
+        return _send_error('invalid', '无效的消息')
     if db.is_user_banned(uid):
-        return
+        return _send_error('banned', '账号已被封禁')
+    conv_id  = data.get('conversation_id')
+    content  = (data.get('content') or '').strip()
+    msg_type = data.get('msg_type', 'text')   # 'text'|'image'|'audio'|'file'
+    media_url = data.get('media_url')         # server-side path already saved by /api/upload
+    filename  = data.get('filename', '')
+    client_msg_id = data.get('client_msg_id') or None
+
+    if client_msg_id is not None and (not isinstance(client_msg_id, str) or len(client_msg_id) > CLIENT_MSG_ID_MAX):
+        return _send_error('invalid', '无效的消息')
+
+    # An outbox resend of a message that is already stored is acknowledged before any
+    # limit applies: rejecting it would make the client retry or mark it failed.
+    if client_msg_id and isinstance(conv_id, int):
+        stored = db.get_client_message(conv_id, uid, client_msg_id)
+        if stored:
+            return {'ok': True, 'message': _send_ack_message(stored, filename), 'duplicate': True}
+
     now = time.time()
     timestamps = user_msg_timestamps.setdefault(uid, [])
     timestamps[:] = [t for t in timestamps if now - t < 1]
     if len(timestamps) >= 6:
-        return
+        return _send_error('rate_limited', '发送太快，请稍后再试')
     timestamps.append(now)
-    conv_id  = data.get('conversation_id')
-    content  = data.get('content', '').strip()
-    msg_type = data.get('msg_type', 'text')   # 'text'|'image'|'audio'|'file'
-    media_url = data.get('media_url')         # server-side path already saved by /api/upload
-    filename  = data.get('filename', '')
 
     # Whitelist msg_type
     if msg_type not in ('text', 'image', 'audio', 'video', 'file'):
@@ -811,22 +1394,25 @@ def on_send(data):
     # Validate media_url: must be a local upload path owned by this user
     if media_url:
         if not isinstance(media_url, str) or not media_url.startswith('/static/uploads/') or '..' in media_url:
-            return
+            return _send_error('invalid', '无效的文件')
         if not db.verify_file_owner(uid, media_url):
-            return
+            return _send_error('forbidden', '无权发送该文件')
 
     # For media messages content may be empty – use filename as fallback display text
     if msg_type != 'text' and not content:
         content = filename or msg_type
     if not conv_id or (not content and msg_type == 'text'):
-        return
-    if not db.is_member(conv_id, uid):
-        return
+        return _send_error('invalid', '消息不能为空')
+    allowed, reason = db.can_post(conv_id, uid)
+    if not allowed:
+        return _send_error('forbidden', reason)
+    if fanout.saturated() and _room_size(conv_id) > FANOUT_LARGE_ROOM:
+        return _send_error('busy', '服务器繁忙，请稍后再试')   # the client's outbox retries
     if msg_type == 'text':
         settings = db.get_system_settings()
         max_len = int(settings.get('max_message_length', '2000'))
         if len(content) > max_len:
-            return
+            return _send_error('too_long', f'消息长度不能超过 {max_len} 字')
 
     orig_id = data.get('original_message_id')
     try:
@@ -834,16 +1420,31 @@ def on_send(data):
     except:
         orig_id = None
 
-    msg = db.save_message(conv_id, uid, content, msg_type=msg_type, media_url=media_url, original_message_id=orig_id)
+    msg = db.save_message(conv_id, uid, content, msg_type=msg_type, media_url=media_url,
+                          original_message_id=orig_id, client_msg_id=client_msg_id)
+    duplicate = msg.pop('duplicate')
+    if duplicate and now in timestamps:
+        timestamps.remove(now)   # stored by a concurrent retry; only new messages count
     msg['sender_name'] = session.get('username')
-    if orig_id:
-        orig_msg = db.get_message_by_id(orig_id)
-        if orig_msg:
-            msg['original_content'] = orig_msg['content']
-            msg['original_sender_name'] = db.get_username(orig_msg['sender_id'])
-    if filename:
-        msg['filename'] = filename
-    emit('new_message', msg, room=f'conv_{conv_id}')
+    msg = _send_ack_message(msg, filename)
+    if not duplicate:
+        _broadcast('new_message', msg, conv_id)
+        typing_status.stop(conv_id, uid)
+    return {'ok': True, 'message': msg, 'duplicate': duplicate}
+
+
+# ---------- Metrics ----------
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 
 # ---------- Admin ----------
@@ -861,11 +1462,8 @@ def verify_admin_password(password):
             _admin_config_cache['config'] = json.load(f)
             _admin_config_cache['mtime'] = mtime
     config = _admin_config_cache['config']
-    ph = PasswordHasher()
-    try:
-        return ph.verify(config['admin_password_hash'], password)
-    except VerifyMismatchError:
-        return False
+    ok, _ = passwords.verify_password(config['admin_password_hash'], password)
+    return ok
 
 
 def require_admin(f):
@@ -896,9 +1494,9 @@ def admin_login():
     password = request.json.get('password', '')
     if verify_admin_password(password):
         session['is_admin'] = True
-        app.logger.info(f"Admin logged in from {request.remote_addr}")
+        app.logger.info('Admin logged in from %s', request.remote_addr)
         return jsonify({'ok': True})
-    app.logger.warning(f"Admin login failed from {request.remote_addr}")
+    app.logger.warning('Admin login failed from %s', request.remote_addr)
     return jsonify({'ok': False, 'msg': '密码错误'})
 
 
@@ -908,10 +1506,48 @@ def admin_logout():
     return jsonify({'ok': True})
 
 
+def _admin_page_args(sorts):
+    """Common ?limit=&cursor=&sort=&order= arguments of the admin listings. Returns (kwargs, error msg)."""
+    sort = request.args.get('sort', 'id')
+    if sort not in sorts:
+        return None, '无效的排序字段'
+    try:
+        limit = max(1, int(request.args.get('limit', database.ADMIN_PAGE_SIZE)))
+    except ValueError:
+        return None, '无效的分页大小'
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        try:
+            database.decode_cursor(cursor)
+        except ValueError:
+            return None, '无效的分页游标'
+    return {'limit': limit, 'cursor': cursor, 'sort': sort,
+            'desc': request.args.get('order') == 'desc',
+            'prefix': request.args.get('q', '').strip()}, None
+
+
+def _optional_int_arg(name):
+    value = request.args.get(name, '')
+    return int(value) if value.strip() else None
+
+
 @app.route('/api/admin/users')
 @require_admin
 def admin_get_users():
-    users = db.get_all_users()
+    """Paginated: ?q=<username prefix>&banned=0|1&min_storage_mb=&sort=id|username|storage&order=asc|desc&cursor="""
+    kwargs, error = _admin_page_args(database.USER_SORTS)
+    if error:
+        return jsonify({'ok': False, 'msg': error})
+    banned = request.args.get('banned', '')
+    if banned in ('0', '1'):
+        kwargs['banned'] = banned == '1'
+    try:
+        min_storage_mb = _optional_int_arg('min_storage_mb')
+    except ValueError:
+        return jsonify({'ok': False, 'msg': '无效的用量筛选值'})
+    if min_storage_mb:
+        kwargs['min_storage_bytes'] = min_storage_mb * 1024 * 1024
+    users, next_cursor = db.get_users_page(**kwargs)
     # Attach global quota to users who haven't overridden it
     settings = db.get_system_settings()
     default_quota_mb = int(settings.get('default_storage_quota_mb', '10240'))
@@ -921,7 +1557,18 @@ def admin_get_users():
             u['quota_is_default'] = True
         else:
             u['quota_is_default'] = False
-    return jsonify({'ok': True, 'users': users})
+    return jsonify({'ok': True, 'users': users, 'next_cursor': next_cursor})
+
+
+def _check_new_user(username, password):
+    """The admin create-user checks. Returns an error message or None."""
+    if not username or not password:
+        return '用户名和密码不能为空'
+    if len(username) < 2 or len(username) > 20:
+        return '用户名长度应2-20个字符'
+    if len(password) < 4:
+        return '密码至少4个字符'
+    return None
 
 
 @app.route('/api/admin/users', methods=['POST'])
@@ -930,16 +1577,266 @@ def admin_create_user():
     data = request.json or {}
     username = data.get('username', '').strip()
     password = data.get('password', '')
-    if not username or not password:
-        return jsonify({'ok': False, 'msg': '用户名和密码不能为空'})
-    if len(username) < 2 or len(username) > 20:
-        return jsonify({'ok': False, 'msg': '用户名长度应2-20个字符'})
-    if len(password) < 4:
-        return jsonify({'ok': False, 'msg': '密码至少4个字符'})
+    error = _check_new_user(username, password)
+    if error:
+        return jsonify({'ok': False, 'msg': error})
     ok, msg = db.create_user(username, password)
     return jsonify({'ok': ok, 'msg': msg})
 
 
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '100000'))
+IMPORT_READ_CHUNK = 64 * 1024        # characters read from the body at a time
+IMPORT_RECORD_MAX = 64 * 1024        # largest JSON array element / NDJSON or CSV line accepted
+_import_running = threading.Lock()
+
+
+def _json_array_items(text):
+    """
+    Yield the elements of a JSON array read incrementally from the text stream
+    `text`; only the element being parsed is held in memory.  Raises ValueError
+    when the array is malformed or an element exceeds IMPORT_RECORD_MAX.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    expect = '['   # '[', 'first' (element or ']'), 'element', 'sep' (',' or ']')
+
+    def fill():
+        nonlocal buf, pos, eof
+        if eof:
+            raise ValueError('unexpected end of JSON array')
+        if len(buf) - pos > IMPORT_RECORD_MAX:
+            raise ValueError('JSON array element too large')
+        chunk = text.read(IMPORT_READ_CHUNK)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            fill()
+            continue
+        ch = buf[pos]
+        if expect == '[':
+            if ch != '[':
+                raise ValueError('expected a JSON array')
+            pos, expect = pos + 1, 'first'
+        elif ch == ']' and expect in ('first', 'sep'):
+            return
+        elif expect == 'sep':
+            if ch != ',':
+                raise ValueError("expected ',' or ']'")
+            pos, expect = pos + 1, 'element'
+        else:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                fill()   # element not complete yet (or malformed: then fill() hits the end)
+                continue
+            following = buf[end:].lstrip()[:1]
+            if following not in (',', ']') and not eof:
+                fill()   # '1' of '1.5': a number is only complete once its delimiter is in
+                continue
+            if end - pos > IMPORT_RECORD_MAX:
+                raise ValueError('JSON array element too large')
+            pos, expect = end, 'sep'
+            yield item
+
+
+def _import_records():
+    """
+    Yield (line, record or error message) from the request body: a JSON array,
+    NDJSON (one object per line) or CSV with a username,password[,quota_mb] header.
+    The body is read as it arrives, not buffered whole; a JSON array element or
+    a line may be at most IMPORT_RECORD_MAX characters.
+    """
+    kind = request.mimetype
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    if kind == 'application/json':
+        i = 0
+        try:
+            for i, item in enumerate(_json_array_items(lines), 1):
+                yield i, item if isinstance(item, dict) else '格式错误'
+        except ValueError:
+            yield i + 1, 'JSON 格式错误，其余未处理'
+        return
+    if kind in ('application/x-ndjson', 'application/jsonl'):
+        i = 0
+        try:
+            for i, line in enumerate(_bounded_lines(lines), 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = None
+                yield i, item if isinstance(item, dict) else '格式错误'
+        except ValueError:
+            yield i + 1, '行过长，其余未处理'
+        return
+    reader = csv.reader(_bounded_lines(lines))
+    try:
+        header = next(reader, None)
+        if header is None:
+            return
+        header = [h.strip().lower() for h in header]
+        if 'username' not in header or 'password' not in header:
+            yield 1, 'CSV 首行须为表头，至少包含 username,password'
+            return
+        for row in reader:
+            if any(cell.strip() for cell in row):
+                yield reader.line_num, dict(zip(header, row))
+    except ValueError:
+        yield reader.line_num + 1, '行过长，其余未处理'
+
+
+def _bounded_lines(text):
+    """Lines of the text stream `text`; raises ValueError on one longer than IMPORT_RECORD_MAX."""
+    while True:
+        line = text.readline(IMPORT_RECORD_MAX + 1)
+        if not line:
+            return
+        if len(line) > IMPORT_RECORD_MAX:
+            raise ValueError('line too long')
+        yield line
+
+
+def _import_row(record):
+    """Validate one import record. Returns ((username, password, quota_mb), None) or (None, error)."""
+    username = str(record.get('username') or '').strip()
+    password = str(record.get('password') or '')
+    error = _check_new_user(username, password)
+    if error:
+        return None, error
+    quota_mb = record.get('quota_mb')
+    if quota_mb in (None, ''):
+        quota_mb = None
+    else:
+        try:
+            quota_mb = int(quota_mb)
+            if quota_mb < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return None, '无效的配额值'
+    return (username, password, quota_mb), None
+
+
+@app.route('/api/admin/users/import', methods=['POST'])
+@require_admin
+def admin_import_users():
+    """
+    Bulk user creation.  Streams back one NDJSON result per input row
+    ({"line", "username", "ok", "msg"}) and a final {"done": true, ...} summary.
+    Passwords are hashed in parallel on passwords.bulk_pool and each batch is
+    inserted in one transaction.
+    """
+    if not _import_running.acquire(blocking=False):
+        return jsonify({'ok': False, 'msg': '已有导入任务在进行，请稍后再试'})
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            _import_running.release()
+
+    def result(line, username, ok, msg):
+        return json.dumps({'line': line, 'username': username, 'ok': ok, 'msg': msg}, ensure_ascii=False) + '\n'
+
+    def flush(batch):
+        hashes = passwords.hash_passwords([row[1] for _, row in batch])
+        while True:
+            try:
+                outcomes = db.bulk_create_users([(row[0], h, row[2]) for (_, row), h in zip(batch, hashes)])
+                break
+            except PoolTimeout:
+                raise
+            except PoolBusy:   # shed under load: wait for the pool rather than drop the batch
+                socketio.sleep(0.2)
+        return [(line, row[0], ok, msg) for (line, row), (ok, msg) in zip(batch, outcomes)]
+
+    def generate():
+        created = failed = total = 0
+        batch = []
+        try:
+            for line, record in _import_records():
+                total += 1
+                if total > IMPORT_MAX_ROWS:
+                    yield result(line, '', False, f'超过单次导入上限 {IMPORT_MAX_ROWS} 行，其余未处理')
+                    failed += 1
+                    break
+                row, error = _import_row(record) if isinstance(record, dict) else (None, record)
+                if error:
+                    failed += 1
+                    yield result(line, (record.get('username') if isinstance(record, dict) else '') or '', False, error)
+                    continue
+                batch.append((line, row))
+                if len(batch) >= passwords.BULK_HASH_BATCH:
+                    for outcome in flush(batch):
+                        created += outcome[2]
+                        failed += not outcome[2]
+                        yield result(*outcome)
+                    batch = []
+            for outcome in flush(batch) if batch else ():
+                created += outcome[2]
+                failed += not outcome[2]
+                yield result(*outcome)
+            app.logger.warning('Admin imported %d users (%d rows failed)', created, failed)
+            yield json.dumps({'done': True, 'created': created, 'failed': failed}) + '\n'
+        finally:
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # generate() releases as soon as it finishes, but a body that is never iterated
+    # (client gone, error before the first chunk) never runs its finally: the server
+    # still closes the response, so release there too.
+    response.call_on_close(release)
+    return response
+
+
+def _bulk_user_ids(data):
+    """The user_ids list of a bulk request, or None if it is not a list of ints."""
+    ids = data.get('user_ids')
+    if not isinstance(ids, list) or not ids or len(ids) > IMPORT_MAX_ROWS:
+        return None
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return None
+    return ids
+
+
+@app.route('/api/admin/users/bulk-ban', methods=['POST'])
+@require_admin
+def admin_bulk_ban():
+    data = request.json or {}
+    ids = _bulk_user_ids(data)
+    if ids is None:
+        return jsonify({'ok': False, 'msg': '请提供用户 ID 列表'})
+    ban = bool(data.get('ban', True))
+    n = db.ban_users(ids, ban)
+    action = '封禁' if ban else '解封'
+    app.logger.warning('Admin bulk %s %d users', action, n)
+    return jsonify({'ok': True, 'msg': f'已{action} {n} 个用户', 'count': n})
+
+
+@app.route('/api/admin/users/bulk-quota', methods=['PUT'])
+@require_admin
+def admin_bulk_quota():
+    data = request.json or {}
+    ids = _bulk_user_ids(data)
+    if ids is None:
+        return jsonify({'ok': False, 'msg': '请提供用户 ID 列表'})
+    quota_mb = data.get('quota_mb')
+    if quota_mb is not None:
+        try:
+            quota_mb = int(quota_mb)
+            if quota_mb < 0:
+                raise ValueError
+        except (ValueError, TypeError):
+            return jsonify({'ok': False, 'msg': '无效的配额值'})
+    n = db.set_users_quota(ids, quota_mb)
+    return jsonify({'ok': True, 'msg': f'已更新 {n} 个用户的配额', 'count': n})
+
+
 @app.route('/api/admin/users/<int:user_id>/quota', methods=['PUT'])
 @require_admin
 def admin_set_user_quota(user_id):
@@ -962,9 +1859,11 @@ def admin_delete_user(user_id):
     user = db.get_user_by_id(user_id)
     if not user:
         return jsonify({'ok': False, 'msg': '用户不存在'})
-    db.delete_user(user_id)
-    app.logger.warning(f"Admin deleted user {user_id} ({user['username']})")
-    return jsonify({'ok': True, 'msg': f'用户 {user["username"]} 已删除'})
+    job_id = db.tombstone_user(user_id)
+    if job_id is None:
+        return jsonify({'ok': False, 'msg': '该用户已在删除中'})
+    app.logger.warning('Admin deleted user %s (%s), job %s', user_id, user['username'], job_id)
+    return jsonify({'ok': True, 'msg': f'用户 {user["username"]} 已删除，数据正在后台清理', 'job_id': job_id})
 
 
 @app.route('/api/admin/users/<int:user_id>/ban', methods=['PUT'])
@@ -976,15 +1875,36 @@ def admin_ban_user(user_id):
     ban = (request.json or {}).get('ban', True)
     db.ban_user(user_id, ban)
     action = '封禁' if ban else '解封'
-    app.logger.warning(f"Admin {action} user {user_id} ({user['username']})")
+    app.logger.warning('Admin %s user %s (%s)', action, user_id, user['username'])
     return jsonify({'ok': True, 'msg': f'用户 {user["username"]} 已{action}'})
 
 
 @app.route('/api/admin/groups')
 @require_admin
 def admin_get_groups():
-    groups = db.get_all_groups()
-    return jsonify({'ok': True, 'groups': groups})
+    """Paginated: ?q=<name prefix>&min_members=&max_members=&sort=id|name|members&order=asc|desc&cursor="""
+    kwargs, error = _admin_page_args(database.GROUP_SORTS)
+    if error:
+        return jsonify({'ok': False, 'msg': error})
+    try:
+        kwargs['min_members'] = _optional_int_arg('min_members')
+        kwargs['max_members'] = _optional_int_arg('max_members')
+    except ValueError:
+        return jsonify({'ok': False, 'msg': '无效的成员数筛选值'})
+    groups, next_cursor = db.get_groups_page(**kwargs)
+    return jsonify({'ok': True, 'groups': groups, 'next_cursor': next_cursor})
+
+
+@app.route('/api/admin/groups/<int:conv_id>/members')
+@require_admin
+def admin_get_group_members(conv_id):
+    try:
+        after = int(request.args.get('after', 0))
+        limit = max(1, int(request.args.get('limit', database.ADMIN_PAGE_SIZE)))
+    except ValueError:
+        return jsonify({'ok': False, 'msg': '无效的分页参数'})
+    members = db.get_group_members_page(conv_id, limit, after)
+    return jsonify({'ok': True, 'members': members})
 
 
 @app.route('/api/admin/groups/<int:conv_id>', methods=['PUT'])
@@ -1000,17 +1920,107 @@ def admin_rename_group(conv_id):
 @app.route('/api/admin/groups/<int:conv_id>', methods=['DELETE'])
 @require_admin
 def admin_delete_group(conv_id):
-    db.delete_group(conv_id)
-    return jsonify({'ok': True, 'msg': '群聊已删除'})
+    job_id = db.tombstone_group(conv_id)
+    if job_id is None:
+        return jsonify({'ok': False, 'msg': '群聊不存在或已在删除中'})
+    app.logger.warning('Admin deleted group %s, job %s', conv_id, job_id)
+    return jsonify({'ok': True, 'msg': '群聊已删除，消息正在后台清理', 'job_id': job_id})
+
+
+@app.route('/api/admin/deletions')
+@require_admin
+def admin_get_deletions():
+    return jsonify({'ok': True, 'jobs': db.get_deletion_jobs()})
+
+
+@app.route('/api/admin/deletions/<int:job_id>/retry', methods=['POST'])
+@require_admin
+def admin_retry_deletion(job_id):
+    if not db.retry_deletion_job(job_id):
+        return jsonify({'ok': False, 'msg': '只能重试失败的任务'})
+    return jsonify({'ok': True, 'msg': '已重新排队'})
+
+
+@app.route('/api/admin/groups/<int:conv_id>/retention', methods=['PUT'])
+@require_admin
+def admin_set_group_retention(conv_id):
+    days = (request.json or {}).get('retention_days')
+    if days is not None:
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            return jsonify({'ok': False, 'msg': '保留天数必须为整数'})
+        if days < 0:
+            return jsonify({'ok': False, 'msg': '保留天数不能为负数'})
+    db.set_conversation_retention(conv_id, days)
+    return jsonify({'ok': True, 'msg': '消息保留策略已更新'})
 
 
 @app.route('/api/admin/stats')
 @require_admin
 def admin_get_stats():
     stats = db.get_admin_stats()
+    stats['db_pool'] = database.pool.stats()
+    stats['db_lock_wait'] = db_backends.lock_waits.snapshot()
+    stats['hub_blocks'] = profiler.hub_monitor_stats()
+    stats['replay'] = replay_log.stats()
+    stats['presence'] = presence.stats()
+    stats['typing'] = typing_status.stats()
+    stats['fanout'] = fanout.stats()
     return jsonify({'ok': True, 'stats': stats})
 
 
+@app.route('/api/admin/stats/history')
+@require_admin
+def admin_get_stats_history():
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in database.STATS_BUCKETS:
+        return jsonify({'ok': False, 'msg': '无效的时间粒度'})
+    try:
+        hours = float(request.args.get('hours', 24))
+    except ValueError:
+        hours = None
+    if hours is None or not math.isfinite(hours) or hours <= 0:
+        return jsonify({'ok': False, 'msg': '无效的时间范围'})
+    hours = min(hours, database.STATS_KEEP[granularity] / 3600)
+    history = db.get_stats_history(granularity, time.time() - hours * 3600)
+    return jsonify({'ok': True, 'granularity': granularity, 'history': history})
+
+
+@app.route('/api/admin/profile', methods=['POST'])
+@require_admin
+def admin_profile():
+    """Sample all greenlets and threads for N seconds; returns collapsed stacks for a flamegraph."""
+    data = request.json or {}
+    try:
+        seconds = float(data.get('seconds', 10))
+        interval_ms = float(data.get('interval_ms', 10))
+    except (TypeError, ValueError):
+        return jsonify({'ok': False, 'msg': '参数无效'})
+    if not 0 < seconds <= profiler.MAX_SECONDS:
+        return jsonify({'ok': False, 'msg': f'采样时长需在 0 到 {profiler.MAX_SECONDS} 秒之间'})
+    app.logger.info('Admin started a %ss sampling profile', seconds)
+    folded = profiler.profile(seconds, interval_ms, socketio.sleep)
+    if folded is None:
+        return jsonify({'ok': False, 'msg': '已有采样正在进行'}), 409
+    return Response(folded, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=profile-{int(time.time())}.folded'
+    })
+
+
+@app.route('/api/admin/sql-trace')
+@require_admin
+def admin_get_sql_trace():
+    return jsonify({
+        'ok': True,
+        'enabled': sqltrace.ENABLED,
+        'slow_ms': sqltrace.SLOW_MS,
+        'n_plus_one_min': sqltrace.N_PLUS_ONE_MIN,
+        'traces': list(reversed(sqltrace.recent)),
+        'slow_queries': list(reversed(sqltrace.slow_queries)),
+    })
+
+
 @app.route('/api/admin/system-settings')
 @require_admin
 def admin_get_system_settings():
@@ -1023,7 +2033,15 @@ def admin_get_system_settings():
 def admin_update_system_settings():
     data = request.json or {}
     allowed_keys = ('registration_enabled', 'max_message_length', 'system_name',
-                    'allow_friend_requests', 'default_storage_quota_mb')
+                    'allow_friend_requests', 'default_storage_quota_mb',
+                    'message_retention_days', 'archive_after_days')
+    for key in ('message_retention_days', 'archive_after_days'):
+        if key in data:
+            try:
+                if int(data[key]) < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return jsonify({'ok': False, 'msg': '天数必须为非负整数'})
     for key in allowed_keys:
         if key in data:
             db.update_system_setting(key, str(data[key]))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking, structured application logging.
+
+Request handlers only put LogRecords on an in-memory queue (QueueHandler); a
+QueueListener thread formats them and does the file I/O, including rotation,
+so a slow disk or a rotation never stalls the gevent hub.
+
+Records carry the request context bound with bind() (request id, user id,
+route) and are written as one JSON object per line (LOG_FORMAT=json, default)
+or as the old text format (LOG_FORMAT=text).
+
+Log calls use %-style arguments so the message is only built by the writer
+thread.  High-volume events pass extra=sampled('name'); LOG_SAMPLE sets the
+fraction kept per name, e.g. LOG_SAMPLE="shed=0.05,login=0.5".
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR          = 'logs'
+LOG_FORMAT       = os.environ.get('LOG_FORMAT', 'json')
+LOG_MAX_BYTES    = int(os.environ.get('LOG_MAX_BYTES', str(1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '10'))
+DEFAULT_SAMPLE_RATES = {'shed': 0.1}   # load-shedding warnings arrive by the thousand under overload
+
+_context = contextvars.ContextVar('log_context', default={})
+_listener = None
+_handler = None
+
+
+def _parse_rates(spec):
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for part in spec.split(','):
+        name, _, rate = part.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+SAMPLE_RATES = _parse_rates(os.environ.get('LOG_SAMPLE', ''))
+
+
+def bind(**fields):
+    """Attach fields (request_id, user_id, ...) to every record logged in this context. Returns a reset token."""
+    return _context.set({**_context.get(), **fields})
+
+
+def unbind(token):
+    if token is not None:
+        _context.reset(token)
+
+
+def sampled(name):
+    """extra= for a high-volume log call; the record is kept with probability SAMPLE_RATES[name]."""
+    return {'sample': name}
+
+
+class _SamplingFilter(logging.Filter):
+    def filter(self, record):
+        name = getattr(record, 'sample', None)
+        if name is None:
+            return True
+        rate = SAMPLE_RATES.get(name, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _ContextQueueHandler(QueueHandler):
+    """
+    Captures the bound context and any traceback in the calling thread, but
+    leaves msg % args to the writer thread.
+    """
+
+    def prepare(self, record):
+        record.context = _context.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# LogRecord attributes that are not user-supplied extra= fields.
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'context', 'sample'}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        entry['src'] = f'{record.module}:{record.lineno}'
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+
+    def format(self, record):
+        line = super().format(record)
+        ctx = getattr(record, 'context', None)
+        if ctx:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in ctx.items())
+        return line
+
+
+def setup(*loggers, level=logging.INFO):
+    """Route `loggers` through the queue to logs/app.log. Safe to call more than once."""
+    global _listener, _handler
+    if _listener is None:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        file_handler = RotatingFileHandler(os.path.join(LOG_DIR, 'app.log'),
+                                           maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8')
+        file_handler.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)   # flush what is still queued
+        _handler = _ContextQueueHandler(records)
+        _handler.addFilter(_SamplingFilter())
+    for logger in loggers:
+        if _handler not in logger.handlers:
+            logger.addHandler(_handler)
+        logger.setLevel(level)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Front-end asset pipeline: vendored libraries, icon sprite, minification and
+content-hashed file names.
+
+Third-party files are pinned in VENDOR and downloaded once into vendor/ with
+`python assets.py vendor` (checked against their SRI hash when one is pinned),
+so pages never wait on a CDN and a library cannot change under us.  build()
+turns the sources into dist/:
+
+  chat.js, style.css   whitespace and comments stripped
+  socket.io.js         the vendored copy as-is (already minified)
+  icons.svg            only the Lucide symbols the templates and chat.js use
+
+Every output is named <name>.<content hash>.<ext> and has a .gz sibling, so
+/assets/ can serve it with an immutable one-year Cache-Control: a changed file
+gets a new URL and a deploy needs no cache purge.
+
+Until the vendor files exist the pages fall back to the pinned CDN URLs (and
+the Lucide runtime instead of the sprite).
+"""
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VENDOR_DIR = os.path.join(BASE_DIR, 'vendor')
+DIST_DIR = os.path.join(BASE_DIR, 'dist')
+DIST_URL = '/assets/'
+DIST_KEEP_SECONDS = 7 * 86400   # superseded builds stay this long for pages still open
+
+# logical name -> (pinned URL, SRI hash or None, file under vendor/)
+VENDOR = {
+    'socket.io.js': ('https://cdn.socket.io/4.7.4/socket.io.min.js',
+                     'sha256-rVL8VAaAlF/nVJwPGxEmtUAp3X6yX4zisHmmJCyAcBE=', 'socket.io-4.7.4.min.js'),
+    'lucide-sprite.svg': ('https://unpkg.com/lucide-static@0.460.0/sprite.svg',
+                          None, 'lucide-static-0.460.0-sprite.svg'),
+}
+# Used when the sprite is not vendored: the same Lucide release, rendered at runtime.
+LUCIDE_RUNTIME = 'https://unpkg.com/lucide@0.460.0/dist/umd/lucide.min.js'
+
+# logical name -> source under BASE_DIR
+SOURCES = {
+    'chat.js': os.path.join('static', 'js', 'chat.js'),
+    'style.css': os.path.join('static', 'css', 'style.css'),
+}
+# Files scanned for icon names
+ICON_SOURCES = (os.path.join('static', 'js', 'chat.js'), os.path.join('templates', 'chat.html'))
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+
+auto_rebuild = False   # rebuild when a source changes (debug server)
+_manifest = {}         # logical name -> URL
+_built_mtimes = None
+_lock = threading.Lock()
+
+
+class AssetError(Exception):
+    pass
+
+
+# ── Minification ─────────────────────────────────────────────────────────────
+
+_WORD = re.compile(r'[\w$\\]')
+# After these a '/' starts a regular expression, otherwise it divides.
+_REGEX_AFTER_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete',
+                         'void', 'throw', 'instanceof', 'yield', 'await'}
+# A line break may go when it follows or precedes one of these: no statement can end there.
+_JOIN_AFTER = set('{;,([=:?&|<>*%!~^')
+_JOIN_BEFORE = set('}),;]')
+
+
+def _is_word(ch):
+    return bool(ch) and (bool(_WORD.match(ch)) or ord(ch) > 127)
+
+
+def minify_js(src):
+    """
+    Strip comments, indentation and redundant whitespace.  Tokens are never
+    rewritten; line breaks are kept wherever automatic semicolon insertion could
+    depend on them, so the result parses exactly like the input.
+    """
+    out = []
+    i, n = 0, len(src)
+    templates = []       # brace depth inside each open ${ ... } of a template literal
+    pending = ''         # whitespace seen since the last token: '', ' ' or '\n'
+    last_word = ''       # last identifier/keyword emitted, for the regex-or-divide decision
+    last = ''            # last significant character emitted
+
+    def emit(text):
+        nonlocal pending, last
+        if pending and out:
+            first = text[0]
+            if pending == '\n' and last not in _JOIN_AFTER and first not in _JOIN_BEFORE:
+                out.append('\n')
+            elif ((_is_word(last) and _is_word(first)) or (last in '+-' and first in '+-')
+                  or (last == '/' and first in '/*')):
+                out.append(' ')
+        pending = ''
+        out.append(text)
+        last = text[-1]
+
+    def read_template(start):
+        # From just after a backtick (or a closing '}' of ${}) to the closing backtick or the next '${'.
+        j = start
+        while j < n:
+            c = src[j]
+            if c == '\\':
+                j += 2
+                continue
+            if c == '`':
+                return j + 1, False
+            if c == '$' and src.startswith('${', j):
+                return j + 2, True
+            j += 1
+        raise AssetError('unterminated template literal')
+
+    while i < n:
+        c = src[i]
+        if c in ' \t\r\n':
+            if c == '\n' or pending == '\n':
+                pending = '\n'
+            else:
+                pending = pending or ' '
+            i += 1
+        elif src.startswith('//', i):
+            end = src.find('\n', i)
+            i = n if end < 0 else end
+        elif src.startswith('/*', i):
+            end = src.find('*/', i + 2)
+            if end < 0:
+                raise AssetError('unterminated comment')
+            pending = '\n' if '\n' in src[i:end] or pending == '\n' else (pending or ' ')
+            i = end + 2
+        elif c in '\'"':
+            j = i + 1
+            while j < n and src[j] != c:
+                if src[j] == '\n':
+                    raise AssetError('unterminated string')
+                j += 2 if src[j] == '\\' else 1
+            if j >= n:
+                raise AssetError('unterminated string')
+            emit(src[i:j + 1])
+            last_word = ''
+            i = j + 1
+        elif c == '`':
+            j, opened = read_template(i + 1)
+            emit(src[i:j])
+            if opened:
+                templates.append(0)
+            last_word = ''
+            i = j
+        elif c == '}' and templates and templates[-1] == 0:
+            templates.pop()
+            j, opened = read_template(i + 1)
+            emit(src[i:j])
+            if opened:
+                templates.append(0)
+            i = j
+        elif c == '/' and (not last or last in '(,=:[!&|?{};+-*%<>~^' or last_word in _REGEX_AFTER_KEYWORDS):
+            j, in_class = i + 1, False
+            while j < n and (in_class or src[j] != '/'):
+                if src[j] == '\n':
+                    raise AssetError('unterminated regular expression')
+                if src[j] == '\\':
+                    j += 1
+                elif src[j] == '[':
+                    in_class = True
+                elif src[j] == ']':
+                    in_class = False
+                j += 1
+            j += 1
+            while j < n and _is_word(src[j]):
+                j += 1
+            emit(src[i:j])
+            last_word = ''
+            i = j
+        elif _is_word(c):
+            j = i + 1
+            while j < n and (_is_word(src[j]) or (src[j] == '.' and src[i].isdigit())):
+                j += 1
+            word = src[i:j]
+            emit(word)
+            last_word = word
+            i = j
+        else:
+            if templates:
+                if c == '{':
+                    templates[-1] += 1
+                elif c == '}':
+                    templates[-1] -= 1
+            emit(c)
+            last_word = ''
+            i += 1
+    return ''.join(out).strip() + '\n'
+
+
+def minify_css(src):
+    """Strip comments and whitespace that carries no meaning; strings are copied verbatim."""
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', src)
+    for k in range(0, len(parts), 2):
+        text = re.sub(r'/\*.*?\*/', '', parts[k], flags=re.S)
+        text = re.sub(r'\s+', ' ', text)
+        # Only after ':' — "a :hover" and "a:hover" are different selectors.
+        text = re.sub(r' ?([{};,>]) ?', r'\1', text).replace(': ', ':')
+        parts[k] = text.replace(';}', '}')
+    return ''.join(parts).strip() + '\n'
+
+
+# ── Icon sprite ──────────────────────────────────────────────────────────────
+
+def used_icons():
+    """Icon names the sources may render: data-lucide attributes plus identifier-like string literals."""
+    required, candidates = set(), set()
+    for rel in ICON_SOURCES:
+        with open(os.path.join(BASE_DIR, rel), encoding='utf-8') as f:
+            text = f.read()
+        required.update(re.findall(r'data-lucide="([a-z0-9-]+)"', text))
+        candidates.update(re.findall(r'[\'"`]([a-z][a-z0-9-]*)[\'"`]', text))
+    return required, candidates
+
+
+def build_sprite(sprite_svg):
+    """A sprite with the used symbols only. Raises AssetError when a data-lucide name is missing."""
+    ET.register_namespace('', SVG_NS)
+    root = ET.fromstring(sprite_svg)
+    symbols = {el.get('id'): el for el in root.iter(f'{{{SVG_NS}}}symbol')}
+    required, candidates = used_icons()
+    missing = sorted(required - symbols.keys())
+    if missing:
+        raise AssetError(f'icons missing from the vendored Lucide sprite: {", ".join(missing)}')
+    sprite = ET.Element(f'{{{SVG_NS}}}svg')
+    for name in sorted((required | candidates) & symbols.keys()):
+        symbol = symbols[name]
+        symbol.tail = None
+        sprite.append(symbol)
+    return ET.tostring(sprite, encoding='unicode').encode()
+
+
+# ── Build ────────────────────────────────────────────────────────────────────
+
+def _vendor_path(name):
+    return os.path.join(VENDOR_DIR, VENDOR[name][2])
+
+
+def _inputs():
+    paths = [os.path.join(BASE_DIR, p) for p in SOURCES.values()]
+    paths += [os.path.join(BASE_DIR, p) for p in ICON_SOURCES]
+    paths += [_vendor_path(name) for name in VENDOR]
+    return {p: os.path.getmtime(p) for p in paths if os.path.exists(p)}
+
+
+def _write(name, data):
+    stem, ext = os.path.splitext(name)
+    filename = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+    path = os.path.join(DIST_DIR, filename)
+    if not os.path.exists(path):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        with open(tmp + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        os.replace(tmp + '.gz', path + '.gz')
+        os.replace(tmp, path)
+    return filename
+
+
+def _prune(keep):
+    cutoff = time.time() - DIST_KEEP_SECONDS
+    for entry in os.scandir(DIST_DIR):
+        if entry.name.removesuffix('.gz') not in keep and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+
+
+def build(strict=False):
+    """
+    Write dist/ and return {logical name: URL}.  Vendored files that are absent are
+    left out; so is a sprite missing some used icon, unless `strict` (then AssetError).
+    """
+    global _manifest, _built_mtimes
+    with _lock:
+        mtimes = _inputs()
+        os.makedirs(DIST_DIR, exist_ok=True)
+        files = {}
+        for name, rel in SOURCES.items():
+            with open(os.path.join(BASE_DIR, rel), encoding='utf-8') as f:
+                text = f.read()
+            data = minify_js(text) if name.endswith('.js') else minify_css(text)
+            files[name] = _write(name, data.encode())
+        if os.path.exists(_vendor_path('socket.io.js')):
+            with open(_vendor_path('socket.io.js'), 'rb') as f:
+                files['socket.io.js'] = _write('socket.io.js', f.read())
+        if os.path.exists(_vendor_path('lucide-sprite.svg')):
+            with open(_vendor_path('lucide-sprite.svg'), 'rb') as f:
+                sprite = f.read()
+            try:
+                files['icons.svg'] = _write('icons.svg', build_sprite(sprite))
+            except AssetError:
+                if strict:
+                    raise
+                logging.getLogger(__name__).exception('Icon sprite not built; pages use the Lucide runtime')
+        with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(files, f, indent=2, sort_keys=True)
+        _prune(set(files.values()) | {'manifest.json'})
+        _manifest = {name: DIST_URL + filename for name, filename in files.items()}
+        _built_mtimes = mtimes
+        return dict(_manifest)
+
+
+def _current():
+    if _built_mtimes is None or (auto_rebuild and _inputs() != _built_mtimes):
+        build()
+    return _manifest
+
+
+def url(name):
+    """URL of a built asset, or None when it is not available (an unvendored library)."""
+    return _current().get(name)
+
+
+def scripts():
+    """[(src, integrity)] for chat.html in load order; CDN fallbacks carry their SRI hash."""
+    manifest = _current()
+    cdn, integrity, _ = VENDOR['socket.io.js']
+    result = [(manifest['socket.io.js'], None) if 'socket.io.js' in manifest else (cdn, integrity)]
+    if 'icons.svg' not in manifest:
+        result.append((LUCIDE_RUNTIME, None))
+    result.append((manifest['chat.js'], None))
+    return result
+
+
+def preloads():
+    """[(href, as)] for <link rel="preload">: the scripts served from /assets/."""
+    return [(src, 'script') for src, _ in scripts() if src.startswith(DIST_URL)]
+
+
+def locate(filename, gzip_ok):
+    """(path, gzipped) of a file in dist/, or (None, False). Older builds stay servable until pruned."""
+    if '/' in filename or '\\' in filename or filename.startswith('.') or filename == 'manifest.json':
+        return None, False
+    path = os.path.join(DIST_DIR, filename)
+    if gzip_ok and os.path.isfile(path + '.gz'):
+        return path + '.gz', True
+    return (path, False) if os.path.isfile(path) else (None, False)
+
+
+# ── Vendoring ────────────────────────────────────────────────────────────────
+
+def vendor():
+    """Download every pinned file that is not in vendor/ yet, checking pinned SRI hashes."""
+    import urllib.request
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    for name, (source, integrity, filename) in VENDOR.items():
+        path = os.path.join(VENDOR_DIR, filename)
+        if os.path.exists(path):
+            print(f'{filename} 已存在，跳过')
+            continue
+        with urllib.request.urlopen(source, timeout=30) as resp:
+            data = resp.read()
+        digest = 'sha256-' + base64.b64encode(hashlib.sha256(data).digest()).decode()
+        if integrity and digest != integrity:
+            raise AssetError(f'{source}: 校验失败，期望 {integrity}，实际 {digest}')
+        with open(path, 'wb') as f:
+            f.write(data)
+        print(f'{filename} ← {source} ({len(data)} 字节, {digest})')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if command == 'vendor':
+        vendor()
+    elif command == 'build':
+        for name, asset_url in build(strict=True).items():
+            print(f'{name:<14} {asset_url}')
+    else:
+        sys.exit('用法: python assets.py [vendor|build]')
@@ -0,0 +1,287 @@
+"""
+数据库基准测试
+在 seed_db.py 生成的真实规模数据上逐个计时 database.py 的公共函数（中位数 / p95 / 最大值），
+并与保存的基线对比，回归以百分比差异的形式显示。
+
+数据库只生成一次并缓存（--cache-dir），每次运行在它的副本上执行，写操作（save_message、
+record_file_upload、delete_user 等）不会影响下一次运行，结果可复现。仅支持 SQLite（含 MESSAGE_SHARDS）。
+
+用法:
+  python bench_db.py --size realistic --save          # 生成 10 万用户 / 100 万消息并记录基线
+  python bench_db.py --size realistic                 # 与基线对比
+  python bench_db.py --only get_messages,get_user_conversations --fail-over 20
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import database
+import seed_db
+
+# Passed to seed_db.seed(); anything not listed falls back to seed_db's defaults.
+SIZES = {
+    'small':     dict(users=2000, groups=200, large_groups=2, large_group_size=500, messages=100_000),
+    'realistic': dict(users=100_000, groups=10_000, large_groups=10, large_group_size=2000, messages=1_000_000),
+}
+BASELINE = 'bench_baseline.json'
+
+
+class Context:
+    """Ids sampled from the seeded database that the benchmarks draw their arguments from."""
+
+    def __init__(self, rng, sample=200):
+        with database.db_conn() as conn:
+            user_ids = [r['id'] for r in conn.execute('SELECT id FROM users ORDER BY id').fetchall()]
+            self.group_owners = {r['id']: r['created_by'] for r in conn.execute(
+                'SELECT id, created_by FROM conversations WHERE is_group = 1').fetchall()}
+            self.groups = sorted(self.group_owners)
+            privates = conn.execute(
+                'SELECT id FROM conversations WHERE is_group = 0 AND is_self_chat = 0'
+            ).fetchall()
+            self.privates = [r['id'] for r in privates]
+            # Users ranked by membership count, so the "busy" set exercises the long tail.
+            ranked = conn.execute(
+                '''SELECT user_id FROM conversation_members
+                   GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT ?''', (sample,)
+            ).fetchall()
+            self.busy_users = [r['user_id'] for r in ranked]
+            favorited = {r['user_id'] for r in conn.execute('SELECT DISTINCT user_id FROM favorite_messages')}
+            self.fav_users = sorted(favorited) or self.busy_users
+            self.largest_group = conn.execute(
+                '''SELECT conversation_id FROM conversation_members cm JOIN conversations c
+                   ON c.id = cm.conversation_id WHERE c.is_group = 1
+                   GROUP BY conversation_id ORDER BY COUNT(*) DESC LIMIT 1'''
+            ).fetchone()['conversation_id']
+        others = [u for u in user_ids if u not in favorited]
+        self.users = rng.sample(others, min(sample, len(others)))
+        # Disjoint from self.users so deleting them doesn't break later lookups.
+        rest = sorted(set(others) - set(self.users) - set(self.busy_users))
+        self.victims = rng.sample(rest, min(sample, len(rest)))
+        with database.db_conn() as conn:
+            # Prefixes matching a page or so of seeded names (user000123 -> user0001).
+            self.username_prefixes = [conn.execute('SELECT username FROM users WHERE id = ?', (u,)).fetchone()['username'][:-2]
+                                      for u in self.users[:20]]
+        self.message_ids = []
+        for conn in database._each_message_db():
+            rows = conn.execute('SELECT id FROM messages ORDER BY RANDOM() LIMIT ?', (sample,)).fetchall()
+            self.message_ids.extend(r['id'] for r in rows)
+        self.conversations = self.groups + self.privates
+        self.uploads = 0
+
+    def hot_conversation(self, rng):
+        # Half the calls hit the largest group, the rest a random conversation.
+        return self.largest_group if rng.random() < 0.5 else rng.choice(self.conversations)
+
+
+def _group_settings(ctx, rng):
+    group_id = rng.choice(ctx.groups)
+    return database.get_group_settings(group_id, ctx.group_owners[group_id])
+
+
+def _record_upload(ctx, rng):
+    ctx.uploads += 1
+    user_id = rng.choice(ctx.users)
+    return database.record_file_upload(user_id, f'/static/uploads/bench_{user_id}_{ctx.uploads}.bin', 4096)
+
+
+def _message_changes(ctx, rng):
+    # A client that last synced a day ago.
+    return database.get_message_changes(ctx.hot_conversation(rng), database.encode_cursor(time.time() - 86400, 0))
+
+
+def _forward_messages(ctx, rng):
+    # Multi-select forward: 30 messages into 20 conversations.
+    originals = database.get_messages_by_ids(rng.sample(ctx.message_ids, min(30, len(ctx.message_ids))))
+    targets = rng.sample(ctx.conversations, min(20, len(ctx.conversations)))
+    return database.forward_messages(rng.choice(ctx.busy_users), list(originals.values()), targets,
+                                     f'bench{rng.random()}')
+
+
+def _delete_user(ctx, rng):
+    return database.delete_user(ctx.victims.pop())
+
+
+# (function name, repetitions, call). Order matters: writes and delete_user run last.
+BENCHMARKS = [
+    ('get_user_by_id',            500, lambda c, r: database.get_user_by_id(r.choice(c.users))),
+    ('get_profile',               500, lambda c, r: database.get_profile(r.choice(c.users))),
+    ('is_member',                 500, lambda c, r: database.is_member(c.hot_conversation(r), r.choice(c.users))),
+    ('get_message_by_id',         500, lambda c, r: database.get_message_by_id(r.choice(c.message_ids))),
+    ('get_user_conversations',     50, lambda c, r: database.get_user_conversations(r.choice(c.busy_users))),
+    ('get_messages',              200, lambda c, r: database.get_messages(c.hot_conversation(r))),
+    ('get_message_changes',       200, _message_changes),
+    ('get_conversation_members',  100, lambda c, r: database.get_conversation_members(c.hot_conversation(r))),
+    ('get_pinned_messages',       200, lambda c, r: database.get_pinned_messages(r.choice(c.groups))),
+    ('get_group_settings',        200, _group_settings),
+    ('search_users',              100, lambda c, r: database.search_users(str(r.randint(0, 99)), r.choice(c.users))),
+    ('search_users_for_viewer',   100, lambda c, r: database.search_users_for_viewer(r.choice(c.users),
+                                                                                     str(r.randint(0, 99)))),
+    ('can_start_private_chat',    300, lambda c, r: database.can_start_private_chat(r.choice(c.users),
+                                                                                    r.choice(c.busy_users))),
+    ('get_friends',               200, lambda c, r: database.get_friends(r.choice(c.busy_users))),
+    ('get_friend_requests',       200, lambda c, r: database.get_friend_requests(r.choice(c.users))),
+    ('get_pending_request_count', 500, lambda c, r: database.get_pending_request_count(r.choice(c.users))),
+    ('get_favorite_messages',     200, lambda c, r: database.get_favorite_messages(r.choice(c.fav_users))),
+    ('get_user_storage_info',     300, lambda c, r: database.get_user_storage_info(r.choice(c.users))),
+    ('get_system_settings',       500, lambda c, r: database.get_system_settings()),
+    ('get_users_page',            100, lambda c, r: database.get_users_page(sort='storage', desc=True)),
+    ('get_users_page_prefix',     100, lambda c, r: database.get_users_page(prefix=r.choice(c.username_prefixes))),
+    ('get_groups_page',           100, lambda c, r: database.get_groups_page(sort='members', desc=True)),
+    ('get_group_members_page',    100, lambda c, r: database.get_group_members_page(c.largest_group)),
+    ('get_admin_stats',            10, lambda c, r: database.get_admin_stats()),
+    ('save_message',              300, lambda c, r: database.save_message(c.hot_conversation(r), r.choice(c.busy_users),
+                                                                          'bench message')),
+    ('forward_messages',           20, _forward_messages),
+    ('toggle_favorite_message',   300, lambda c, r: database.toggle_favorite_message(r.choice(c.users),
+                                                                                     r.choice(c.message_ids))),
+    ('record_file_upload',        300, _record_upload),
+    ('delete_user',                20, _delete_user),
+]
+
+
+def _db_files(path):
+    base, ext = os.path.splitext(path)
+    return [path] + sorted(glob.glob(f'{base}_msgs_*{ext}'))
+
+
+def prepare(args):
+    """Seed the cached database if needed and return the path of a fresh working copy."""
+    preset = dict(SIZES[args.size])
+    shards = f'_s{database.MESSAGE_SHARDS}' if database.MESSAGE_SHARDS else ''
+    cached = os.path.join(args.cache_dir, f'bench_{args.size}{shards}.db')
+    if args.reseed:
+        for path in _db_files(cached):
+            os.remove(path)
+    if not os.path.exists(cached):
+        print(f'生成 {args.size} 数据集 → {cached}')
+        seed_args = seed_db.build_parser().parse_args([])
+        for key, value in preset.items():
+            setattr(seed_args, key, value)
+        database.DB_PATH = cached
+        t0 = time.time()
+        seed_db.seed(seed_args)
+        print(f'数据集生成完毕，用时 {time.time() - t0:.1f}s')
+
+    work_dir = tempfile.mkdtemp(prefix='bench_db_')
+    work = os.path.join(work_dir, 'bench.db')
+    base, ext = os.path.splitext(cached)
+    for path in _db_files(cached):
+        shutil.copyfile(path, work[:-len(ext)] + path[len(base):])
+    database.DB_PATH = work
+    return work_dir
+
+
+def measure(fn, ctx, rng, repeat, warmup=3):
+    errors = 0
+    for _ in range(min(warmup, repeat)):
+        try:
+            fn(ctx, rng)
+        except Exception:
+            errors += 1
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            fn(ctx, rng)
+        except Exception:
+            errors += 1
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    ms = lambda s: round(s * 1000, 4)  # noqa: E731
+    return {
+        'n': repeat,
+        'median_ms': ms(statistics.median(timings)),
+        'p95_ms': ms(timings[min(len(timings) - 1, int(0.95 * len(timings)))]),
+        'max_ms': ms(timings[-1]),
+        'errors': errors,
+    }
+
+
+def compare(results, baseline, fail_over):
+    """Print the result table, diffed against the baseline. Returns the names that regressed."""
+    regressed = []
+    print(f'{"函数":<28}{"中位数ms":>11}{"p95 ms":>11}{"基线ms":>11}{"变化":>10}')
+    print('-' * 71)
+    for name, r in results.items():
+        base = baseline.get(name, {}).get('median_ms')
+        change = ''
+        flag = ''
+        if base:
+            pct = (r['median_ms'] - base) / base * 100
+            change = f'{pct:+.1f}%'
+            if fail_over is not None and pct > fail_over:
+                regressed.append(name)
+                flag = '  ⚠ 回归'
+        err = f'  （{r["errors"]} 次出错）' if r['errors'] else ''
+        print(f'{name:<28}{r["median_ms"]:>11.3f}{r["p95_ms"]:>11.3f}'
+              f'{(f"{base:.3f}" if base else "-"):>11}{change:>10}{flag}{err}')
+    return regressed
+
+
+def run(args):
+    work_dir = prepare(args)
+    try:
+        database.init_db()
+        rng = random.Random(args.seed)
+        ctx = Context(rng)
+        only = set(args.only.split(',')) if args.only else None
+        results = {}
+        for name, repeat, fn in BENCHMARKS:
+            if only and name not in only:
+                continue
+            repeat = max(1, int(repeat * args.repeat_scale))
+            if name == 'delete_user':
+                repeat = min(repeat, len(ctx.victims) - 3)
+            results[name] = measure(fn, ctx, rng, repeat)
+            print(f'  {name}: {results[name]["median_ms"]:.3f} ms', flush=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('size') == args.size:
+            baseline = saved['results']
+        else:
+            print(f'基线数据集为 {saved.get("size")}，与本次 {args.size} 不同，不做对比')
+    print()
+    regressed = compare(results, baseline, args.fail_over)
+
+    if args.save:
+        merged = dict(baseline, **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'size': args.size, 'shards': database.MESSAGE_SHARDS,
+                       'saved_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': merged},
+                      f, indent=2, ensure_ascii=False)
+        print(f'\n基线已保存到 {args.baseline}')
+    if regressed:
+        print(f'\n以下函数比基线慢 {args.fail_over}% 以上: {", ".join(regressed)}')
+    return results, regressed
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='database.py 基准测试')
+    p.add_argument('--size', choices=sorted(SIZES), default='small', help='数据集规模')
+    p.add_argument('--cache-dir', default=tempfile.gettempdir(), help='缓存生成的数据集的目录')
+    p.add_argument('--reseed', action='store_true', help='重新生成数据集')
+    p.add_argument('--baseline', default=BASELINE, help='基线文件路径')
+    p.add_argument('--save', action='store_true', help='把本次结果写入基线')
+    p.add_argument('--only', help='只运行这些函数（逗号分隔）')
+    p.add_argument('--repeat-scale', type=float, default=1.0, help='按比例放大/缩小每个函数的调用次数')
+    p.add_argument('--fail-over', type=float, default=None,
+                   help='中位数比基线慢超过该百分比时以非零状态退出')
+    p.add_argument('--seed', type=int, default=7)
+    return p
+
+
+if __name__ == '__main__':
+    _, regressed = run(build_parser().parse_args())
+    sys.exit(1 if regressed else 0)
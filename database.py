@@ -3,41 +3,262 @@ import sqlite3
 import os
 import time
 import threading
+import zlib
+import calendar
+import base64
+import binascii
+import json
+import logging
+import urllib.parse
 from contextlib import contextmanager
-from argon2 import PasswordHasher, Type
-from argon2.exceptions import VerifyMismatchError
+import passwords
+import db_backends
+from db_backends import IntegrityError, OperationalError, begin_write
+from offload import BoundedPool, PoolBusy
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatroom.db')
+# Cold messages are moved into one compressed SQLite file per month under this dir.
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archives')
+# Split messages/pins/favorites over N shard files by conversation_id (0 = everything in DB_PATH).
+# Fixed once data exists: changing it later is refused at startup.
+MESSAGE_SHARDS = int(os.environ.get('MESSAGE_SHARDS', '0'))
+
+# Native threads running DB calls for the gevent server (see app.py), how many calls
+# may queue before requests are shed, and how long a caller waits for one call.
+DB_WORKERS       = int(os.environ.get('DB_WORKERS', '8'))
+DB_MAX_PENDING   = int(os.environ.get('DB_MAX_PENDING', '256'))
+DB_CALL_DEADLINE = float(os.environ.get('DB_CALL_DEADLINE', '15'))   # > the 10s sqlite busy timeout
+pool = BoundedPool('db', DB_WORKERS, DB_MAX_PENDING, deadline=DB_CALL_DEADLINE)
+
+# Functions that already hand their blocking parts to `pool` / passwords.pool themselves,
+# so callers must not offload them as a whole (argon2 would then occupy a DB worker).
+SELF_OFFLOADING = ('init_db', 'create_user', 'verify_user', 'change_password')
+
+logger = logging.getLogger('chat.db')
+
+
+_backend = None
+
+
+def get_backend():
+    """SQLite at DB_PATH, or PostgreSQL when DATABASE_URL is set (see db_backends)."""
+    global _backend
+    if _backend is None:
+        _backend = db_backends.from_url(db_backends.DATABASE_URL, lambda: DB_PATH)
+    return _backend
 
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=10)
+    return get_backend().connect()
+
+
+@contextmanager
+def db_conn():
+    """Context manager: ensures the connection is always closed, even on exceptions."""
+    conn = get_db()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# ===== Message shards =====
+# With MESSAGE_SHARDS = N, messages of conversation c live in shard c % N.  A shard
+# connection opens the shard file as `main` and attaches the core DB as `core`, so
+# unqualified users/conversations/conversation_members resolve to the core tables and
+# queries written against the single-file layout run unchanged.
+# New message ids are allocated so that id % N == shard; ids <= _legacy_max_id predate
+# sharding and are located by probing the shards.
+
+_legacy_max_id = 0
+
+
+def _shard_path(shard):
+    base, ext = os.path.splitext(DB_PATH)
+    return f'{base}_msgs_{shard}{ext}'
+
+
+def _open_shard(shard):
+    conn = sqlite3.connect(_shard_path(shard), timeout=10, factory=db_backends.TimedConnection)
     conn.row_factory = sqlite3.Row
     conn.execute('PRAGMA journal_mode=WAL')
     conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('ATTACH DATABASE ? AS core', (DB_PATH,))
     return conn
 
 
 @contextmanager
-def db_conn():
-    """Context manager: ensures the connection is always closed, even on exceptions."""
-    conn = get_db()
+def _shard_conn(shard, core=None):
+    """Connection holding shard `shard`; None means the core DB (reusing `core` if given)."""
+    if shard is None:
+        if core is not None:
+            yield core
+        else:
+            with db_conn() as conn:
+                yield conn
+        return
+    conn = _open_shard(shard)
     try:
         yield conn
     finally:
         conn.close()
 
 
+def _conv_shard(conversation_id):
+    return conversation_id % MESSAGE_SHARDS if MESSAGE_SHARDS else None
+
+
+def _message_shard(message_id):
+    if not MESSAGE_SHARDS:
+        return None
+    if message_id > _legacy_max_id:
+        return message_id % MESSAGE_SHARDS
+    for shard in range(MESSAGE_SHARDS):
+        with _shard_conn(shard) as conn:
+            if conn.execute('SELECT 1 FROM messages WHERE id = ?', (message_id,)).fetchone():
+                return shard
+    return 0
+
+
+def msg_conn(conversation_id):
+    """Connection for a conversation's messages, pins and favorites (core tables reachable too)."""
+    return _shard_conn(_conv_shard(conversation_id))
+
+
+def _message_conn(message_id):
+    return _shard_conn(_message_shard(message_id))
+
+
+def _each_message_db(core=None):
+    """Yield a connection to every database holding messages."""
+    for shard in (range(MESSAGE_SHARDS) if MESSAGE_SHARDS else [None]):
+        with _shard_conn(shard, core) as conn:
+            yield conn
+
+
+def _create_shard_schema(c):
+    # Same tables as the core schema, minus foreign keys into the core DB.
+    c.execute('''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        msg_type TEXT NOT NULL DEFAULT 'text',
+        media_url TEXT,
+        is_revoked INTEGER NOT NULL DEFAULT 0,
+        edited_at REAL,
+        original_message_id INTEGER,
+        timestamp REAL NOT NULL,
+        updated_at REAL,
+        client_msg_id TEXT
+    )''')
+    if _safe_add_column(c, 'main.messages', 'updated_at REAL'):
+        c.execute('UPDATE main.messages SET updated_at = COALESCE(edited_at, timestamp)')
+    _safe_add_column(c, 'main.messages', 'client_msg_id TEXT')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS main.idx_messages_client_id
+                 ON messages(conversation_id, sender_id, client_msg_id)''')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_messages_conv_ts ON messages(conversation_id, timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_messages_ts ON messages(timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_messages_sender ON messages(sender_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_messages_conv_updated ON messages(conversation_id, updated_at, id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS favorite_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        UNIQUE(user_id, message_id),
+        FOREIGN KEY (message_id) REFERENCES messages(id)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_favorites_user_created ON favorite_messages(user_id, created_at DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_favorites_msg ON favorite_messages(message_id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS pinned_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        pinned_by INTEGER NOT NULL,
+        pinned_at REAL NOT NULL,
+        UNIQUE(conversation_id, message_id),
+        FOREIGN KEY (message_id) REFERENCES messages(id)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS main.idx_pinned_conv ON pinned_messages(conversation_id, pinned_at DESC)')
+    _create_stat_counters(c, ('messages',))
+
+
+_MESSAGE_COLUMNS = ('id', 'conversation_id', 'sender_id', 'content', 'msg_type', 'media_url',
+                    'is_revoked', 'edited_at', 'original_message_id', 'timestamp')
+
+
+def _init_shards(conn):
+    """Create shard schemas and, on first sharded start, move existing messages out of the core DB."""
+    global _legacy_max_id
+    row = conn.execute("SELECT value FROM system_settings WHERE key = 'message_shards'").fetchone()
+    configured = int(row['value']) if row else 0
+    if configured and configured != MESSAGE_SHARDS:
+        raise RuntimeError(
+            f'MESSAGE_SHARDS={MESSAGE_SHARDS} but the database was sharded with {configured}; '
+            'resharding is not supported'
+        )
+    if not MESSAGE_SHARDS:
+        return
+    if get_backend().name != 'sqlite':
+        raise RuntimeError('MESSAGE_SHARDS is only supported with the SQLite backend')
+    for shard in range(MESSAGE_SHARDS):
+        with _shard_conn(shard) as sc:
+            _create_shard_schema(sc)
+            sc.commit()
+
+    if not configured:
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        cols = ', '.join(_MESSAGE_COLUMNS + ('updated_at', 'client_msg_id'))
+        for shard in range(MESSAGE_SHARDS):
+            # OR IGNORE: a migration interrupted half-way can simply be re-run.
+            conn.execute('ATTACH DATABASE ? AS shard', (_shard_path(shard),))
+            try:
+                conn.execute(
+                    f'''INSERT OR IGNORE INTO shard.messages ({cols})
+                        SELECT {cols} FROM main.messages WHERE conversation_id % ? = ?''',
+                    (MESSAGE_SHARDS, shard)
+                )
+                conn.execute(
+                    '''INSERT OR IGNORE INTO shard.pinned_messages (conversation_id, message_id, pinned_by, pinned_at)
+                       SELECT conversation_id, message_id, pinned_by, pinned_at FROM main.pinned_messages
+                       WHERE conversation_id % ? = ?''',
+                    (MESSAGE_SHARDS, shard)
+                )
+                conn.execute(
+                    '''INSERT OR IGNORE INTO shard.favorite_messages (user_id, message_id, created_at)
+                       SELECT f.user_id, f.message_id, f.created_at FROM main.favorite_messages f
+                       JOIN main.messages m ON m.id = f.message_id
+                       WHERE m.conversation_id % ? = ?''',
+                    (MESSAGE_SHARDS, shard)
+                )
+                conn.commit()
+            finally:
+                conn.execute('DETACH DATABASE shard')
+        conn.execute('DELETE FROM favorite_messages')
+        conn.execute('DELETE FROM pinned_messages')
+        conn.execute('DELETE FROM messages')
+        conn.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('shard_legacy_max_id', ?)",
+                     (str(seq['seq'] if seq else 0),))
+        conn.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES ('message_shards', ?)",
+                     (str(MESSAGE_SHARDS),))
+        conn.commit()
+
+    row = conn.execute("SELECT value FROM system_settings WHERE key = 'shard_legacy_max_id'").fetchone()
+    _legacy_max_id = int(row['value']) if row else 0
+
+
 _db_initialized = False
 _db_init_lock = threading.Lock()  # prevents concurrent init_db execution
 
 
 def _safe_add_column(cursor, table, col_def):
-    """Add a column only if it does not already exist (idempotent)."""
+    """Add a column only if it does not already exist (idempotent). Returns True if it was added."""
     try:
         cursor.execute(f'ALTER TABLE {table} ADD COLUMN {col_def}')
-    except sqlite3.OperationalError:
-        pass
+    except OperationalError:
+        return False
+    return True
 
 
 def init_db():
@@ -100,6 +321,9 @@ def _init_db_locked():
             FOREIGN KEY (conversation_id) REFERENCES conversations(id),
             FOREIGN KEY (sender_id) REFERENCES users(id)
         )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_conv_ts ON messages(conversation_id, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id)')
 
         c.execute('''CREATE TABLE IF NOT EXISTS favorite_messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -167,6 +391,20 @@ def _init_db_locked():
             FOREIGN KEY (user_id) REFERENCES users(id)
         )''')
         c.execute('CREATE INDEX IF NOT EXISTS idx_user_files_uid ON user_files(user_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_user_files_uploaded ON user_files(uploaded_at)')
+
+        # Admin statistics: running totals (stats_counters, kept by triggers) and
+        # per-minute / per-hour history written by rollup_stats().
+        _create_stat_counters(c, ('users', 'conversations', 'messages', 'user_files'))
+        c.execute('''CREATE TABLE IF NOT EXISTS stats_rollup (
+            granularity TEXT NOT NULL,
+            bucket_start REAL NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            uploads INTEGER NOT NULL DEFAULT 0,
+            upload_bytes BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket_start)
+        )''')
 
         # ── Default settings ────────────────────────────────────────────────
         for key, value in [
@@ -175,6 +413,8 @@ def _init_db_locked():
             ('system_name', '聊天室'),
             ('allow_friend_requests', '1'),
             ('default_storage_quota_mb', '10240'),   # 10 GB
+            ('message_retention_days', '0'),         # 0 = keep forever
+            ('archive_after_days', '0'),             # 0 = never archive
             ('db_version', '0'),
         ]:
             c.execute('INSERT OR IGNORE INTO system_settings (key, value) VALUES (?, ?)', (key, value))
@@ -193,6 +433,61 @@ def _init_db_locked():
         _safe_add_column(c, 'friends',              'initiated_by INTEGER')
         _safe_add_column(c, 'conversations',        'avatar_url TEXT')
         _safe_add_column(c, 'conversations',        "announcement TEXT NOT NULL DEFAULT ''")
+        _safe_add_column(c, 'conversations',        'retention_days INTEGER')  # NULL = use global policy
+        _safe_add_column(c, 'users',                'storage_used_bytes BIGINT NOT NULL DEFAULT 0')
+        _safe_add_column(c, 'conversations',        'member_count INTEGER NOT NULL DEFAULT 0')
+
+        # Aggregate columns kept by triggers, and the indexes the admin listings page through.
+        _create_aggregate_triggers(c)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_storage ON users(storage_used_bytes, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_groups_members ON conversations(is_group, member_count, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_groups_name ON conversations(is_group, name, id)')
+
+        # Users and groups are deleted in the background: tombstoned (deleted_at) at
+        # once, then emptied in bounded chunks by run_deletion_step().
+        _safe_add_column(c, 'users',                'deleted_at REAL')
+        _safe_add_column(c, 'conversations',        'deleted_at REAL')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_conversations_creator ON conversations(created_by)')
+        c.execute('''CREATE TABLE IF NOT EXISTS deletion_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            label TEXT NOT NULL DEFAULT '',
+            phase TEXT NOT NULL DEFAULT 'messages',
+            status TEXT NOT NULL DEFAULT 'pending',
+            deleted_rows INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_deletion_jobs_status ON deletion_jobs(status, id)')
+
+        # Last insert/edit/revoke of a message: clients fetch changes since a cursor
+        # over (updated_at, id) instead of reloading whole pages (see get_message_changes).
+        _safe_add_column(c, 'messages',             'updated_at REAL')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_conv_updated ON messages(conversation_id, updated_at, id)')
+
+        # Idempotency key chosen by the sending client: a resent message is matched
+        # to the stored one instead of being saved twice (see save_message).
+        _safe_add_column(c, 'messages',             'client_msg_id TEXT')
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id
+                     ON messages(conversation_id, sender_id, client_msg_id)''')
+
+        # When the user's last socket went away (written by the presence tracker).  The
+        # presence visibility check looks friends and co-members up from the user's side.
+        _safe_add_column(c, 'users',                'last_seen REAL')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_members_user ON conversation_members(user_id, conversation_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_friends_addressee ON friends(addressee_id, requester_id)')
+
+        # Announcement-style groups where only admins may post.
+        _safe_add_column(c, 'conversations',        'admins_only INTEGER NOT NULL DEFAULT 0')
+
+        # Pre-rendered group avatars; triggers bump avatar_dirty when the shown members change.
+        _safe_add_column(c, 'conversations',        'avatar_composite TEXT')
+        _safe_add_column(c, 'conversations',        'avatar_dirty INTEGER NOT NULL DEFAULT 0')
+        _create_group_avatar_triggers(c)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_conversations_avatar_dirty ON conversations(id) WHERE avatar_dirty > 0')
 
         # ── Data migrations (run once per version) ──────────────────────────
         db_version = c.execute(
@@ -233,38 +528,92 @@ def _init_db_locked():
             c.execute("UPDATE conversations SET announcement = '' WHERE announcement IS NULL")
             c.execute("UPDATE system_settings SET value = '5' WHERE key = 'db_version'")
 
+        if ver < 6:
+            # Back-fill the trigger-maintained aggregate columns
+            for table, column, source, key, amount in _AGGREGATE_COLUMNS:
+                total = f'COALESCE(SUM({amount}), 0)' if amount else 'COUNT(*)'
+                c.execute(f'UPDATE {table} SET {column} = (SELECT {total} FROM {source} WHERE {key} = {table}.id)')
+            c.execute("UPDATE system_settings SET value = '6' WHERE key = 'db_version'")
+
+        if ver < 7:
+            c.execute('UPDATE messages SET updated_at = COALESCE(edited_at, timestamp) WHERE updated_at IS NULL')
+            c.execute("UPDATE system_settings SET value = '7' WHERE key = 'db_version'")
+
+        if ver < 8:
+            c.execute('UPDATE conversations SET avatar_dirty = 1 WHERE is_group = 1 AND deleted_at IS NULL')
+            c.execute("UPDATE system_settings SET value = '8' WHERE key = 'db_version'")
+
         conn.commit()
+        _init_shards(conn)
+    _upgrade_archives()
     _db_initialized = True
 
 
-_ph = PasswordHasher(type=Type.ID)  # argon2id
+def create_user(username, password):
+    # Hash before touching the DB so no connection is held while argon2 runs.
+    password_hash = passwords.hash_password(password)
+    return pool.run(_insert_user, username, password_hash)
 
 
-def create_user(username, password):
+def _insert_user(username, password_hash):
     with db_conn() as conn:
         try:
-            password_hash = _ph.hash(password)
             conn.execute(
                 'INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)',
                 (username, password_hash, time.time())
             )
             conn.commit()
             return True, '注册成功'
-        except sqlite3.IntegrityError:
+        except IntegrityError:
             return False, '用户名已存在'
 
 
-def verify_user(username, password):
+def _set_password_hash(user_id, new_hash, old_hash=None):
+    """Store a new hash; with old_hash, only if it is still the current one (compare-and-swap)."""
+    with db_conn() as conn:
+        if old_hash is None:
+            conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user_id))
+        else:
+            conn.execute(
+                'UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                (new_hash, user_id, old_hash)
+            )
+        conn.commit()
+
+
+def _rehash_password(user_id, old_hash, password):
+    """Upgrade a hash made with outdated argon2 parameters."""
+    pool.run(_set_password_hash, user_id, passwords.hash_password(password), old_hash)
+
+
+def _get_user_row(username):
     with db_conn() as conn:
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        user = dict(user) if user else None
+    return dict(user) if user else None
+
+
+def verify_user(username, password):
+    user = pool.run(_get_user_row, username)
     if not user:
         return None
-    try:
-        _ph.verify(user['password_hash'], password)
-        return user
-    except VerifyMismatchError:
+    ok, needs_rehash = passwords.verify_password(user['password_hash'], password)
+    if not ok:
         return None
+    if needs_rehash:
+        # Opportunistic: a saturated pool must not fail a login whose password checked out,
+        # the next login tries again.
+        try:
+            _rehash_password(user['id'], user['password_hash'], password)
+        except PoolBusy as e:
+            logger.warning('Password rehash for user %s skipped: %s', user['id'], e)
+    return user
+
+
+def _is_live_user(conn, user_id):
+    """Whether user_id exists and is not deleted or being deleted."""
+    return conn.execute(
+        'SELECT 1 FROM users WHERE id = ? AND deleted_at IS NULL', (user_id,)
+    ).fetchone() is not None
 
 
 def get_user_by_id(user_id):
@@ -285,12 +634,12 @@ def search_users(query, exclude_id=None):
     with db_conn() as conn:
         if exclude_id:
             users = conn.execute(
-                'SELECT id, username FROM users WHERE username LIKE ? ESCAPE "\\" AND id != ? LIMIT 20',
+                'SELECT id, username FROM users WHERE username LIKE ? ESCAPE "\\" AND id != ? AND deleted_at IS NULL LIMIT 20',
                 (like_query, exclude_id)
             ).fetchall()
         else:
             users = conn.execute(
-                'SELECT id, username FROM users WHERE username LIKE ? ESCAPE "\\" LIMIT 20',
+                'SELECT id, username FROM users WHERE username LIKE ? ESCAPE "\\" AND deleted_at IS NULL LIMIT 20',
                 (like_query,)
             ).fetchall()
     return [dict(u) for u in users]
@@ -304,7 +653,7 @@ def search_users_for_viewer(viewer_id, query):
             '''SELECT u.id, u.username, p.avatar_url, p.avatar_emoji
                FROM users u
                LEFT JOIN user_profiles p ON p.user_id = u.id
-               WHERE u.username LIKE ? ESCAPE "\\"
+               WHERE u.username LIKE ? ESCAPE "\\" AND u.deleted_at IS NULL
                ORDER BY CASE WHEN u.id = ? THEN 0 ELSE 1 END, u.username
                LIMIT 20''',
             (like_query, viewer_id)
@@ -356,7 +705,7 @@ def can_start_private_chat(user1_id, user2_id):
 def create_self_conversation(user_id):
     """Return (or create) the user's private self-chat / notes conversation."""
     with db_conn() as conn:
-        conn.execute('BEGIN IMMEDIATE')
+        begin_write(conn, 'self_chat', user_id)
         existing = conn.execute(
             '''SELECT c.id FROM conversations c
                JOIN conversation_members cm ON c.id = cm.conversation_id
@@ -386,9 +735,10 @@ def create_private_conversation(user1_id, user2_id):
     if user1_id == user2_id:
         return create_self_conversation(user1_id)
     with db_conn() as conn:
-        # BEGIN IMMEDIATE acquires a write lock before the SELECT so no other writer can
-        # slip a concurrent INSERT in between the check and the insert (TOCTOU fix).
-        conn.execute('BEGIN IMMEDIATE')
+        # begin_write takes the write lock (SQLite) or this pair's lock (PostgreSQL) before the
+        # SELECT so no other writer can slip a concurrent INSERT in between the check and the
+        # insert (TOCTOU fix).
+        begin_write(conn, 'private_chat', *_norm_pair(user1_id, user2_id))
         existing = conn.execute(
             '''SELECT c.id FROM conversations c
                JOIN conversation_members cm1 ON c.id = cm1.conversation_id AND cm1.user_id = ?
@@ -427,7 +777,12 @@ def create_group_conversation(name, creator_id, member_ids):
             (name, creator_id, now)
         )
         conv_id = c.lastrowid
-        all_members = set(member_ids) | {creator_id}
+        # Deleted users, including ones whose data is still being cleaned up, are left out.
+        all_members = {creator_id}
+        for batch, marks in _id_chunks(set(member_ids) - {creator_id}):
+            all_members.update(r['id'] for r in c.execute(
+                f'SELECT id FROM users WHERE id IN ({marks}) AND deleted_at IS NULL', batch
+            ).fetchall())
         for uid in all_members:
             role = 'admin' if uid == creator_id else 'member'
             c.execute(
@@ -438,27 +793,52 @@ def create_group_conversation(name, creator_id, member_ids):
     return conv_id
 
 
+# Group member lists are paged; conversation lists carry members for private chats only.
+GROUP_MEMBER_PAGE = 50
+
+
+def get_user_conversation_ids(user_id):
+    """Ids of the live conversations user_id belongs to (socket room joins)."""
+    with db_conn() as conn:
+        rows = conn.execute(
+            '''SELECT cm.conversation_id FROM conversation_members cm
+               JOIN conversations c ON c.id = cm.conversation_id
+               WHERE cm.user_id = ? AND c.deleted_at IS NULL''',
+            (user_id,)
+        ).fetchall()
+    return [r['conversation_id'] for r in rows]
+
+
 def get_user_conversations(user_id):
     with db_conn() as conn:
         convs = conn.execute(
-            '''SELECT c.id, c.name, c.is_group, c.is_self_chat, c.avatar_url, c.announcement, c.created_at
+            '''SELECT c.id, c.name, c.is_group, c.is_self_chat, c.avatar_url, c.avatar_composite,
+                      c.announcement, c.created_at, c.created_by, c.member_count, c.admins_only,
+                      cm.role AS my_role
                FROM conversations c
                JOIN conversation_members cm ON c.id = cm.conversation_id
-               WHERE cm.user_id = ?
+               WHERE cm.user_id = ? AND c.deleted_at IS NULL
                ORDER BY c.created_at DESC''',
             (user_id,)
         ).fetchall()
-        result = []
-        for conv in convs:
-            conv_dict = dict(conv)
+        result = [dict(conv) for conv in convs]
+        # Groups are drawn from avatar_composite; only private chats need their members.
+        private = {c['id']: c for c in result if not c['is_group']}
+        for conv_dict in private.values():
+            conv_dict['members'] = []
+        for batch, placeholders in _id_chunks(private):
             members = conn.execute(
-                     '''SELECT u.id, u.username, p.avatar_url, p.avatar_emoji FROM users u
-                   JOIN conversation_members cm ON u.id = cm.user_id
-                         LEFT JOIN user_profiles p ON p.user_id = u.id
-                   WHERE cm.conversation_id = ?''',
-                (conv['id'],)
+                f'''SELECT cm.conversation_id, u.id, u.username, p.avatar_url, p.avatar_emoji FROM users u
+                    JOIN conversation_members cm ON u.id = cm.user_id
+                    LEFT JOIN user_profiles p ON p.user_id = u.id
+                    WHERE cm.conversation_id IN ({placeholders})
+                    ORDER BY cm.conversation_id, cm.user_id''',
+                batch
             ).fetchall()
-            conv_dict['members'] = [dict(m) for m in members]
+            for m in members:
+                m = dict(m)
+                private[m.pop('conversation_id')]['members'].append(m)
+        for conv_dict in result:
             if conv_dict.get('is_self_chat'):
                 conv_dict['display_name'] = '我的备忘录'
             elif not conv_dict['is_group']:
@@ -466,15 +846,9 @@ def get_user_conversations(user_id):
                 conv_dict['display_name'] = other[0]['username'] if other else '未知'
             else:
                 conv_dict['display_name'] = conv_dict['name'] or '群聊'
-            last_msg = conn.execute(
-                '''SELECT m.id, m.content, m.msg_type, m.timestamp, m.is_revoked, u.username as sender_name
-                   FROM messages m JOIN users u ON m.sender_id = u.id
-                   WHERE m.conversation_id = ?
-                   ORDER BY m.timestamp DESC LIMIT 1''',
-                (conv['id'],)
-            ).fetchone()
-            conv_dict['last_message'] = dict(last_msg) if last_msg else None
-            result.append(conv_dict)
+        last_msgs = _last_messages([c['id'] for c in result], conn)
+        for conv_dict in result:
+            conv_dict['last_message'] = last_msgs.get(conv_dict['id'])
     result.sort(
         key=lambda x: x['last_message']['timestamp'] if x['last_message'] else x['created_at'],
         reverse=True
@@ -482,40 +856,186 @@ def get_user_conversations(user_id):
     return result
 
 
-def save_message(conversation_id, sender_id, content, msg_type='text', media_url=None, original_message_id=None):
-    with db_conn() as conn:
+def _last_messages(conv_ids, core=None):
+    """{conversation_id: latest message} using one connection per shard."""
+    by_shard = {}
+    for conv_id in conv_ids:
+        by_shard.setdefault(_conv_shard(conv_id), []).append(conv_id)
+    result = {}
+    for shard, ids in by_shard.items():
+        with _shard_conn(shard, core) as conn:
+            for conv_id in ids:
+                row = conn.execute(
+                    '''SELECT m.id, m.content, m.msg_type, m.timestamp, m.is_revoked, u.username as sender_name
+                       FROM messages m JOIN users u ON m.sender_id = u.id
+                       WHERE m.conversation_id = ?
+                       ORDER BY m.timestamp DESC LIMIT 1''',
+                    (conv_id,)
+                ).fetchone()
+                if row:
+                    result[conv_id] = dict(row)
+    return result
+
+
+def _next_message_id(conn, shard):
+    """Smallest unused id above every existing one with id % MESSAGE_SHARDS == shard.
+    Caller must hold the shard's write lock (BEGIN IMMEDIATE)."""
+    row = conn.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'messages'").fetchone()
+    last = max(row['seq'] if row else 0, _legacy_max_id)
+    return last + 1 + (shard - (last + 1)) % MESSAGE_SHARDS
+
+
+def _client_message(conn, conversation_id, sender_id, client_msg_id):
+    row = conn.execute(
+        _MESSAGE_BY + 'WHERE m.conversation_id = ? AND m.sender_id = ? AND m.client_msg_id = ?',
+        (conversation_id, sender_id, client_msg_id)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def get_client_message(conversation_id, sender_id, client_msg_id):
+    """The message sender_id already stored in the conversation under client_msg_id, or None."""
+    with msg_conn(conversation_id) as conn:
+        return _client_message(conn, conversation_id, sender_id, client_msg_id)
+
+
+def save_message(conversation_id, sender_id, content, msg_type='text', media_url=None,
+                 original_message_id=None, client_msg_id=None):
+    """
+    Store a message and return it.  With a client_msg_id the call is idempotent:
+    a retry of a message already stored returns the stored one with
+    duplicate=True instead of inserting it again.
+    """
+    shard = _conv_shard(conversation_id)
+    with _shard_conn(shard) as conn:
         now = time.time()
         c = conn.cursor()
-        c.execute(
-            '''INSERT INTO messages
-               (conversation_id, sender_id, content, msg_type, media_url, original_message_id, timestamp)
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (conversation_id, sender_id, content, msg_type, media_url, original_message_id, now)
-        )
-        msg_id = c.lastrowid
-        conn.commit()
+        if shard is not None:
+            c.execute('BEGIN IMMEDIATE')   # also makes the duplicate check below race-free
+        if client_msg_id:
+            existing = _client_message(conn, conversation_id, sender_id, client_msg_id)
+            if existing:
+                conn.rollback()
+                return dict(existing, duplicate=True)
+        try:
+            if shard is None:
+                c.execute(
+                    '''INSERT INTO messages
+                       (conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                        timestamp, updated_at, client_msg_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    (conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                     now, now, client_msg_id)
+                )
+                msg_id = c.lastrowid
+            else:
+                msg_id = _next_message_id(conn, shard)
+                c.execute(
+                    '''INSERT INTO messages
+                       (id, conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                        timestamp, updated_at, client_msg_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    (msg_id, conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                     now, now, client_msg_id)
+                )
+            conn.commit()
+        except IntegrityError:
+            # A concurrent retry of the same message got in first.
+            conn.rollback()
+            existing = _client_message(conn, conversation_id, sender_id, client_msg_id) if client_msg_id else None
+            if not existing:
+                raise
+            return dict(existing, duplicate=True)
     return {
         'id': msg_id, 'conversation_id': conversation_id, 'sender_id': sender_id,
         'content': content, 'msg_type': msg_type, 'media_url': media_url,
         'is_revoked': 0, 'edited_at': None, 'original_message_id': original_message_id,
-        'timestamp': now
+        'timestamp': now, 'updated_at': now, 'client_msg_id': client_msg_id, 'duplicate': False
     }
 
 
+def forward_messages(sender_id, originals, conversation_ids, batch_key):
+    """
+    Copy `originals` (message dicts) into every conversation of `conversation_ids`
+    as messages of sender_id, one transaction and one executemany per database.
+    Each copy carries client_msg_id 'fwd:<batch_key>:<original id>', so retrying a
+    batch with the same key inserts nothing twice; copies stored by an earlier try
+    come back with duplicate=True.  Returns {conversation_id: [messages]}.
+    """
+    originals = sorted(originals, key=lambda o: (o['timestamp'], o['id']))
+    now = time.time()
+    by_shard = {}
+    for conv_id in dict.fromkeys(conversation_ids):
+        by_shard.setdefault(_conv_shard(conv_id), []).append(conv_id)
+    keys = [f'fwd:{batch_key}:{o["id"]}' for o in originals]
+    result = {}
+    for shard, conv_ids in by_shard.items():
+        rows, stamps = [], {}
+        for conv_id in conv_ids:
+            # Distinct timestamps keep the copies in their original order.
+            for i, (o, key) in enumerate(zip(originals, keys)):
+                stamp = now + i * 1e-6
+                stamps[(conv_id, key)] = stamp
+                rows.append((conv_id, sender_id, o['content'], o['msg_type'], o['media_url'], o['id'],
+                             stamp, stamp, key))
+        with _shard_conn(shard) as conn:
+            c = conn.cursor()
+            if shard is None:
+                c.executemany(
+                    '''INSERT OR IGNORE INTO messages
+                       (conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                        timestamp, updated_at, client_msg_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    rows
+                )
+            else:
+                c.execute('BEGIN IMMEDIATE')
+                first = _next_message_id(conn, shard)
+                c.executemany(
+                    '''INSERT OR IGNORE INTO messages
+                       (id, conversation_id, sender_id, content, msg_type, media_url, original_message_id,
+                        timestamp, updated_at, client_msg_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    [(first + i * MESSAGE_SHARDS,) + row for i, row in enumerate(rows)]
+                )
+            stored = conn.execute(
+                _MESSAGE_BY + f'''WHERE m.conversation_id IN ({", ".join("?" for _ in conv_ids)})
+                                  AND m.sender_id = ? AND m.client_msg_id IN ({", ".join("?" for _ in keys)})
+                                  ORDER BY m.timestamp, m.id''',
+                (*conv_ids, sender_id, *keys)
+            ).fetchall()
+            conn.commit()
+        for row in stored:
+            msg = dict(row)
+            msg['duplicate'] = msg['timestamp'] != stamps[(msg['conversation_id'], msg['client_msg_id'])]
+            result.setdefault(msg['conversation_id'], []).append(msg)
+    by_id = {o['id']: o for o in originals}
+    for msgs in result.values():
+        for msg in msgs:
+            orig = by_id[msg['original_message_id']]
+            msg['original_content'] = orig['content']
+            msg['original_sender_name'] = orig['sender_name']
+            msg['original_msg_type'] = orig['msg_type']
+    return result
+
+
+_MESSAGE_SELECT = '''
+    SELECT m.id, m.conversation_id, m.sender_id, m.content,
+           m.msg_type, m.media_url, m.is_revoked, m.edited_at,
+           m.original_message_id, m.timestamp, m.updated_at, m.client_msg_id, u.username as sender_name,
+           om.content AS original_content, ou.username AS original_sender_name,
+           om.msg_type AS original_msg_type
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN messages om ON m.original_message_id = om.id
+    LEFT JOIN users ou ON om.sender_id = ou.id
+    WHERE m.conversation_id = ?
+'''
+
+
 def get_messages(conversation_id, limit=50, before=None):
-    with db_conn() as conn:
-        base_query = '''
-            SELECT m.id, m.conversation_id, m.sender_id, m.content,
-                   m.msg_type, m.media_url, m.is_revoked, m.edited_at,
-                   m.original_message_id, m.timestamp, u.username as sender_name,
-                   om.content AS original_content, ou.username AS original_sender_name,
-                   om.msg_type AS original_msg_type
-            FROM messages m
-            JOIN users u ON m.sender_id = u.id
-            LEFT JOIN messages om ON m.original_message_id = om.id
-            LEFT JOIN users ou ON om.sender_id = ou.id
-            WHERE m.conversation_id = ?
-        '''
+    with msg_conn(conversation_id) as conn:
+        base_query = _MESSAGE_SELECT
         if before:
             msgs = conn.execute(
                 base_query + ' AND m.timestamp < ? ORDER BY m.timestamp DESC LIMIT ?',
@@ -526,24 +1046,114 @@ def get_messages(conversation_id, limit=50, before=None):
                 base_query + ' ORDER BY m.timestamp DESC LIMIT ?',
                 (conversation_id, limit)
             ).fetchall()
-    return [dict(m) for m in reversed(msgs)]
+        msgs = [dict(m) for m in msgs]
+        # Pinned and favorited messages are never archived, so an old one can sit in the
+        # hot page among (or below) archived messages: unless the page is full and its
+        # oldest row is newer than every archive, merge in the archived rows under the
+        # same `before` and keep the newest `limit`.
+        after = msgs[-1]['timestamp'] if len(msgs) == limit else None
+        if after is None or _archives_reach(after):
+            msgs.extend(_get_archived_messages(conn, conversation_id, limit, before, after))
+            msgs.sort(key=lambda m: (m['timestamp'], m['id']), reverse=True)
+            del msgs[limit:]
+    _fill_forward_originals(msgs)
+    return list(reversed(msgs))
+
+
+# ===== Incremental sync =====
+# Clients cache message pages and ask only for what changed since a cursor over
+# (updated_at, id).  A write stamped just before a concurrent reader's snapshot
+# can commit after it, so the cursor handed back never passes now - SYNC_SETTLE:
+# changes from the last few seconds are sent again on the next sync, and the
+# client overwrites them by id.
+
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '200'))
+SYNC_SETTLE = 2.0   # seconds
+
+
+def current_sync_cursor():
+    """Cursor to hand out together with a freshly loaded page of messages."""
+    return encode_cursor(time.time() - SYNC_SETTLE, 0)
+
+
+def get_message_changes(conversation_id, cursor, limit=SYNC_PAGE_SIZE):
+    """
+    Messages of a conversation inserted, edited or revoked after `cursor`, oldest
+    change first.  Returns (messages, next cursor, has_more); raises ValueError on
+    a malformed cursor.
+    """
+    since = tuple(decode_cursor(cursor))
+    with msg_conn(conversation_id) as conn:
+        rows = conn.execute(
+            _MESSAGE_SELECT + ''' AND (m.updated_at > ? OR (m.updated_at = ? AND m.id > ?))
+                                  ORDER BY m.updated_at, m.id LIMIT ?''',
+            (conversation_id, since[0], since[0], since[1], limit + 1)
+        ).fetchall()
+    msgs = [dict(r) for r in rows]
+    has_more = len(msgs) > limit
+    msgs = msgs[:limit]
+    _fill_forward_originals(msgs)
+    last = (msgs[-1]['updated_at'], msgs[-1]['id']) if msgs else since
+    if not has_more:
+        last = min(last, (time.time() - SYNC_SETTLE, 0))
+    return msgs, encode_cursor(*max(last, since)), has_more
+
+
+def _fill_forward_originals(msgs):
+    """Resolve forwarded originals the in-shard JOIN could not see (other shard or archived)."""
+    missing = [m for m in msgs if m['original_message_id'] and m['original_content'] is None]
+    if not missing:
+        return
+    wanted = {m['original_message_id'] for m in missing}
+    originals = get_messages_by_ids(wanted)
+    originals.update(_get_archived_messages_by_ids(wanted - originals.keys()))
+    for m in missing:
+        orig = originals.get(m['original_message_id'])
+        if orig:
+            m['original_content'] = orig['content']
+            m['original_sender_name'] = orig['sender_name']
+            m['original_msg_type'] = orig['msg_type']
+
+
+_MESSAGE_BY = '''
+    SELECT m.id, m.conversation_id, m.sender_id, m.content, m.msg_type,
+           m.media_url, m.is_revoked, m.edited_at, m.original_message_id, m.timestamp,
+           m.updated_at, m.client_msg_id, u.username as sender_name
+    FROM messages m JOIN users u ON m.sender_id = u.id
+'''
 
 
 def get_message_by_id(message_id):
-    with db_conn() as conn:
-        msg = conn.execute(
-            '''SELECT m.id, m.conversation_id, m.sender_id, m.content, m.msg_type,
-                      m.media_url, m.is_revoked, m.edited_at, m.original_message_id, m.timestamp,
-                      u.username as sender_name
-               FROM messages m JOIN users u ON m.sender_id = u.id
-               WHERE m.id = ?''',
-            (message_id,)
-        ).fetchone()
+    with _message_conn(message_id) as conn:
+        msg = conn.execute(_MESSAGE_BY + 'WHERE m.id = ?', (message_id,)).fetchone()
     return dict(msg) if msg else None
 
 
+def get_messages_by_ids(message_ids):
+    """get_message_by_id() for many ids at once, keyed by id; missing ids are left out."""
+    wanted = list(dict.fromkeys(message_ids))
+    if MESSAGE_SHARDS:
+        by_shard = {}
+        legacy = [i for i in wanted if i <= _legacy_max_id]
+        for i in wanted:
+            if i > _legacy_max_id:
+                by_shard.setdefault(i % MESSAGE_SHARDS, []).append(i)
+        if legacy:
+            for shard in range(MESSAGE_SHARDS):
+                by_shard.setdefault(shard, []).extend(legacy)
+    else:
+        by_shard = {None: wanted}
+    found = {}
+    for shard, ids in by_shard.items():
+        with _shard_conn(shard) as conn:
+            for batch, placeholders in _id_chunks(ids):
+                for row in conn.execute(_MESSAGE_BY + f'WHERE m.id IN ({placeholders})', batch).fetchall():
+                    found[row['id']] = dict(row)
+    return found
+
+
 def revoke_message(message_id, user_id):
-    with db_conn() as conn:
+    with _message_conn(message_id) as conn:
         msg = conn.execute(
             'SELECT id, sender_id, is_revoked FROM messages WHERE id = ?',
             (message_id,)
@@ -555,8 +1165,8 @@ def revoke_message(message_id, user_id):
         if msg['is_revoked']:
             return False, '消息已撤回'
         conn.execute(
-            "UPDATE messages SET is_revoked = 1, content = '消息已撤回', media_url = NULL WHERE id = ?",
-            (message_id,)
+            "UPDATE messages SET is_revoked = 1, content = '消息已撤回', media_url = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), message_id)
         )
         conn.execute('DELETE FROM favorite_messages WHERE message_id = ?', (message_id,))
         conn.commit()
@@ -564,7 +1174,7 @@ def revoke_message(message_id, user_id):
 
 
 def edit_message(message_id, user_id, content):
-    with db_conn() as conn:
+    with _message_conn(message_id) as conn:
         msg = conn.execute(
             'SELECT id, sender_id, is_revoked, msg_type FROM messages WHERE id = ?',
             (message_id,)
@@ -577,23 +1187,24 @@ def edit_message(message_id, user_id, content):
             return False, '消息已撤回'
         if msg['msg_type'] != 'text':
             return False, '仅文本消息可编辑'
+        now = time.time()
         conn.execute(
-            'UPDATE messages SET content = ?, edited_at = ? WHERE id = ?',
-            (content, time.time(), message_id)
+            'UPDATE messages SET content = ?, edited_at = ?, updated_at = ? WHERE id = ?',
+            (content, now, now, message_id)
         )
         conn.commit()
     return True, '已编辑'
 
 
 def toggle_favorite_message(user_id, message_id):
-    with db_conn() as conn:
+    with _message_conn(message_id) as conn:
         msg = conn.execute(
             'SELECT is_revoked FROM messages WHERE id = ?',
             (message_id,)
         ).fetchone()
         if not msg or msg['is_revoked']:
             return False, False
-        conn.execute('BEGIN IMMEDIATE')
+        begin_write(conn, 'favorite', user_id, message_id)
         deleted = conn.execute(
             'DELETE FROM favorite_messages WHERE user_id = ? AND message_id = ?',
             (user_id, message_id)
@@ -611,14 +1222,16 @@ def toggle_favorite_message(user_id, message_id):
 
 def get_favorite_messages(user_id, limit=30, before=None):
     safe_limit = max(1, min(int(limit), 100))
-    with db_conn() as conn:
-        params = [user_id]
-        where_clause = 'WHERE fm.user_id = ?'
-        if before is not None:
-            where_clause += ' AND fm.created_at < ?'
-            params.append(float(before))
-        params.append(safe_limit + 1)
-        rows = conn.execute(
+    params = [user_id]
+    where_clause = 'WHERE fm.user_id = ?'
+    if before is not None:
+        where_clause += ' AND fm.created_at < ?'
+        params.append(float(before))
+    params.append(safe_limit + 1)
+    rows = []
+    # A user's favorites are spread over the shards of the favorited messages.
+    for conn in _each_message_db():
+        rows += conn.execute(
             f'''SELECT m.id, m.conversation_id, m.sender_id, m.content, m.msg_type,
                       m.media_url, m.is_revoked, m.edited_at, m.original_message_id, m.timestamp,
                       u.username as sender_name, fm.created_at as favorited_at,
@@ -632,6 +1245,7 @@ def get_favorite_messages(user_id, limit=30, before=None):
                LIMIT ?''',
             tuple(params)
         ).fetchall()
+    rows.sort(key=lambda r: r['favorited_at'], reverse=True)
     items = [dict(r) for r in rows[:safe_limit]]
     has_more = len(rows) > safe_limit
     next_before = items[-1]['favorited_at'] if has_more and items else None
@@ -653,15 +1267,221 @@ def get_conversation_members(conversation_id):
     return [dict(m) for m in members]
 
 
+_CAN_POST = "(c.admins_only = 0 OR cm.role = 'admin' OR c.created_by = cm.user_id)"
+
+
+def can_post(conversation_id, user_id):
+    """(ok, msg): whether user_id may send messages to the conversation."""
+    with db_conn() as conn:
+        row = conn.execute(
+            f'''SELECT {_CAN_POST} AS allowed FROM conversation_members cm
+                JOIN conversations c ON c.id = cm.conversation_id
+                WHERE cm.conversation_id = ? AND cm.user_id = ? AND c.deleted_at IS NULL''',
+            (conversation_id, user_id)
+        ).fetchone()
+    if not row:
+        return False, '你不在该会话中'
+    if not row['allowed']:
+        return False, '仅管理员可发言'
+    return True, ''
+
+
 def is_member(conversation_id, user_id):
     with db_conn() as conn:
         row = conn.execute(
-            'SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
+            '''SELECT 1 FROM conversation_members cm JOIN conversations c ON c.id = cm.conversation_id
+               WHERE cm.conversation_id = ? AND cm.user_id = ? AND c.deleted_at IS NULL''',
             (conversation_id, user_id)
         ).fetchone()
     return row is not None
 
 
+def member_conversations(user_id, conversation_ids, posting=False):
+    """
+    The subset of conversation_ids user_id is a member of (deleted conversations
+    excluded); with posting=True only those it may also post in.
+    """
+    found = set()
+    can_post = f' AND {_CAN_POST}' if posting else ''
+    with db_conn() as conn:
+        for batch, placeholders in _id_chunks(dict.fromkeys(conversation_ids)):
+            rows = conn.execute(
+                f'''SELECT cm.conversation_id FROM conversation_members cm
+                    JOIN conversations c ON c.id = cm.conversation_id
+                    WHERE cm.user_id = ? AND cm.conversation_id IN ({placeholders}) AND c.deleted_at IS NULL'''
+                + can_post,
+                (user_id, *batch)
+            ).fetchall()
+            found.update(r['conversation_id'] for r in rows)
+    return found
+
+
+# ===== Presence =====
+
+def presence_visible(viewer_id, user_ids):
+    """The subset of user_ids whose presence viewer_id may see: itself, friends and members of a shared conversation."""
+    visible = {viewer_id} if viewer_id in user_ids else set()
+    with db_conn() as conn:
+        for batch, placeholders in _id_chunks(dict.fromkeys(user_ids)):
+            rows = conn.execute(
+                f'''SELECT addressee_id AS uid FROM friends
+                    WHERE requester_id = ? AND status = 'accepted' AND addressee_id IN ({placeholders})
+                    UNION
+                    SELECT requester_id FROM friends
+                    WHERE addressee_id = ? AND status = 'accepted' AND requester_id IN ({placeholders})
+                    UNION
+                    SELECT other.user_id FROM conversation_members mine
+                    JOIN conversation_members other ON other.conversation_id = mine.conversation_id
+                    JOIN conversations c ON c.id = mine.conversation_id
+                    WHERE mine.user_id = ? AND c.deleted_at IS NULL AND other.user_id IN ({placeholders})''',
+                (viewer_id, *batch, viewer_id, *batch, viewer_id, *batch)
+            ).fetchall()
+            visible.update(r['uid'] for r in rows)
+    return visible
+
+
+def get_last_seen(user_ids):
+    """{user_id: last_seen} for the given users; users never seen offline are left out."""
+    found = {}
+    with db_conn() as conn:
+        for batch, placeholders in _id_chunks(dict.fromkeys(user_ids)):
+            rows = conn.execute(
+                f'SELECT id, last_seen FROM users WHERE id IN ({placeholders}) AND last_seen IS NOT NULL', batch
+            ).fetchall()
+            found.update((r['id'], r['last_seen']) for r in rows)
+    return found
+
+
+def set_last_seen(entries):
+    """Record when users went offline; entries are (user_id, timestamp) pairs."""
+    with db_conn() as conn:
+        conn.executemany('UPDATE users SET last_seen = ? WHERE id = ?', [(ts, uid) for uid, ts in entries])
+        conn.commit()
+
+
+# ===== Group avatars =====
+
+_PG_GROUP_AVATAR_FUNCTION = '''CREATE OR REPLACE FUNCTION group_avatar_touch() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    IF TG_TABLE_NAME = 'user_profiles' THEN
+        IF NEW.avatar_url IS NOT DISTINCT FROM OLD.avatar_url
+           AND NEW.avatar_emoji IS NOT DISTINCT FROM OLD.avatar_emoji THEN
+            RETURN NULL;
+        END IF;
+        UPDATE conversations SET avatar_dirty = avatar_dirty + 1
+        WHERE is_group = 1 AND id IN (
+            SELECT cm.conversation_id FROM conversation_members cm
+            WHERE cm.user_id = NEW.user_id AND (SELECT COUNT(*) FROM (
+                SELECT 1 FROM conversation_members o
+                WHERE o.conversation_id = cm.conversation_id AND o.user_id < NEW.user_id LIMIT 4) f) < 4);
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN r := NEW; ELSE r := OLD; END IF;
+    UPDATE conversations SET avatar_dirty = avatar_dirty + 1
+    WHERE id = r.conversation_id AND is_group = 1 AND (SELECT COUNT(*) FROM (
+        SELECT 1 FROM conversation_members o
+        WHERE o.conversation_id = r.conversation_id AND o.user_id < r.user_id LIMIT 4) f) < 4;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+# A member is shown in the composite when fewer than four members have a lower id.
+_SHOWN_MEMBER = '''(SELECT COUNT(*) FROM (
+    SELECT 1 FROM conversation_members o
+    WHERE o.conversation_id = {conv} AND o.user_id < {user} LIMIT 4) f) < 4'''
+
+
+def _create_group_avatar_triggers(c):
+    """Bump conversations.avatar_dirty when a member shown in the group composite joins, leaves or changes avatar."""
+    if get_backend().name == 'postgres':
+        c.execute(_PG_GROUP_AVATAR_FUNCTION)
+        for trigger, event, table in (('trg_group_avatar_insert', 'INSERT', 'conversation_members'),
+                                      ('trg_group_avatar_delete', 'DELETE', 'conversation_members'),
+                                      ('trg_group_avatar_profile', 'UPDATE', 'user_profiles')):
+            c.execute(f'DROP TRIGGER IF EXISTS {trigger} ON {table}')
+            c.execute(f'''CREATE TRIGGER {trigger} AFTER {event} ON {table} FOR EACH ROW
+                EXECUTE FUNCTION group_avatar_touch()''')
+        return
+    for op, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        shown = _SHOWN_MEMBER.format(conv=f'{row}.conversation_id', user=f'{row}.user_id')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS main.trg_group_avatar_{op.lower()}
+            AFTER {op} ON conversation_members WHEN {shown}
+            BEGIN
+                UPDATE conversations SET avatar_dirty = avatar_dirty + 1
+                WHERE id = {row}.conversation_id AND is_group = 1;
+            END''')
+    shown = _SHOWN_MEMBER.format(conv='cm.conversation_id', user='NEW.user_id')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS main.trg_group_avatar_profile
+        AFTER UPDATE OF avatar_url, avatar_emoji ON user_profiles
+        WHEN NEW.avatar_url IS NOT OLD.avatar_url OR NEW.avatar_emoji IS NOT OLD.avatar_emoji
+        BEGIN
+            UPDATE conversations SET avatar_dirty = avatar_dirty + 1
+            WHERE is_group = 1 AND id IN (
+                SELECT cm.conversation_id FROM conversation_members cm
+                WHERE cm.user_id = NEW.user_id AND {shown});
+        END''')
+
+
+def dirty_group_avatars(limit, cells=4):
+    """
+    Groups whose composite avatar may be stale, lowest id first:
+    [{'id', 'dirty', 'avatar_composite', 'members'}] with the first `cells` members in user id order.
+    """
+    # Only groups are ever marked, so the partial index alone answers this.
+    with db_conn() as conn:
+        groups = [dict(r) for r in conn.execute(
+            '''SELECT id, avatar_dirty AS dirty, avatar_composite FROM conversations
+               WHERE avatar_dirty > 0 AND deleted_at IS NULL
+               ORDER BY id LIMIT ?''',
+            (limit,)
+        ).fetchall()]
+        by_id = {g['id']: g for g in groups}
+        for g in groups:
+            g['members'] = []
+        for batch, placeholders in _id_chunks(by_id):
+            rows = conn.execute(
+                f'''SELECT m.conversation_id, u.id, u.username, p.avatar_url, p.avatar_emoji
+                    FROM (SELECT conversation_id, user_id,
+                                 ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY user_id) AS n
+                          FROM conversation_members WHERE conversation_id IN ({placeholders})) m
+                    JOIN users u ON u.id = m.user_id
+                    LEFT JOIN user_profiles p ON p.user_id = u.id
+                    WHERE m.n <= ?
+                    ORDER BY m.conversation_id, m.n''',
+                (*batch, cells)
+            ).fetchall()
+            for r in rows:
+                r = dict(r)
+                by_id[r.pop('conversation_id')]['members'].append(r)
+    return groups
+
+
+def set_group_avatars(rendered):
+    """
+    Store composites [(conversation_id, url, dirty seen when read)].  A group marked
+    dirty again while it was rendered keeps the difference and is rendered again.
+    """
+    with db_conn() as conn:
+        conn.executemany(
+            '''UPDATE conversations SET avatar_composite = ?,
+                      avatar_dirty = CASE WHEN avatar_dirty > ? THEN avatar_dirty - ? ELSE 0 END
+               WHERE id = ?''',
+            [(url, dirty, dirty, conv_id) for conv_id, url, dirty in rendered]
+        )
+        conn.commit()
+
+
+def group_avatar_urls():
+    """Composite URLs still referenced by some conversation."""
+    with db_conn() as conn:
+        rows = conn.execute(
+            'SELECT DISTINCT avatar_composite FROM conversations WHERE avatar_composite IS NOT NULL'
+        ).fetchall()
+    return {r['avatar_composite'] for r in rows}
+
+
 # ===== Storage functions =====
 
 def verify_file_owner(user_id: int, file_path: str) -> bool:
@@ -677,12 +1497,9 @@ def verify_file_owner(user_id: int, file_path: str) -> bool:
 def record_file_upload(user_id: int, file_path: str, file_size: int) -> bool:
     """Record a file upload atomically with quota check. Returns False if quota exceeded."""
     with db_conn() as conn:
-        conn.execute('BEGIN IMMEDIATE')
-        row = conn.execute(
-            'SELECT COALESCE(SUM(file_size), 0) as used FROM user_files WHERE user_id = ?',
-            (user_id,)
-        ).fetchone()
-        used = row['used'] if row else 0
+        begin_write(conn, 'quota', user_id)
+        row = conn.execute('SELECT storage_used_bytes FROM users WHERE id = ?', (user_id,)).fetchone()
+        used = row['storage_used_bytes'] if row else 0
 
         quota_row = conn.execute(
             'SELECT storage_quota_mb FROM user_profiles WHERE user_id = ?', (user_id,)
@@ -711,11 +1528,8 @@ def record_file_upload(user_id: int, file_path: str, file_size: int) -> bool:
 def get_user_storage_info(user_id: int) -> dict:
     """Return used bytes, quota bytes, and percentage for a user."""
     with db_conn() as conn:
-        row = conn.execute(
-            'SELECT COALESCE(SUM(file_size), 0) as used FROM user_files WHERE user_id = ?',
-            (user_id,)
-        ).fetchone()
-        used = row['used'] if row else 0
+        row = conn.execute('SELECT storage_used_bytes FROM users WHERE id = ?', (user_id,)).fetchone()
+        used = row['storage_used_bytes'] if row else 0
 
         # Per-user override > global default
         quota_row = conn.execute(
@@ -756,26 +1570,308 @@ def set_user_quota(user_id: int, quota_mb):
 
 # ===== Admin functions =====
 
-def get_all_users():
+# (table, column, source table, key column in source, per-row amount column or None for 1)
+_AGGREGATE_COLUMNS = (
+    ('users',         'storage_used_bytes', 'user_files',           'user_id',         'file_size'),
+    ('conversations', 'member_count',       'conversation_members', 'conversation_id', None),
+)
+
+_PG_AGGREGATE_FUNCTION = '''CREATE OR REPLACE FUNCTION aggregate_bump() RETURNS trigger AS $$
+DECLARE
+    r JSONB;
+    delta BIGINT := 1;
+BEGIN
+    IF TG_OP = 'INSERT' THEN r := to_jsonb(NEW); ELSE r := to_jsonb(OLD); END IF;
+    IF TG_ARGV[3] <> '' THEN delta := (r ->> TG_ARGV[3])::BIGINT; END IF;
+    IF TG_OP = 'DELETE' THEN delta := -delta; END IF;
+    EXECUTE format('UPDATE %I SET %I = %I + $1 WHERE id = $2', TG_ARGV[0], TG_ARGV[1], TG_ARGV[1])
+        USING delta, (r ->> TG_ARGV[2])::BIGINT;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+ADMIN_PAGE_SIZE = 50
+ADMIN_PAGE_MAX = 200
+
+USER_SORTS = {'id': 'u.id', 'username': 'u.username', 'storage': 'u.storage_used_bytes'}
+GROUP_SORTS = {'id': 'c.id', 'name': 'c.name', 'members': 'c.member_count'}   # group names are never NULL
+
+
+def _create_aggregate_triggers(c):
+    """Insert/delete triggers keeping users.storage_used_bytes and conversations.member_count current."""
+    postgres = get_backend().name == 'postgres'
+    if postgres:
+        c.execute(_PG_AGGREGATE_FUNCTION)
+    for table, column, source, key, amount in _AGGREGATE_COLUMNS:
+        for op, row, sign in (('INSERT', 'NEW', '+'), ('DELETE', 'OLD', '-')):
+            trigger = f'trg_{column}_{op.lower()}'
+            if postgres:
+                c.execute(f'DROP TRIGGER IF EXISTS {trigger} ON {source}')
+                c.execute(f'''CREATE TRIGGER {trigger} AFTER {op} ON {source} FOR EACH ROW
+                    EXECUTE FUNCTION aggregate_bump('{table}', '{column}', '{key}', '{amount or ""}')''')
+            else:
+                c.execute(f'''CREATE TRIGGER IF NOT EXISTS main.{trigger} AFTER {op} ON {source}
+                    BEGIN
+                        UPDATE {table} SET {column} = {column} {sign} {f"{row}.{amount}" if amount else 1}
+                        WHERE id = {row}.{key};
+                    END''')
+
+
+def encode_cursor(sort_value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(). Raises ValueError on a malformed cursor."""
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('bad cursor') from e
+    if not isinstance(row_id, int):
+        raise ValueError('bad cursor')
+    return sort_value, row_id
+
+
+def _prefix_range(column, prefix, where, params):
+    """Index-friendly `column` starts-with-`prefix` (case-sensitive)."""
+    if prefix:
+        where.append(f'{column} >= ? AND {column} < ?')
+        params += [prefix, prefix + '\U0010ffff']
+
+
+def _keyset_page(conn, sql, where, params, sort_col, id_col, desc, cursor, limit, key):
+    """
+    One page of `sql` (a SELECT without WHERE/ORDER BY) ordered by (sort_col, id_col).
+    `key` extracts the sort value from a result row.  Returns (rows, next cursor or None).
+    """
+    where, params = list(where), list(params)
+    if cursor:
+        where.append(f'({sort_col}, {id_col}) {"<" if desc else ">"} (?, ?)')
+        params += list(decode_cursor(cursor))
+    direction = 'DESC' if desc else 'ASC'
+    rows = conn.execute(
+        sql + (' WHERE ' + ' AND '.join(where) if where else '')
+        + f' ORDER BY {sort_col} {direction}, {id_col} {direction} LIMIT ?',
+        params + [limit + 1]
+    ).fetchall()
+    rows = [dict(r) for r in rows]
+    next_cursor = encode_cursor(key(rows[limit - 1]), rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def get_users_page(limit=ADMIN_PAGE_SIZE, cursor=None, sort='id', desc=False,
+                   prefix='', banned=None, min_storage_bytes=None):
+    """
+    Admin user listing, one keyset page at a time.  Filters: username prefix,
+    banned flag, minimum storage used.  Returns (users, next_cursor).
+    """
+    sort_col = USER_SORTS[sort]
+    where, params = [], []
+    _prefix_range('u.username', prefix, where, params)
+    if banned is not None:
+        where.append('u.is_banned = ?')
+        params.append(1 if banned else 0)
+    if min_storage_bytes:
+        where.append('u.storage_used_bytes >= ?')
+        params.append(min_storage_bytes)
     with db_conn() as conn:
-        users = conn.execute(
-            '''SELECT u.id, u.username, u.created_at, u.is_banned,
-                      COALESCE(p.storage_quota_mb, NULL) as storage_quota_mb,
-                      COALESCE((
-                          SELECT SUM(f.file_size) FROM user_files f WHERE f.user_id = u.id
-                      ), 0) as storage_used_bytes
+        return _keyset_page(
+            conn,
+            '''SELECT u.id, u.username, u.created_at, u.is_banned, u.storage_used_bytes, u.deleted_at,
+                      p.storage_quota_mb
                FROM users u
+               LEFT JOIN user_profiles p ON p.user_id = u.id''',
+            where, params, sort_col, 'u.id', desc, cursor, min(limit, ADMIN_PAGE_MAX),
+            key=lambda r: r[sort_col.split('.')[1]]
+        )
+
+
+def delete_user(user_id):
+    """Delete a user synchronously (scripts): tombstone, then drain the deletion queue."""
+    if tombstone_user(user_id) is not None:
+        while run_deletion_step():
+            pass
+
+
+def get_groups_page(limit=ADMIN_PAGE_SIZE, cursor=None, sort='id', desc=False,
+                    prefix='', min_members=None, max_members=None):
+    """
+    Admin group listing, one keyset page at a time, with member counts but not
+    members (see get_group_members_page).  Returns (groups, next_cursor).
+    """
+    sort_col = GROUP_SORTS[sort]
+    where, params = ['c.is_group = 1'], []
+    _prefix_range('c.name', prefix, where, params)
+    if min_members is not None:
+        where.append('c.member_count >= ?')
+        params.append(min_members)
+    if max_members is not None:
+        where.append('c.member_count <= ?')
+        params.append(max_members)
+    with db_conn() as conn:
+        return _keyset_page(
+            conn,
+            '''SELECT c.id, c.name, c.created_at, c.retention_days, c.member_count, c.deleted_at,
+                      u.username as creator_name
+               FROM conversations c
+               LEFT JOIN users u ON c.created_by = u.id''',
+            where, params, sort_col, 'c.id', desc, cursor, min(limit, ADMIN_PAGE_MAX),
+            key=lambda r: r[sort_col.split('.')[1]]
+        )
+
+
+def get_group_members_page(conv_id, limit=ADMIN_PAGE_SIZE, after_id=0):
+    """Members of one group in user id order, starting after `after_id`."""
+    with db_conn() as conn:
+        members = conn.execute(
+            '''SELECT u.id, u.username, cm.role, cm.joined_at, p.avatar_url, p.avatar_emoji
+               FROM conversation_members cm
+               JOIN users u ON u.id = cm.user_id
                LEFT JOIN user_profiles p ON p.user_id = u.id
-               ORDER BY u.id'''
+               WHERE cm.conversation_id = ? AND cm.user_id > ?
+               ORDER BY cm.user_id LIMIT ?''',
+            (conv_id, after_id, min(limit, ADMIN_PAGE_MAX))
         ).fetchall()
-    return [dict(u) for u in users]
+    return [dict(m) for m in members]
 
 
-def delete_user(user_id):
+def rename_group(conv_id, new_name):
+    with db_conn() as conn:
+        conn.execute('UPDATE conversations SET name = ? WHERE id = ? AND is_group = 1', (new_name, conv_id))
+        conn.commit()
+
+
+def delete_group(conv_id):
+    """Delete a group synchronously (scripts): tombstone, then drain the deletion queue."""
+    if tombstone_group(conv_id) is not None:
+        while run_deletion_step():
+            pass
+
+
+def ban_user(user_id, ban=True):
+    with db_conn() as conn:
+        conn.execute('UPDATE users SET is_banned = ? WHERE id = ?', (1 if ban else 0, user_id))
+        conn.commit()
+    return True, '已封禁用户' if ban else '已解封用户'
+
+
+def _id_chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), _IN_CHUNK):
+        batch = ids[i:i + _IN_CHUNK]
+        yield batch, ', '.join('?' for _ in batch)
+
+
+def ban_users(user_ids, ban=True):
+    """ban_user() for many users in one transaction. Returns how many users were updated (deleted ones are skipped)."""
+    changed = 0
+    with db_conn() as conn:
+        begin_write(conn)
+        for batch, marks in _id_chunks(user_ids):
+            changed += conn.execute(
+                f'UPDATE users SET is_banned = ? WHERE id IN ({marks}) AND deleted_at IS NULL',
+                [1 if ban else 0] + batch
+            ).rowcount
+        conn.commit()
+    return changed
+
+
+def set_users_quota(user_ids, quota_mb):
+    """set_user_quota() for many users in one transaction. Returns how many users were updated."""
+    with db_conn() as conn:
+        begin_write(conn)
+        existing = []
+        for batch, marks in _id_chunks(user_ids):
+            existing += [r['id'] for r in conn.execute(
+                f'SELECT id FROM users WHERE id IN ({marks}) AND deleted_at IS NULL', batch
+            ).fetchall()]
+        conn.executemany(
+            '''INSERT OR IGNORE INTO user_profiles
+               (user_id, avatar_emoji, bio, theme, font_size)
+               VALUES (?, '\U0001f60a', '', 'light', 'medium')''',
+            [(uid,) for uid in existing]
+        )
+        for batch, marks in _id_chunks(existing):
+            conn.execute(f'UPDATE user_profiles SET storage_quota_mb = ? WHERE user_id IN ({marks})',
+                         [quota_mb] + batch)
+        conn.commit()
+    return len(existing)
+
+
+def bulk_create_users(users):
+    """
+    Insert many (username, password_hash, quota_mb or None) rows in one transaction.
+    Returns one (ok, msg) per row; names already taken, in the database or earlier
+    in the batch, are reported and skipped.
+    """
+    now = time.time()
+    results, rows, quotas = [], [], {}
+    with db_conn() as conn:
+        begin_write(conn, 'usernames')
+        taken = set()
+        for batch, marks in _id_chunks(u[0] for u in users):
+            taken.update(r['username'] for r in conn.execute(
+                f'SELECT username FROM users WHERE username IN ({marks})', batch
+            ).fetchall())
+        for username, password_hash, quota_mb in users:
+            if username in taken:
+                results.append((False, '用户名已存在'))
+                continue
+            taken.add(username)
+            rows.append((username, password_hash, now))
+            if quota_mb is not None:
+                quotas[username] = quota_mb
+            results.append((True, '创建成功'))
+        conn.executemany('INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)', rows)
+        for batch, marks in _id_chunks(quotas):
+            conn.executemany(
+                '''INSERT INTO user_profiles (user_id, avatar_emoji, bio, theme, font_size, storage_quota_mb)
+                   VALUES (?, '\U0001f60a', '', 'light', 'medium', ?)''',
+                [(r['id'], quotas[r['username']]) for r in conn.execute(
+                    f'SELECT id, username FROM users WHERE username IN ({marks})', batch
+                ).fetchall()]
+            )
+        conn.commit()
+    return results
+
+
+# ===== Background deletion =====
+# Deleting a user or group used to be one transaction with a full-table anti-join,
+# holding the write lock while every chat waited.  Now tombstone_*() hides the
+# target in one short transaction and queues a deletion_jobs row; the app's
+# background loop calls run_deletion_step(), which deletes at most DELETE_CHUNK
+# rows per transaction.  Every step is idempotent, so a job interrupted by a
+# restart simply continues.
+
+DELETE_CHUNK = int(os.environ.get('DELETE_CHUNK', '500'))   # rows per deletion transaction
+
+_IN_CHUNK = 500   # ids per IN (...) list
+
+
+def _queue_deletion(conn, kind, target_id, label, now):
+    return conn.execute(
+        '''INSERT INTO deletion_jobs (kind, target_id, label, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?)''',
+        (kind, target_id, label or '', now, now)
+    ).lastrowid
+
+
+def tombstone_user(user_id):
+    """
+    Hide a user at once and queue the rest of the deletion.  The user is banned and
+    marked deleted, loses memberships and friendships, hands owned groups to a
+    successor; conversations left without members are tombstoned too.
+    Returns the job id, or None if the user does not exist or is already deleted.
+    """
+    now = time.time()
     with db_conn() as conn:
         c = conn.cursor()
-        # Remove file upload records
-        c.execute('DELETE FROM user_files WHERE user_id = ?', (user_id,))
+        begin_write(conn, 'user', user_id)
+        user = c.execute('SELECT username, deleted_at FROM users WHERE id = ?', (user_id,)).fetchone()
+        if not user or user['deleted_at'] is not None:
+            conn.rollback()
+            return None
+        c.execute('UPDATE users SET deleted_at = ?, is_banned = 1 WHERE id = ?', (now, user_id))
         # ── Transfer group ownership before removing membership ────────────
         # For every group this user created, promote the longest-standing admin
         # (or any remaining member) as the new owner so the group stays manageable.
@@ -799,66 +1895,200 @@ def delete_user(user_id):
                     "UPDATE conversation_members SET role = 'admin' WHERE conversation_id = ? AND user_id = ?",
                     (gid, new_owner)
                 )
-            else:
-                # No other members — set NULL (group will be cleaned up below)
-                c.execute('UPDATE conversations SET created_by = NULL WHERE id = ?', (gid,))
-        # ── Remove user records ────────────────────────────────────────────
+        # Private chats and groups nobody inherits keep no reference to the user.
+        c.execute('UPDATE conversations SET created_by = NULL WHERE created_by = ?', (user_id,))
+        conv_ids = [r['conversation_id'] for r in c.execute(
+            'SELECT conversation_id FROM conversation_members WHERE user_id = ?', (user_id,)
+        ).fetchall()]
         c.execute('DELETE FROM conversation_members WHERE user_id = ?', (user_id,))
-        c.execute('DELETE FROM messages WHERE sender_id = ?', (user_id,))
-        c.execute('''DELETE FROM messages WHERE conversation_id NOT IN (
-            SELECT DISTINCT conversation_id FROM conversation_members)''')
-        c.execute('''DELETE FROM conversations WHERE id NOT IN (
-            SELECT DISTINCT conversation_id FROM conversation_members)''')
         c.execute('DELETE FROM friends WHERE requester_id = ? OR addressee_id = ?', (user_id, user_id))
-        c.execute('DELETE FROM user_profiles WHERE user_id = ?', (user_id,))
-        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        # Only the user's own conversations can have become empty: no global anti-join.
+        orphans = []
+        for i in range(0, len(conv_ids), _IN_CHUNK):
+            batch = conv_ids[i:i + _IN_CHUNK]
+            orphans += c.execute(
+                f'''SELECT id, name FROM conversations
+                    WHERE id IN ({", ".join("?" for _ in batch)}) AND member_count = 0''',
+                batch
+            ).fetchall()
+        c.executemany('UPDATE conversations SET deleted_at = ? WHERE id = ?', [(now, o['id']) for o in orphans])
+        job_id = _queue_deletion(c, 'user', user_id, user['username'], now)
+        for o in orphans:
+            _queue_deletion(c, 'conversation', o['id'], o['name'], now)
         conn.commit()
+    return job_id
 
 
-def get_all_groups():
+def tombstone_group(conv_id):
+    """Hide a group at once and queue its deletion. Returns the job id, or None if there is no such group."""
+    now = time.time()
     with db_conn() as conn:
-        groups = conn.execute(
-            '''SELECT c.id, c.name, c.created_at, u.username as creator_name
-               FROM conversations c
-               LEFT JOIN users u ON c.created_by = u.id
-               WHERE c.is_group = 1
-               ORDER BY c.id'''
-        ).fetchall()
-        result = []
-        for g in groups:
-            gd = dict(g)
-            members = conn.execute(
-                '''SELECT u.id, u.username FROM users u
-                   JOIN conversation_members cm ON u.id = cm.user_id
-                   WHERE cm.conversation_id = ?''',
-                (g['id'],)
-            ).fetchall()
-            gd['members'] = [dict(m) for m in members]
-            gd['member_count'] = len(gd['members'])
-            result.append(gd)
-    return result
+        begin_write(conn, 'conversation', conv_id)
+        group = conn.execute(
+            'SELECT name FROM conversations WHERE id = ? AND is_group = 1 AND deleted_at IS NULL', (conv_id,)
+        ).fetchone()
+        if not group:
+            conn.rollback()
+            return None
+        conn.execute('UPDATE conversations SET deleted_at = ? WHERE id = ?', (now, conv_id))
+        job_id = _queue_deletion(conn, 'conversation', conv_id, group['name'], now)
+        conn.commit()
+    return job_id
+
+
+def _delete_messages_chunk(conn, where, params, chunk):
+    """Delete up to `chunk` messages matching `where`, with the favorites and pins pointing at them."""
+    ids = [(r['id'],) for r in conn.execute(
+        f'SELECT id FROM messages WHERE {where} LIMIT ?', params + (chunk,)
+    ).fetchall()]
+    if ids:
+        begin_write(conn)
+        conn.executemany('DELETE FROM favorite_messages WHERE message_id = ?', ids)
+        conn.executemany('DELETE FROM pinned_messages WHERE message_id = ?', ids)
+        conn.executemany('DELETE FROM messages WHERE id = ?', ids)
+        conn.commit()
+    return len(ids)
 
 
-def rename_group(conv_id, new_name):
+def _delete_rows_chunk(conn, table, where, params, chunk):
+    """Delete up to `chunk` rows of `table` (which has an id column) matching `where`."""
+    ids = [(r['id'],) for r in conn.execute(
+        f'SELECT id FROM {table} WHERE {where} LIMIT ?', params + (chunk,)
+    ).fetchall()]
+    if ids:
+        begin_write(conn)
+        conn.executemany(f'DELETE FROM {table} WHERE id = ?', ids)
+        conn.commit()
+    return len(ids)
+
+
+def _delete_archived(where, params):
+    """Delete archived messages matching `where` from every archive file, one file per transaction."""
+    deleted = 0
+    for month_key, path in _list_archives():
+        arc = _open_archive(month_key, write=True)
+        try:
+            deleted += arc.execute(f'DELETE FROM archived_messages WHERE {where}', params).rowcount
+            arc.commit()
+        finally:
+            arc.close()
+    return deleted
+
+
+def _conversation_deletion_step(job, chunk):
+    """One chunk of a conversation job. Returns (rows deleted, next phase)."""
+    conv_id = job['target_id']
+    if job['phase'] == 'messages':
+        with msg_conn(conv_id) as conn:
+            n = _delete_messages_chunk(conn, 'conversation_id = ?', (conv_id,), chunk)
+            if not n:
+                n = _delete_rows_chunk(conn, 'pinned_messages', 'conversation_id = ?', (conv_id,), chunk)
+        return n, 'messages' if n else 'archive'
+    if job['phase'] == 'archive':
+        return _delete_archived('conversation_id = ?', (conv_id,)), 'members'
+    if job['phase'] == 'members':
+        with db_conn() as conn:
+            members = [(conv_id, r['user_id']) for r in conn.execute(
+                'SELECT user_id FROM conversation_members WHERE conversation_id = ? LIMIT ?', (conv_id, chunk)
+            ).fetchall()]
+            if members:
+                begin_write(conn)
+                conn.executemany('DELETE FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
+                                 members)
+                conn.commit()
+        return len(members), 'members' if members else 'finish'
     with db_conn() as conn:
-        conn.execute('UPDATE conversations SET name = ? WHERE id = ? AND is_group = 1', (new_name, conv_id))
+        n = conn.execute('DELETE FROM conversations WHERE id = ?', (conv_id,)).rowcount
         conn.commit()
+    return n, 'done'
 
 
-def delete_group(conv_id):
+def _user_deletion_step(job, chunk):
+    """One chunk of a user job. Returns (rows deleted, next phase)."""
+    user_id = job['target_id']
+    if job['phase'] in ('messages', 'rows'):
+        for conn in _each_message_db():
+            if job['phase'] == 'messages':
+                n = _delete_messages_chunk(conn, 'sender_id = ?', (user_id,), chunk)
+            else:
+                n = (_delete_rows_chunk(conn, 'favorite_messages', 'user_id = ?', (user_id,), chunk)
+                     or _delete_rows_chunk(conn, 'pinned_messages', 'pinned_by = ?', (user_id,), chunk))
+            if n:
+                return n, job['phase']
+        if job['phase'] == 'messages':
+            return 0, 'archive'
+        with db_conn() as conn:
+            n = _delete_rows_chunk(conn, 'user_files', 'user_id = ?', (user_id,), chunk)
+        return n, 'rows' if n else 'finish'
+    if job['phase'] == 'archive':
+        return _delete_archived('sender_id = ?', (user_id,)), 'rows'
     with db_conn() as conn:
-        c = conn.cursor()
-        c.execute('DELETE FROM messages WHERE conversation_id = ?', (conv_id,))
-        c.execute('DELETE FROM conversation_members WHERE conversation_id = ?', (conv_id,))
-        c.execute('DELETE FROM conversations WHERE id = ? AND is_group = 1', (conv_id,))
+        begin_write(conn, 'user', user_id)
+        # add_group_member() and friends refuse deleted users, but a membership or request
+        # that raced tombstone_user() would still block the final DELETE on its foreign key.
+        conn.execute('DELETE FROM conversation_members WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM friends WHERE requester_id = ? OR addressee_id = ?', (user_id, user_id))
+        conn.execute('DELETE FROM user_profiles WHERE user_id = ?', (user_id,))
+        n = conn.execute('DELETE FROM users WHERE id = ?', (user_id,)).rowcount
         conn.commit()
+    return n, 'done'
 
 
-def ban_user(user_id, ban=True):
+_DELETION_STEPS = {'user': _user_deletion_step, 'conversation': _conversation_deletion_step}
+
+
+def run_deletion_step(chunk=None):
+    """
+    Run one chunk of the oldest unfinished deletion job.  Returns the job as it
+    stands afterwards, or None when there is nothing to do.  A step that raises
+    marks the job failed (see retry_deletion_job) and re-raises.
+    """
     with db_conn() as conn:
-        conn.execute('UPDATE users SET is_banned = ? WHERE id = ?', (1 if ban else 0, user_id))
+        row = conn.execute(
+            "SELECT * FROM deletion_jobs WHERE status IN ('pending', 'running') ORDER BY id LIMIT 1"
+        ).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    try:
+        n, phase = _DELETION_STEPS[job['kind']](job, chunk or DELETE_CHUNK)
+    except Exception as e:
+        with db_conn() as conn:
+            conn.execute("UPDATE deletion_jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                         (str(e), time.time(), job['id']))
+            conn.commit()
+        raise
+    job.update(phase=phase, status='done' if phase == 'done' else 'running',
+               deleted_rows=job['deleted_rows'] + n, updated_at=time.time())
+    with db_conn() as conn:
+        conn.execute(
+            'UPDATE deletion_jobs SET phase = ?, status = ?, deleted_rows = ?, updated_at = ? WHERE id = ?',
+            (job['phase'], job['status'], job['deleted_rows'], job['updated_at'], job['id'])
+        )
         conn.commit()
-    return True, '已封禁用户' if ban else '已解封用户'
+    return job
+
+
+def retry_deletion_job(job_id):
+    with db_conn() as conn:
+        n = conn.execute(
+            "UPDATE deletion_jobs SET status = 'running', error = NULL WHERE id = ? AND status = 'failed'",
+            (job_id,)
+        ).rowcount
+        conn.commit()
+    return n > 0
+
+
+def get_deletion_jobs(limit=50):
+    """Unfinished and failed jobs first, then the most recent finished ones."""
+    with db_conn() as conn:
+        rows = conn.execute(
+            '''SELECT * FROM deletion_jobs
+               ORDER BY CASE WHEN status = 'done' THEN 1 ELSE 0 END, id DESC
+               LIMIT ?''',
+            (limit,)
+        ).fetchall()
+    return [dict(r) for r in rows]
 
 
 # ===== Profile & Settings =====
@@ -907,18 +2137,20 @@ def update_profile(user_id, avatar_emoji=None, avatar_url=None, bio=None, theme=
         conn.commit()
 
 
-def change_password(user_id, old_password, new_password):
+def _get_password_hash(user_id):
     with db_conn() as conn:
-        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-        if not user:
-            return False, '用户不存在'
-        try:
-            _ph.verify(user['password_hash'], old_password)
-        except VerifyMismatchError:
-            return False, '原密码错误'
-        new_hash = _ph.hash(new_password)
-        conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user_id))
-        conn.commit()
+        row = conn.execute('SELECT password_hash FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row['password_hash'] if row else None
+
+
+def change_password(user_id, old_password, new_password):
+    password_hash = pool.run(_get_password_hash, user_id)
+    if not password_hash:
+        return False, '用户不存在'
+    ok, _ = passwords.verify_password(password_hash, old_password)
+    if not ok:
+        return False, '原密码错误'
+    pool.run(_set_password_hash, user_id, passwords.hash_password(new_password))
     return True, '密码已更新'
 
 
@@ -984,6 +2216,8 @@ def send_friend_request(requester_id, addressee_id):
     """
     norm_req, norm_addr = _norm_pair(requester_id, addressee_id)
     with db_conn() as conn:
+        if not _is_live_user(conn, addressee_id):
+            return False, '用户不存在'
         existing = conn.execute(
             'SELECT * FROM friends WHERE requester_id = ? AND addressee_id = ?',
             (norm_req, norm_addr)
@@ -1009,7 +2243,7 @@ def send_friend_request(requester_id, addressee_id):
             )
             conn.commit()
             return True, '好友请求已发送'
-        except sqlite3.IntegrityError:
+        except IntegrityError:
             return False, '请求已存在'
 
 
@@ -1092,14 +2326,6 @@ def get_group_settings(conv_id, user_id):
         ).fetchone()
         if not conv:
             return None
-        members = conn.execute(
-                '''SELECT u.id, u.username, p.avatar_url, p.avatar_emoji, cm.role, cm.joined_at
-               FROM users u JOIN conversation_members cm ON u.id = cm.user_id
-                    LEFT JOIN user_profiles p ON p.user_id = u.id
-               WHERE cm.conversation_id = ?
-               ORDER BY CASE cm.role WHEN 'admin' THEN 0 ELSE 1 END, u.username''',
-            (conv_id,)
-        ).fetchall()
         my_role_row = conn.execute(
             'SELECT role FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
             (conv_id, user_id)
@@ -1107,17 +2333,42 @@ def get_group_settings(conv_id, user_id):
     my_role = my_role_row['role'] if my_role_row else 'member'
     if conv['created_by'] == user_id:
         my_role = 'admin'
+    # First page only; the rest comes from get_group_members_page().
+    members = get_group_members_page(conv_id, GROUP_MEMBER_PAGE)
     return {
         'id': conv['id'],
         'name': conv['name'],
         'avatar_url': conv['avatar_url'],
+        'avatar_composite': conv['avatar_composite'],
         'announcement': conv['announcement'] or '',
         'created_by': conv['created_by'],
-        'members': [dict(m) for m in members],
+        'admins_only': conv['admins_only'],
+        'member_count': conv['member_count'],
+        'members': members,
+        'has_more_members': len(members) == GROUP_MEMBER_PAGE,
         'my_role': my_role,
     }
 
 
+def set_group_admins_only(conv_id, user_id, enabled):
+    """Allow only admins (and the owner) to post in a group, or everyone again."""
+    with db_conn() as conn:
+        conv = conn.execute(
+            'SELECT created_by FROM conversations WHERE id = ? AND is_group = 1', (conv_id,)
+        ).fetchone()
+        if not conv:
+            return False, '群聊不存在'
+        role = conn.execute(
+            'SELECT role FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
+            (conv_id, user_id)
+        ).fetchone()
+        if not (role and role['role'] == 'admin') and conv['created_by'] != user_id:
+            return False, '需要管理员权限'
+        conn.execute('UPDATE conversations SET admins_only = ? WHERE id = ?', (1 if enabled else 0, conv_id))
+        conn.commit()
+    return True, '已开启仅管理员发言' if enabled else '已关闭仅管理员发言'
+
+
 def update_group_announcement(conv_id, user_id, announcement):
     with db_conn() as conn:
         conv = conn.execute(
@@ -1161,7 +2412,7 @@ def update_group_avatar(conv_id, user_id, avatar_url):
 
 
 def pin_message(conv_id, message_id, user_id):
-    with db_conn() as conn:
+    with msg_conn(conv_id) as conn:
         conv = conn.execute('SELECT is_group FROM conversations WHERE id = ?', (conv_id,)).fetchone()
         if not conv:
             return False, '会话不存在'
@@ -1191,7 +2442,7 @@ def pin_message(conv_id, message_id, user_id):
 
 
 def unpin_message(conv_id, message_id, user_id):
-    with db_conn() as conn:
+    with msg_conn(conv_id) as conn:
         if not is_member(conv_id, user_id):
             return False, '无权限'
         conv = conn.execute('SELECT is_group, created_by FROM conversations WHERE id = ?', (conv_id,)).fetchone()
@@ -1213,7 +2464,7 @@ def unpin_message(conv_id, message_id, user_id):
 
 
 def get_pinned_messages(conv_id):
-    with db_conn() as conn:
+    with msg_conn(conv_id) as conn:
         rows = conn.execute(
             '''SELECT pm.message_id, pm.pinned_by, pm.pinned_at,
                       m.content, m.msg_type, m.media_url, m.timestamp,
@@ -1260,11 +2511,17 @@ def add_group_member(conv_id, operator_id, new_member_id):
         ).fetchone()
         if not (role and role['role'] == 'admin') and conv['created_by'] != operator_id:
             return False, '需要管理员权限'
+        # Same scope as tombstone_user(): a user being deleted cannot be added back.
+        begin_write(conn, 'user', new_member_id)
+        if not _is_live_user(conn, new_member_id):
+            conn.rollback()
+            return False, '用户不存在'
         existing = conn.execute(
             'SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user_id = ?',
             (conv_id, new_member_id)
         ).fetchone()
         if existing:
+            conn.rollback()
             return False, '该用户已在群中'
         conn.execute(
             "INSERT INTO conversation_members (conversation_id, user_id, joined_at, role) VALUES (?, ?, ?, 'member')",
@@ -1375,20 +2632,510 @@ def update_system_setting(key, value):
 
 # ===== Admin Extended =====
 
+# ===== Statistics =====
+
+# (counter, table, only rows where column = value, per-row amount column or None for 1)
+_STAT_COUNTERS = (
+    ('users',      'users',         None,            None),
+    ('groups',     'conversations', ('is_group', 1), None),
+    ('messages',   'messages',      None,            None),
+    ('files',      'user_files',    None,            None),
+    ('file_bytes', 'user_files',    None,            'file_size'),
+)
+
+_PG_STATS_FUNCTION = '''CREATE OR REPLACE FUNCTION stats_bump() RETURNS trigger AS $$
+DECLARE
+    delta BIGINT := 1;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF TG_ARGV[1] <> '' THEN delta := (to_jsonb(NEW) ->> TG_ARGV[1])::BIGINT; END IF;
+    ELSE
+        IF TG_ARGV[1] <> '' THEN delta := (to_jsonb(OLD) ->> TG_ARGV[1])::BIGINT; END IF;
+        delta := -delta;
+    END IF;
+    UPDATE stats_counters SET value = value + delta WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+STATS_BUCKETS  = {'minute': 60, 'hour': 3600}
+STATS_KEEP     = {'minute': 2 * 86400, 'hour': 90 * 86400}   # history kept per granularity
+STATS_BACKFILL = {'minute': 3600, 'hour': 48 * 3600}         # how far back a first (or late) rollup reaches
+
+
+def _create_stat_counters(c, tables):
+    """Create stats_counters plus the insert/delete triggers for the counters over `tables`."""
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )''')
+    postgres = get_backend().name == 'postgres'
+    if postgres:
+        c.execute(_PG_STATS_FUNCTION)
+    for name, table, where, amount in _STAT_COUNTERS:
+        if table not in tables:
+            continue
+        for op, row, sign in (('INSERT', 'NEW', '+'), ('DELETE', 'OLD', '-')):
+            trigger = f'trg_stats_{name}_{op.lower()}'
+            when = f'{row}.{where[0]} = {where[1]}' if where else ''
+            if postgres:
+                c.execute(f'DROP TRIGGER IF EXISTS {trigger} ON {table}')
+                c.execute(f'''CREATE TRIGGER {trigger} AFTER {op} ON {table} FOR EACH ROW
+                    {f"WHEN ({when})" if when else ""}
+                    EXECUTE FUNCTION stats_bump('{name}', '{amount or ""}')''')
+            else:
+                c.execute(f'''CREATE TRIGGER IF NOT EXISTS main.{trigger} AFTER {op} ON {table}
+                    {f"WHEN {when}" if when else ""}
+                    BEGIN
+                        UPDATE stats_counters SET value = value {sign} {f"{row}.{amount}" if amount else 1}
+                        WHERE name = '{name}';
+                    END''')
+        # Seed each total once.  A row written after its trigger exists but before
+        # the seed is missed by the trigger's UPDATE and counted here instead.
+        total = f'COALESCE(SUM({amount}), 0)' if amount else 'COUNT(*)'
+        c.execute(f"INSERT OR IGNORE INTO stats_counters (name, value) SELECT '{name}', {total} FROM {table}"
+                  + (f' WHERE {where[0]} = {where[1]}' if where else ''))
+
+
+def _active_senders(start, end):
+    """Distinct user ids that sent a message in [start, end), across all message databases."""
+    senders = set()
+    for conn in _each_message_db():
+        senders.update(r['sender_id'] for r in conn.execute(
+            'SELECT DISTINCT sender_id FROM messages WHERE timestamp >= ? AND timestamp < ?', (start, end)
+        ).fetchall())
+    return senders
+
+
 def get_admin_stats():
+    """
+    Current totals, read from the trigger-maintained counters (constant time per
+    database and archive file).  message_count covers hot and archived messages;
+    hot_message_count and archived_message_count split it.
+    """
     with db_conn() as conn:
-        user_count   = conn.execute('SELECT COUNT(*) as c FROM users').fetchone()['c']
-        group_count  = conn.execute(
-            'SELECT COUNT(*) as c FROM conversations WHERE is_group = 1'
-        ).fetchone()['c']
-        msg_count    = conn.execute('SELECT COUNT(*) as c FROM messages').fetchone()['c']
-        active_users = conn.execute(
-            'SELECT COUNT(DISTINCT sender_id) as c FROM messages WHERE timestamp > ?',
-            (time.time() - 86400,)
-        ).fetchone()['c']
+        counters = {r['name']: r['value'] for r in conn.execute('SELECT name, value FROM stats_counters')}
+    hot_count = 0
+    for conn in _each_message_db():
+        row = conn.execute("SELECT value FROM stats_counters WHERE name = 'messages'").fetchone()
+        hot_count += row['value'] if row else 0
+    archived_count = _archived_message_count()
+    active = counters.get('active_users_24h')
+    if active is None:   # rollup_stats() has not run yet
+        now = time.time()
+        active = len(_active_senders(now - 86400, now))
     return {
-        'user_count': user_count,
-        'group_count': group_count,
-        'message_count': msg_count,
-        'active_users_24h': active_users,
+        'user_count': counters.get('users', 0),
+        'group_count': counters.get('groups', 0),
+        'message_count': hot_count + archived_count,
+        'hot_message_count': hot_count,
+        'archived_message_count': archived_count,
+        'active_users_24h': active,
+        'file_count': counters.get('files', 0),
+        'file_bytes': counters.get('file_bytes', 0),
+    }
+
+
+def rollup_stats(now=None):
+    """
+    Write every completed minute and hour bucket not yet in stats_rollup, prune old
+    history and refresh the active_users_24h counter.  Returns the number of buckets written.
+    """
+    now = now or time.time()
+    written = 0
+    for gran, width in STATS_BUCKETS.items():
+        current = now // width * width   # start of the bucket still in progress
+        with db_conn() as conn:
+            last = conn.execute(
+                'SELECT MAX(bucket_start) AS b FROM stats_rollup WHERE granularity = ?', (gran,)
+            ).fetchone()['b']
+        start = max(last + width if last is not None else 0, current - STATS_BACKFILL[gran])
+        if start >= current:
+            continue
+        buckets = {b: [0, set(), 0, 0] for b in range(int(start), int(current), width)}
+        for conn in _each_message_db():
+            for r in conn.execute(
+                'SELECT sender_id, timestamp FROM messages WHERE timestamp >= ? AND timestamp < ?', (start, current)
+            ).fetchall():
+                bucket = buckets[int(r['timestamp'] // width * width)]
+                bucket[0] += 1
+                bucket[1].add(r['sender_id'])
+        with db_conn() as conn:
+            for r in conn.execute(
+                'SELECT file_size, uploaded_at FROM user_files WHERE uploaded_at >= ? AND uploaded_at < ?',
+                (start, current)
+            ).fetchall():
+                bucket = buckets[int(r['uploaded_at'] // width * width)]
+                bucket[2] += 1
+                bucket[3] += r['file_size']
+            conn.executemany(
+                '''INSERT OR REPLACE INTO stats_rollup
+                   (granularity, bucket_start, messages, active_users, uploads, upload_bytes)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                [(gran, b, n, len(senders), uploads, size) for b, (n, senders, uploads, size) in buckets.items()]
+            )
+            conn.execute('DELETE FROM stats_rollup WHERE granularity = ? AND bucket_start < ?',
+                         (gran, now - STATS_KEEP[gran]))
+            conn.commit()
+        written += len(buckets)
+
+    active = len(_active_senders(now - 86400, now))
+    with db_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO stats_counters (name, value) VALUES ('active_users_24h', ?)", (active,))
+        conn.commit()
+    return written
+
+
+def get_stats_history(granularity, since):
+    with db_conn() as conn:
+        rows = conn.execute(
+            '''SELECT bucket_start, messages, active_users, uploads, upload_bytes FROM stats_rollup
+               WHERE granularity = ? AND bucket_start >= ? ORDER BY bucket_start''',
+            (granularity, since)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+# ===== Retention & Archival =====
+
+def _archive_path(month_key):
+    return os.path.join(ARCHIVE_DIR, f'messages_{month_key}.db')
+
+
+def _month_key(ts):
+    t = time.gmtime(ts)
+    return f'{t.tm_year:04d}_{t.tm_mon:02d}'
+
+
+def _month_start(month_key):
+    year, month = (int(x) for x in month_key.split('_'))
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def _month_end(month_key):
+    year, month = (int(x) for x in month_key.split('_'))
+    return calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+
+
+def _archives_reach(ts):
+    """Whether some archive file may hold messages newer than `ts`."""
+    archives = _list_archives()
+    return bool(archives) and _month_end(archives[0][0]) > ts
+
+
+# [(month_key, path)] newest first; None until listed.  Reset by _archives_changed()
+# whenever an archive file is created or removed.
+_archive_list = None
+
+
+def _list_archives():
+    """Return [(month_key, path)] for every archive file, newest month first."""
+    global _archive_list
+    if _archive_list is None:
+        keys = []
+        if os.path.isdir(ARCHIVE_DIR):
+            keys = [f[len('messages_'):-len('.db')] for f in os.listdir(ARCHIVE_DIR)
+                    if f.startswith('messages_') and f.endswith('.db')]
+        _archive_list = [(k, _archive_path(k)) for k in sorted(keys, reverse=True)]
+    return _archive_list
+
+
+def _archives_changed():
+    global _archive_list
+    _archive_list = None
+
+
+def _open_archive(month_key, write=False):
+    """Connection to an existing archive file, read-only unless `write`."""
+    path = _archive_path(month_key)
+    if write:
+        conn = sqlite3.connect(path, timeout=10)
+    else:
+        conn = sqlite3.connect(f'file:{urllib.parse.quote(path)}?mode=ro', uri=True, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _create_archive_schema(conn):
+    # content is zlib-compressed UTF-8; rows are immutable once archived.
+    conn.execute('''CREATE TABLE IF NOT EXISTS archived_messages (
+        id INTEGER PRIMARY KEY,
+        conversation_id INTEGER NOT NULL,
+        sender_id INTEGER NOT NULL,
+        content BLOB NOT NULL,
+        msg_type TEXT NOT NULL,
+        media_url TEXT,
+        is_revoked INTEGER NOT NULL DEFAULT 0,
+        edited_at REAL,
+        original_message_id INTEGER,
+        timestamp REAL NOT NULL
+    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_archived_conv_ts
+                    ON archived_messages(conversation_id, timestamp)''')
+    # Row count kept by triggers, like stats_counters in the hot databases: moving a
+    # message here takes it off the hot counter and puts it on this one.
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''')
+    for op, sign in (('INSERT', '+'), ('DELETE', '-')):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_archived_{op.lower()} AFTER {op} ON archived_messages
+                         BEGIN UPDATE archive_stats SET value = value {sign} 1 WHERE name = 'messages'; END''')
+    if conn.execute("SELECT 1 FROM archive_stats WHERE name = 'messages'").fetchone() is None:
+        conn.execute("INSERT INTO archive_stats (name, value) SELECT 'messages', COUNT(*) FROM archived_messages")
+    conn.commit()
+
+
+def _upgrade_archives():
+    """Bring archive files written by older versions up to the current schema (run by init_db)."""
+    for month_key, path in _list_archives():
+        arc = _open_archive(month_key, write=True)
+        try:
+            _create_archive_schema(arc)
+        finally:
+            arc.close()
+
+
+def _archived_message_count():
+    total = 0
+    for month_key, path in _list_archives():
+        arc = _open_archive(month_key)
+        try:
+            total += arc.execute("SELECT value FROM archive_stats WHERE name = 'messages'").fetchone()['value']
+        finally:
+            arc.close()
+    return total
+
+
+def _get_archived_messages(conn, conversation_id, limit, before=None, after=None):
+    """Newest-first archived messages between `after` and `before`; `conn` resolves sender names."""
+    result = []
+    for month_key, path in _list_archives():
+        if len(result) >= limit:
+            break
+        if before is not None and before <= _month_start(month_key):
+            continue
+        if after is not None and after >= _month_end(month_key):
+            break
+        arc = _open_archive(month_key)
+        try:
+            params = [conversation_id]
+            where = 'conversation_id = ?'
+            if before is not None:
+                where += ' AND timestamp < ?'
+                params.append(before)
+            if after is not None:
+                where += ' AND timestamp > ?'
+                params.append(after)
+            params.append(limit - len(result))
+            rows = arc.execute(
+                f'''SELECT {', '.join(_MESSAGE_COLUMNS)} FROM archived_messages
+                   WHERE {where}
+                   ORDER BY timestamp DESC LIMIT ?''',
+                tuple(params)
+            ).fetchall()
+        finally:
+            arc.close()
+        if not rows:
+            continue
+        sender_ids = list({r['sender_id'] for r in rows})
+        names = {u['id']: u['username'] for u in conn.execute(
+            f'SELECT id, username FROM users WHERE id IN ({", ".join("?" for _ in sender_ids)})',
+            sender_ids
+        ).fetchall()}
+        for r in rows:
+            msg = dict(r)
+            msg['content'] = zlib.decompress(msg['content']).decode('utf-8')
+            msg.update(sender_name=names.get(msg['sender_id']), original_content=None,
+                       original_sender_name=None, original_msg_type=None)
+            result.append(msg)
+        before = rows[-1]['timestamp']
+    return result
+
+
+def _get_archived_messages_by_ids(message_ids):
+    """Archived messages by id, keyed by id (content decompressed, with sender_name); missing ids are left out."""
+    wanted = set(message_ids)
+    found = {}
+    for month_key, path in _list_archives():
+        if not wanted:
+            break
+        arc = _open_archive(month_key)
+        try:
+            for batch, placeholders in _id_chunks(wanted):
+                for r in arc.execute(
+                    f'SELECT {", ".join(_MESSAGE_COLUMNS)} FROM archived_messages WHERE id IN ({placeholders})',
+                    batch
+                ).fetchall():
+                    msg = dict(r)
+                    msg['content'] = zlib.decompress(msg['content']).decode('utf-8')
+                    found[msg['id']] = msg
+        finally:
+            arc.close()
+        wanted -= found.keys()
+    if found:
+        with db_conn() as conn:
+            for batch, placeholders in _id_chunks({m['sender_id'] for m in found.values()}):
+                names = {u['id']: u['username'] for u in conn.execute(
+                    f'SELECT id, username FROM users WHERE id IN ({placeholders})', batch
+                ).fetchall()}
+                for msg in found.values():
+                    if msg['sender_id'] in names:
+                        msg['sender_name'] = names[msg['sender_id']]
+        for msg in found.values():
+            msg.setdefault('sender_name', None)
+    return found
+
+
+def _get_int_setting(conn, key, default=0):
+    row = conn.execute('SELECT value FROM system_settings WHERE key = ?', (key,)).fetchone()
+    try:
+        return int(row['value']) if row else default
+    except ValueError:
+        return default
+
+
+def archive_cold_messages(batch_size=1000):
+    """
+    Move one batch of messages older than `archive_after_days` into the monthly
+    archives. Pinned and favorited messages stay hot (they are referenced by id).
+    Rows are written to the archive before being deleted from the hot table, and
+    INSERT OR IGNORE makes a re-run after a crash harmless.
+    Returns the number of messages archived; call repeatedly until it returns 0.
+    """
+    with db_conn() as conn:
+        days = _get_int_setting(conn, 'archive_after_days')
+    if days <= 0:
+        return 0
+    cutoff = time.time() - days * 86400
+    archived = 0
+    for conn in _each_message_db():
+        rows = conn.execute(
+            f'''SELECT {', '.join('m.' + c for c in _MESSAGE_COLUMNS)} FROM messages m
+               WHERE m.timestamp < ?
+                 AND NOT EXISTS (SELECT 1 FROM pinned_messages p WHERE p.message_id = m.id)
+                 AND NOT EXISTS (SELECT 1 FROM favorite_messages f WHERE f.message_id = m.id)
+               ORDER BY m.timestamp LIMIT ?''',
+            (cutoff, batch_size - archived)
+        ).fetchall()
+        if not rows:
+            continue
+        _write_archive(rows)
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(r['id'],) for r in rows])
+        conn.commit()
+        archived += len(rows)
+        if archived >= batch_size:
+            break
+    return archived
+
+
+def _write_archive(rows):
+    by_month = {}
+    for r in rows:
+        row = dict(r)
+        row['content'] = zlib.compress(row['content'].encode('utf-8'))
+        by_month.setdefault(_month_key(row['timestamp']), []).append(row)
+    placeholders = ', '.join('?' for _ in _MESSAGE_COLUMNS)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month_key, month_rows in by_month.items():
+        arc = _open_archive(month_key, write=True)
+        try:
+            _create_archive_schema(arc)
+            arc.executemany(
+                f'INSERT OR IGNORE INTO archived_messages ({", ".join(_MESSAGE_COLUMNS)}) VALUES ({placeholders})',
+                [tuple(row[c] for c in _MESSAGE_COLUMNS) for row in month_rows]
+            )
+            arc.commit()
+        finally:
+            arc.close()
+    _archives_changed()
+
+
+# Conversations whose own retention_days replaces the global policy, as a subquery:
+# hot databases read it from conversations, archive files from a temp table.
+_OVERRIDDEN_HOT = '(SELECT id FROM conversations WHERE retention_days IS NOT NULL)'
+_OVERRIDDEN_ARCHIVE = '(SELECT id FROM temp.retention_overrides)'
+
+
+def _retention_policies(conn):
+    """Return (global_days, {conversation_id: days}) for conversations with an override."""
+    global_days = _get_int_setting(conn, 'message_retention_days')
+    overrides = {
+        r['id']: r['retention_days'] for r in conn.execute(
+            'SELECT id, retention_days FROM conversations WHERE retention_days IS NOT NULL'
+        ).fetchall()
     }
+    return global_days, overrides
+
+
+def purge_expired_messages(batch_size=1000):
+    """
+    Delete one batch of messages past their retention period, from the hot table
+    and from the archives. A per-conversation retention_days overrides the global
+    `message_retention_days` (0 = keep forever).
+    Returns the number of messages deleted; call repeatedly until it returns 0.
+    """
+    now = time.time()
+    with db_conn() as conn:
+        global_days, overrides = _retention_policies(conn)
+        # (sql condition, params) pairs describing expired rows; {overridden} is
+        # filled in per database (see _OVERRIDDEN_HOT)
+        rules = []
+        if global_days > 0:
+            cond = 'timestamp < ?'
+            if overrides:
+                cond += ' AND conversation_id NOT IN {overridden}'
+            rules.append((cond, [now - global_days * 86400]))
+        for conv_id, days in overrides.items():
+            if days > 0:
+                rules.append(('conversation_id = ? AND timestamp < ?', [conv_id, now - days * 86400]))
+    if not rules:
+        return 0
+
+    deleted = 0
+    for conn in _each_message_db():
+        ids = []
+        for cond, params in rules:
+            if deleted + len(ids) >= batch_size:
+                break
+            ids += [r['id'] for r in conn.execute(
+                f'SELECT id FROM messages WHERE {cond.format(overridden=_OVERRIDDEN_HOT)} LIMIT ?',
+                params + [batch_size - deleted - len(ids)]
+            ).fetchall()]
+        if ids:
+            id_params = [(i,) for i in ids]
+            conn.executemany('DELETE FROM favorite_messages WHERE message_id = ?', id_params)
+            conn.executemany('DELETE FROM pinned_messages WHERE message_id = ?', id_params)
+            conn.executemany('DELETE FROM messages WHERE id = ?', id_params)
+            conn.commit()
+            deleted += len(ids)
+            if deleted >= batch_size:
+                break
+    if deleted:
+        return deleted
+
+    # Hot tables are clean; archives are separate files, so purge them whole-rule at a time.
+    for month_key, path in _list_archives():
+        arc = _open_archive(month_key, write=True)
+        try:
+            arc.execute('CREATE TEMP TABLE retention_overrides (id INTEGER PRIMARY KEY)')
+            arc.executemany('INSERT INTO temp.retention_overrides (id) VALUES (?)', [(i,) for i in overrides])
+            for cond, params in rules:
+                deleted += arc.execute(
+                    f'DELETE FROM archived_messages WHERE {cond.format(overridden=_OVERRIDDEN_ARCHIVE)}', params
+                ).rowcount
+            arc.commit()
+            empty = arc.execute('SELECT 1 FROM archived_messages LIMIT 1').fetchone() is None
+        finally:
+            arc.close()
+        if empty:
+            os.remove(path)
+            _archives_changed()
+    return deleted
+
+
+def set_conversation_retention(conv_id, retention_days):
+    """Admin: per-conversation retention override in days. None = follow the global policy."""
+    with db_conn() as conn:
+        conn.execute('UPDATE conversations SET retention_days = ? WHERE id = ?', (retention_days, conv_id))
+        conn.commit()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Sliced delivery of broadcasts to large rooms.
+
+Emitting to a room writes one packet per socket in a single call, so a
+broadcast to a 5,000-member group holds the hub for the whole loop while every
+small conversation waits.  Broadcasts to rooms with more than FANOUT_LARGE_ROOM
+sockets are queued here instead and delivered FANOUT_SLICE sockets at a time;
+step() serves one slice of every room with pending work in turn, so a busy
+large room cannot starve the others, and the caller yields between steps.
+
+Events of one room keep their order: once a room has queued work, later
+broadcasts to it are queued behind it whatever its size.  saturated() reports
+more than FANOUT_MAX_PENDING queued broadcasts; callers refuse new messages
+for large rooms (the client retries) and drop lightweight events meanwhile.
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+
+FANOUT_LARGE_ROOM  = int(os.environ.get('FANOUT_LARGE_ROOM', '200'))    # sockets
+FANOUT_SLICE       = int(os.environ.get('FANOUT_SLICE', '200'))         # sockets per delivery step
+FANOUT_MAX_PENDING = int(os.environ.get('FANOUT_MAX_PENDING', '500'))   # queued broadcasts
+
+
+class FanoutQueue:
+    def __init__(self, send, slice_size=FANOUT_SLICE, max_pending=FANOUT_MAX_PENDING):
+        self._send = send          # send(event, payload, sids)
+        self.slice_size = slice_size
+        self.max_pending = max_pending
+        self._rooms = OrderedDict()   # room -> deque of [event, payload, sids not yet served]
+        self.pending = 0
+        self.delivered = 0
+        self._lock = threading.Lock()
+
+    def queued(self, room):
+        with self._lock:
+            return room in self._rooms
+
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    def submit(self, room, event, payload, sids):
+        with self._lock:
+            self._rooms.setdefault(room, deque()).append([event, payload, list(sids)])
+            self.pending += 1
+
+    def step(self):
+        """Deliver one slice for every room with queued work. Returns the number of sockets served."""
+        with self._lock:
+            work = []
+            for room, queue in list(self._rooms.items()):
+                item = queue[0]
+                sids = item[2][:self.slice_size]
+                del item[2][:self.slice_size]
+                if not item[2]:
+                    queue.popleft()
+                    self.pending -= 1
+                    if not queue:
+                        del self._rooms[room]
+                work.append((item[0], item[1], sids))
+        for event, payload, sids in work:
+            if sids:
+                self._send(event, payload, sids)
+        served = sum(len(sids) for _, _, sids in work)
+        self.delivered += served
+        return served
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'pending': self.pending, 'delivered': self.delivered}
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-rendered composite avatars for groups without an uploaded one.
+
+The composite is a 2x2 grid of the group's first GROUP_AVATAR_CELLS members in
+user id order, rendered as a small SVG: uploaded member avatars are embedded as
+thumbnails, everyone else gets a tile with their emoji or initial, the same as
+the old client-side grid.  Files are named after a hash of their content, so an
+URL never changes meaning, can be cached forever, and groups whose first
+members look the same share one file.
+
+Rendering runs on its own one-thread pool; database triggers mark the groups
+whose composite may have changed (see database.dirty_group_avatars).
+
+Pillow is optional.  With it, uploaded avatars are cropped to a 48px JPEG
+before embedding; without it an upload is embedded as-is when it is at most
+EMBED_MAX_BYTES, otherwise the member gets an initial tile.
+"""
+import base64
+import hashlib
+import os
+import time
+from io import BytesIO
+from xml.sax.saxutils import escape, quoteattr
+
+from offload import BoundedPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GROUP_AVATAR_DIR = os.path.join(BASE_DIR, 'static', 'avatars', 'groups')
+GROUP_AVATAR_URL = '/static/avatars/groups/'
+GROUP_AVATAR_CELLS = 4
+GROUP_AVATAR_BATCH = 100        # groups rendered per pass
+GROUP_AVATAR_GC_AGE = 86400     # unreferenced files older than this (seconds) are removed
+EMBED_MAX_BYTES = 48 * 1024     # largest upload embedded unscaled when Pillow is missing
+THUMB_SIZE = 48
+
+_SIZE = 96
+_CELL = 47   # two cells and a 2px gap per row
+_MIME = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+         '.gif': 'image/gif', '.webp': 'image/webp'}
+
+pool = BoundedPool('avatars', 1, 1)
+
+
+def _token(member):
+    emoji = member.get('avatar_emoji')
+    if emoji and emoji != '😊':
+        return emoji
+    return (member.get('username') or '?')[:1].upper()
+
+
+def _thumbnail(avatar_url):
+    """data: URI for an uploaded avatar, or None when it cannot be embedded."""
+    if not avatar_url or not avatar_url.startswith('/static/uploads/') or '..' in avatar_url:
+        return None
+    path = os.path.join(BASE_DIR, avatar_url.lstrip('/'))
+    mime = _MIME.get(os.path.splitext(path)[1].lower())
+    if not mime or not os.path.isfile(path):
+        return None
+    if Image is not None:
+        try:
+            with Image.open(path) as img:
+                thumb = ImageOps.fit(img.convert('RGB'), (THUMB_SIZE, THUMB_SIZE))
+            buf = BytesIO()
+            thumb.save(buf, 'JPEG', quality=85)
+            return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode()
+        except (OSError, ValueError):
+            return None
+    if os.path.getsize(path) > EMBED_MAX_BYTES:
+        return None
+    with open(path, 'rb') as f:
+        return f'data:{mime};base64,' + base64.b64encode(f.read()).decode()
+
+
+def render(members):
+    """SVG bytes of the composite for the given members (only the first GROUP_AVATAR_CELLS are drawn)."""
+    cells = []
+    for i, member in enumerate(members[:GROUP_AVATAR_CELLS]):
+        x, y = (i % 2) * (_CELL + 2), (i // 2) * (_CELL + 2)
+        image = _thumbnail(member.get('avatar_url'))
+        if image:
+            cells.append(f'<image href={quoteattr(image)} x="{x}" y="{y}" width="{_CELL}" height="{_CELL}" '
+                         f'preserveAspectRatio="xMidYMid slice"/>')
+        else:
+            cells.append(f'<rect x="{x}" y="{y}" width="{_CELL}" height="{_CELL}" fill="#D1FAE5"/>'
+                         f'<text x="{x + _CELL / 2}" y="{y + _CELL / 2}" font-size="22" fill="#065F46" '
+                         f'text-anchor="middle" dominant-baseline="central" '
+                         f'font-family="sans-serif">{escape(_token(member))}</text>')
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{_SIZE}" height="{_SIZE}" '
+            f'viewBox="0 0 {_SIZE} {_SIZE}"><clipPath id="c"><circle cx="48" cy="48" r="48"/></clipPath>'
+            f'<g clip-path="url(#c)"><rect width="{_SIZE}" height="{_SIZE}" fill="#E2E8F0"/>'
+            + ''.join(cells) + '</g></svg>').encode()
+
+
+def store(members):
+    """Render and write the composite if it is not on disk yet. Returns its URL."""
+    data = render(members)
+    name = hashlib.sha256(data).hexdigest()[:20] + '.svg'
+    path = os.path.join(GROUP_AVATAR_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(GROUP_AVATAR_DIR, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return GROUP_AVATAR_URL + name
+
+
+def store_all(groups):
+    """{conversation id: URL} for [{'id', 'members'}]."""
+    return {g['id']: store(g['members']) for g in groups}
+
+
+def collect_garbage(in_use, min_age=GROUP_AVATAR_GC_AGE):
+    """Delete composites no group refers to any more. Returns how many were removed."""
+    if not os.path.isdir(GROUP_AVATAR_DIR):
+        return 0
+    keep = {url[len(GROUP_AVATAR_URL):] for url in in_use if url}
+    cutoff = time.time() - min_age
+    removed = 0
+    for entry in os.scandir(GROUP_AVATAR_DIR):
+        if entry.name not in keep and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+            removed += 1
+    return removed
@@ -0,0 +1,216 @@
+"""
+Socket.IO 压测工具
+模拟 N 个用户：通过 /api/login 登录、建立 Socket.IO 连接，按设定速率向各自的私聊和群聊发消息，
+统计端到端扇出延迟分位数、消息吞吐和错误率。
+用户需预先用 seed_db.py 生成（用户名 {prefix}000001 起，密码相同）。
+
+用法:
+  python seed_db.py --users 2000 --groups 100 --large-groups 4
+  RATELIMIT_ENABLED=0 python app.py
+  python loadtest.py --url http://127.0.0.1:5000 --users 1000 --rate 0.2 --duration 60
+
+依赖: pip install "python-socketio[client]"
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import random
+import time
+import urllib.request
+from http.cookiejar import CookieJar
+
+import gevent
+from gevent.pool import Pool
+
+try:
+    import socketio
+    import websocket  # noqa: F401  websocket-client, python-socketio's websocket transport
+except ImportError:
+    raise SystemExit('缺少依赖，请先安装: pip install "python-socketio[client]"')
+
+MARKER = 'lt'
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.echoed = 0
+        self.delivered = 0
+        self.fanout_latency = []   # seconds, sender emit -> another member receives it
+        self.echo_latency = []     # seconds, sender emit -> sender receives its own message
+        self.errors = {}
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class SimClient:
+    def __init__(self, idx, username, args, stats):
+        self.idx = idx
+        self.username = username
+        self.args = args
+        self.stats = stats
+        self.user_id = None
+        self.groups = []
+        self.privates = []
+        self.sio = None
+        self.seq = 0
+        self.stopping = False
+        self.jar = CookieJar()
+        self.http = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar))
+
+    def _request(self, path, body=None):
+        req = urllib.request.Request(
+            self.args.url + path,
+            data=json.dumps(body).encode() if body is not None else None,
+            headers={'Content-Type': 'application/json', 'Origin': self.args.url},
+        )
+        with self.http.open(req, timeout=30) as resp:
+            return json.loads(resp.read())
+
+    def start(self):
+        try:
+            data = self._request('/api/login', {'username': self.username, 'password': self.args.password})
+        except Exception:
+            return self.stats.error('login')
+        if not data.get('ok'):
+            return self.stats.error('login')
+        self.user_id = data['user']['id']
+        try:
+            convs = self._request('/api/conversations')['conversations']
+        except Exception:
+            return self.stats.error('conversations')
+        self.groups = [c['id'] for c in convs if c['is_group']]
+        self.privates = [c['id'] for c in convs if not c['is_group'] and not c.get('is_self_chat')]
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('new_message', self.on_message)
+        self.sio.on('server_busy', lambda data: self.stats.error('server_busy'))
+        self.sio.on('disconnect', self.on_disconnect)
+        cookie = '; '.join(f'{c.name}={c.value}' for c in self.jar)
+        try:
+            self.sio.connect(self.args.url, headers={'Cookie': cookie}, transports=['websocket'])
+        except Exception:
+            self.sio = None
+            return self.stats.error('connect')
+
+    def on_disconnect(self, *args):
+        if not self.stopping:
+            self.stats.error('disconnect')
+
+    def on_message(self, msg):
+        parts = msg.get('content', '').split(' ', 4)
+        if len(parts) < 4 or parts[0] != MARKER:
+            return
+        latency = time.time() - float(parts[3])
+        if msg.get('sender_id') == self.user_id:
+            self.stats.echoed += 1
+            self.stats.echo_latency.append(latency)
+        else:
+            self.stats.delivered += 1
+            self.stats.fanout_latency.append(latency)
+
+    def send_loop(self, until):
+        rng = random.Random(self.idx)
+        filler = 'x' * self.args.payload
+        while self.sio and time.time() < until:
+            gevent.sleep(rng.expovariate(self.args.rate))
+            if self.groups and (not self.privates or rng.random() < self.args.group_share):
+                conv_id = rng.choice(self.groups)
+            elif self.privates:
+                conv_id = rng.choice(self.privates)
+            else:
+                return
+            self.seq += 1
+            content = f'{MARKER} {self.idx} {self.seq} {time.time():.6f} {filler}'
+            try:
+                self.sio.emit('send_message', {'conversation_id': conv_id, 'content': content})
+                self.stats.sent += 1
+            except Exception:
+                self.stats.error('send')
+
+    def stop(self):
+        self.stopping = True
+        if self.sio:
+            self.sio.disconnect()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(args):
+    stats = Stats()
+    clients = [SimClient(i, f'{args.prefix}{i:06d}', args, stats) for i in range(1, args.users + 1)]
+
+    print(f'登录并连接 {len(clients)} 个用户（并发 {args.login_concurrency}）...')
+    t0 = time.time()
+    Pool(args.login_concurrency).map(lambda c: c.start(), clients)
+    connected = [c for c in clients if c.sio]
+    print(f'已连接 {len(connected)}/{len(clients)}，用时 {time.time() - t0:.1f}s')
+
+    print(f'发送中：每用户 {args.rate}/s，持续 {args.duration}s ...')
+    started = time.time()
+    until = started + args.duration
+    gevent.joinall([gevent.spawn(c.send_loop, until) for c in connected])
+    gevent.sleep(args.drain)   # let in-flight fan-out arrive
+    elapsed = time.time() - started
+    for c in connected:
+        c.stop()
+
+    fan = stats.fanout_latency
+    echo = stats.echo_latency
+    result = {
+        'users': len(clients),
+        'connected': len(connected),
+        'duration_s': round(elapsed, 2),
+        'sent': stats.sent,
+        'sent_per_s': round(stats.sent / args.duration, 1),
+        'echoed': stats.echoed,
+        'lost': max(stats.sent - stats.echoed, 0),
+        'delivered': stats.delivered,
+        'delivered_per_s': round(stats.delivered / args.duration, 1),
+        'fanout_ms': {f'p{p}': round(percentile(fan, p) * 1000, 1) for p in (50, 90, 99)},
+        'echo_ms': {f'p{p}': round(percentile(echo, p) * 1000, 1) for p in (50, 90, 99)},
+        'errors': stats.errors,
+        'error_rate': round(sum(stats.errors.values()) / max(stats.sent + len(clients), 1), 4),
+    }
+    result['fanout_ms']['max'] = round(max(fan, default=0) * 1000, 1)
+    result['echo_ms']['max'] = round(max(echo, default=0) * 1000, 1)
+
+    print('=' * 50)
+    print(f"发送: {result['sent']}（{result['sent_per_s']}/s）  回显: {result['echoed']}  丢失: {result['lost']}")
+    print(f"扇出投递: {result['delivered']}（{result['delivered_per_s']}/s）")
+    print(f"扇出延迟 ms: {result['fanout_ms']}")
+    print(f"回显延迟 ms: {result['echo_ms']}")
+    print(f"错误: {result['errors'] or '无'}  错误率: {result['error_rate']:.2%}")
+    print('=' * 50)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    return result
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='Socket.IO 聊天压测')
+    p.add_argument('--url', default='http://127.0.0.1:5000')
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--prefix', default='load', help='与 seed_db.py --prefix 一致')
+    p.add_argument('--password', default='loadtest123')
+    p.add_argument('--rate', type=float, default=0.2, help='每个用户每秒发送消息数')
+    p.add_argument('--group-share', type=float, default=0.5, help='发往群聊的消息比例')
+    p.add_argument('--payload', type=int, default=40, help='消息填充字节数')
+    p.add_argument('--duration', type=float, default=30)
+    p.add_argument('--drain', type=float, default=3, help='结束后等待在途消息的秒数')
+    p.add_argument('--login-concurrency', type=int, default=20)
+    p.add_argument('--json', help='把结果写入 JSON 文件')
+    return p
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters and histograms are plain dicts keyed by label values behind one
+uncontended lock each, so recording costs a dict lookup and an add and can stay
+on in production.  Values that already live elsewhere (online_users, pool and
+lock-wait stats) are read at scrape time through Callback metrics instead of
+being mirrored on every change.
+
+    REQUESTS = metrics.Counter('chat_http_requests_total', 'HTTP requests', ('route', 'status'))
+    REQUESTS.inc('/api/me', '200')
+    metrics.render()   # -> text for GET /metrics
+"""
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f'{self.name}{_labels(self.labels, k)} {_number(v)}' for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    def collect(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = self._header()
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), series):
+                cumulative += n
+                le = 'le="%s"' % _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(series[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Callback(_Metric):
+    """
+    A gauge or counter whose value is computed at scrape time.  `fn` returns a
+    number, or a dict of {label value tuple: number} when `labels` is given.
+    """
+
+    def __init__(self, name, help, fn, labels=(), kind='gauge'):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self._fn = fn
+
+    def collect(self):
+        value = self._fn()
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        return self._header() + [f'{self.name}{_labels(self.labels, k)} {_number(v)}' for k, v in items]
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
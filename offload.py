@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded native-thread pools for work that must not run on the gevent hub.
+
+Under async_mode='gevent' every HTTP request and socket handler is a greenlet on
+one native thread, so a C call that never yields (argon2, a sqlite lock wait)
+freezes every connection in the process.  BoundedPool hands such calls to a
+gevent ThreadPool so only the calling greenlet waits, and refuses new work with
+PoolBusy once max_pending calls are already queued or running.  With a deadline,
+the caller gives up after that many seconds with PoolTimeout (the worker thread
+cannot be interrupted, so its slot stays taken until the call really returns).
+"""
+import contextvars
+import functools
+import threading
+import time
+
+
+class PoolBusy(Exception):
+    """Raised by BoundedPool.run when the pool is saturated."""
+
+    def __init__(self, pool_name):
+        super().__init__(f'{pool_name} pool is saturated')
+        self.pool_name = pool_name
+
+
+class PoolTimeout(PoolBusy):
+    """Raised by BoundedPool.run when a call exceeds the pool's deadline."""
+
+    def __init__(self, pool_name, deadline):
+        Exception.__init__(self, f'{pool_name} call exceeded {deadline}s')
+        self.pool_name = pool_name
+
+
+class WaitStats:
+    """Thread-safe count / total / max of durations, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {'count': self.count, 'total_s': round(self.total, 6), 'max_s': round(self.max, 6)}
+
+
+class BoundedPool:
+    def __init__(self, name, size, max_pending, deadline=None):
+        self.name = name
+        self.size = size
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.queue_wait = WaitStats()   # submit -> a worker picks the call up
+        self.rejected = 0
+        self.timeouts = 0
+        self._pool = None
+        self._owner = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Create the worker threads. Must be called from the thread that runs the hub."""
+        from gevent.threadpool import ThreadPool
+        self._pool = ThreadPool(self.size)
+        self._owner = threading.get_ident()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'pending': self._pending,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'queue_wait': self.queue_wait.snapshot(),
+        }
+
+    def _release(self, _result):
+        with self._lock:
+            self._pending -= 1
+
+    def _reserve(self, n):
+        with self._lock:
+            if self._pending + n > self.max_pending:
+                self.rejected += 1
+                raise PoolBusy(self.name)
+            self._pending += n
+
+    def _submit(self, fn, *args, **kwargs):
+        submitted = time.monotonic()
+        ctx = contextvars.copy_context()   # request-scoped context vars follow the call
+
+        def call():
+            self.queue_wait.add(time.monotonic() - submitted)
+            # Hand exceptions back as values: gevent would print a traceback for
+            # every one raised in a worker, even those the caller handles.
+            try:
+                return True, ctx.run(fn, *args, **kwargs)
+            except Exception as e:
+                return False, e
+
+        try:
+            result = self._pool.spawn(call)
+        except BaseException:
+            self._release(None)
+            raise
+        result.rawlink(self._release)
+        return result
+
+    def _wait(self, result):
+        result.wait(self.deadline)
+        if not result.ready():
+            self.timeouts += 1
+            raise PoolTimeout(self.name, self.deadline)
+        ok, value = result.get()
+        if not ok:
+            raise value
+        return value
+
+    def run(self, fn, *args, **kwargs):
+        # Not started (CLI scripts, threading dev server) or already on a native
+        # worker thread: blocking here only blocks this thread, so call directly.
+        if self._pool is None or threading.get_ident() != self._owner:
+            return fn(*args, **kwargs)
+        self._reserve(1)
+        return self._wait(self._submit(fn, *args, **kwargs))
+
+    def map(self, fn, items):
+        """
+        fn(item) for every item, all submitted at once so up to `size` run in
+        parallel; returns the results in order and re-raises the first exception.
+        The whole batch is refused with PoolBusy if it does not fit in max_pending.
+        """
+        items = list(items)
+        if self._pool is None or threading.get_ident() != self._owner:
+            return [fn(item) for item in items]
+        self._reserve(len(items))
+        results = []
+        for i, item in enumerate(items):
+            try:
+                results.append(self._submit(fn, item))
+            except BaseException:
+                for _ in items[i + 1:]:   # never submitted: give their slots back
+                    self._release(None)
+                raise
+        return [self._wait(r) for r in results]
+
+
+class OffloadedModule:
+    """
+    Attribute proxy for a module whose functions block: calling a function through
+    the proxy runs it on `pool`.  Names in `exempt`, private names, classes and
+    non-callables are returned as-is.  With `observe`, every public function call
+    (exempt ones included) reports observe(name, seconds, failed) when it returns.
+    """
+
+    def __init__(self, module, pool, exempt=(), observe=None):
+        self._module = module
+        self._pool = pool
+        self._exempt = frozenset(exempt)
+        self._observe = observe
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if name.startswith('_') or not callable(attr) or isinstance(attr, type):
+            return attr
+        observe = self._observe
+        if name in self._exempt:
+            if observe is None:
+                return attr
+            call = attr
+        else:
+            call = functools.partial(self._pool.run, attr)
+
+        def offloaded(*args, **kwargs):
+            if observe is None:
+                return call(*args, **kwargs)
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = call(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(name, time.perf_counter() - start, failed)
+        offloaded.__name__ = name
+        offloaded.__wrapped__ = attr
+        self.__dict__[name] = offloaded
+        return offloaded
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""argon2id password hashing, executed in a bounded worker pool off the gevent hub."""
+import os
+from argon2 import PasswordHasher, Type
+from argon2.exceptions import VerificationError, InvalidHashError
+from offload import BoundedPool
+
+# argon2id cost parameters. Changing them is safe: existing hashes still verify and
+# are transparently re-hashed with the new parameters on the user's next login.
+ARGON2_TIME_COST   = int(os.environ.get('ARGON2_TIME_COST', '3'))
+ARGON2_MEMORY_KIB  = int(os.environ.get('ARGON2_MEMORY_KIB', '65536'))   # 64 MiB
+ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', '4'))
+
+# Worker threads hashing concurrently, and how many calls may wait before we shed load.
+HASH_WORKERS     = int(os.environ.get('HASH_WORKERS', '2'))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', '32'))
+
+# Bulk imports hash on their own pool so they never queue ahead of logins.
+# argon2 releases the GIL while hashing, so threads use every core.
+BULK_HASH_WORKERS = int(os.environ.get('BULK_HASH_WORKERS', str(os.cpu_count() or 2)))
+BULK_HASH_BATCH   = 64    # passwords hashed per map() call
+
+_ph = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_KIB,
+    parallelism=ARGON2_PARALLELISM,
+    type=Type.ID,
+)
+
+pool = BoundedPool('argon2', HASH_WORKERS, HASH_MAX_PENDING)
+bulk_pool = BoundedPool('argon2-bulk', BULK_HASH_WORKERS, BULK_HASH_BATCH)
+
+
+def _verify(password_hash, password):
+    try:
+        _ph.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False, False
+    return True, _ph.check_needs_rehash(password_hash)
+
+
+def hash_password(password):
+    """Return an argon2id hash using the configured parameters. May raise PoolBusy."""
+    return pool.run(_ph.hash, password)
+
+
+def verify_password(password_hash, password):
+    """Return (ok, needs_rehash). May raise PoolBusy."""
+    return pool.run(_verify, password_hash, password)
+
+
+def hash_passwords(passwords):
+    """Hash up to BULK_HASH_BATCH passwords in parallel on the bulk pool. Returns the hashes in order."""
+    return bulk_pool.map(_ph.hash, passwords)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Online / last-seen tracking for logged-in users.
+
+A user is online while at least one of their sockets is connected.  When the
+last one goes away the user stays online for PRESENCE_GRACE seconds, so a page
+reload or a Wi-Fi switch that reconnects in time never shows up as a flap.
+
+Nothing is broadcast to friends or rooms.  A socket subscribes to the users it
+displays (watch), and every PRESENCE_FLUSH seconds flush() returns the state
+changes since the previous flush, grouped per watching socket, so each viewer
+gets at most one batched update per interval.  A user whose state flipped and
+flipped back within one interval is not reported at all.
+"""
+import os
+import threading
+import time
+
+PRESENCE_GRACE     = float(os.environ.get('PRESENCE_GRACE', '15'))   # seconds offline before it counts
+PRESENCE_FLUSH     = float(os.environ.get('PRESENCE_FLUSH', '2'))    # seconds between batched updates
+PRESENCE_MAX_WATCH = 500                                             # users one socket may watch
+
+
+class Presence:
+    def __init__(self, grace=PRESENCE_GRACE, max_watch=PRESENCE_MAX_WATCH):
+        self.grace = grace
+        self.max_watch = max_watch
+        self._online = set()      # users currently counted as online
+        self._announced = set()   # users watchers were last told are online
+        self._leaving = {}        # user id -> when its last socket disconnected
+        self._last_seen = {}      # user id -> when it went offline (this process)
+        self._changed = set()
+        self._watchers = {}       # user id -> sids watching it
+        self._watching = {}       # sid -> user ids it watches
+        self._lock = threading.Lock()
+
+    def connected(self, user_id):
+        """The user's first socket connected."""
+        with self._lock:
+            if self._leaving.pop(user_id, None) is not None:
+                return   # back within the grace period: never went offline
+            if user_id not in self._online:
+                self._online.add(user_id)
+                self._changed.add(user_id)
+
+    def disconnected(self, user_id, now=None):
+        """The user's last socket disconnected; it goes offline once the grace period passes."""
+        with self._lock:
+            if user_id in self._online:
+                self._leaving[user_id] = now or time.time()
+
+    def status(self, user_ids):
+        """{user_id: {'online', 'last_seen'}}; last_seen is None when only the database knows it."""
+        with self._lock:
+            return {uid: {'online': uid in self._online, 'last_seen': self._last_seen.get(uid)}
+                    for uid in user_ids}
+
+    def watch(self, sid, user_ids):
+        """Replace the set of users socket `sid` gets updates for. Returns the ids kept."""
+        user_ids = list(dict.fromkeys(user_ids))[:self.max_watch]
+        with self._lock:
+            self._unwatch(sid)
+            if user_ids:
+                self._watching[sid] = set(user_ids)
+                for uid in user_ids:
+                    self._watchers.setdefault(uid, set()).add(sid)
+        return user_ids
+
+    def unwatch(self, sid):
+        with self._lock:
+            self._unwatch(sid)
+
+    def _unwatch(self, sid):
+        for uid in self._watching.pop(sid, ()):
+            sids = self._watchers.get(uid)
+            if sids:
+                sids.discard(sid)
+                if not sids:
+                    del self._watchers[uid]
+
+    def flush(self, now=None):
+        """
+        Settle expired grace periods and collect what changed since the last flush.
+        Returns ({sid: [update, ...]}, [(user_id, last_seen)] for users who went offline).
+        """
+        now = now or time.time()
+        went_offline = []
+        with self._lock:
+            for uid, since in list(self._leaving.items()):
+                if now - since >= self.grace:
+                    del self._leaving[uid]
+                    self._online.discard(uid)
+                    self._last_seen[uid] = since
+                    self._changed.add(uid)
+                    went_offline.append((uid, since))
+            batches = {}
+            for uid in self._changed:
+                online = uid in self._online
+                if online == (uid in self._announced):
+                    continue
+                if online:
+                    self._announced.add(uid)
+                else:
+                    self._announced.discard(uid)
+                update = {'user_id': uid, 'online': online, 'last_seen': None if online else self._last_seen[uid]}
+                for sid in self._watchers.get(uid, ()):
+                    batches.setdefault(sid, []).append(update)
+            self._changed.clear()
+        return batches, went_offline
+
+    def stats(self):
+        with self._lock:
+            return {'online': len(self._online), 'leaving': len(self._leaving), 'watching': len(self._watching)}
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Production profiling aids for the gevent server.
+
+SamplingProfiler - a native thread that snapshots every thread's Python stack
+                   (sys._current_frames) at a fixed interval.  On the hub thread
+                   the snapshot is whatever greenlet is running at that moment,
+                   so over N seconds the samples show where the hub spends its
+                   time across all greenlets.  Output is the collapsed-stack
+                   format read by flamegraph.pl / speedscope / inferno.
+
+Hub monitor      - gevent's own monitor thread (gevent.config.monitor_thread)
+                   reports when one greenlet holds the hub longer than
+                   HUB_BLOCK_MS; the report, with stack traces, is logged and
+                   counted for the admin stats.
+"""
+import logging
+import os
+import sys
+import threading
+import warnings
+from collections import Counter
+
+HUB_BLOCK_MS = float(os.environ.get('HUB_BLOCK_MS', '500'))   # 0 disables the blocked-hub monitor
+MAX_SECONDS = 120
+MIN_INTERVAL_MS = 1
+
+logger = logging.getLogger('chat.profiler')
+
+hub_block_count = 0
+_monitor_started = False
+
+
+def _label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        # The thread running the hub (and every greenlet) is the one that created us.
+        self._hub_ident = threading.get_ident()
+
+    def start(self):
+        # A real thread: the app does not monkey-patch, so threading is native.
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                root = 'hub' if ident == self._hub_ident else 'native-thread'
+                stack.append(root)
+                self._stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """One `root;outer;...;inner count` line per distinct stack, busiest first."""
+        return ''.join(f'{";".join(stack)} {n}\n' for stack, n in self._stacks.most_common())
+
+
+_busy = threading.Lock()
+
+
+def profile(seconds, interval_ms, sleep):
+    """
+    Sample for `seconds` and return the collapsed stacks, or None if another
+    profile is already running.  `sleep` must yield to the hub (socketio.sleep).
+    """
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        profiler = SamplingProfiler(max(interval_ms, MIN_INTERVAL_MS) / 1000)
+        profiler.start()
+        try:
+            sleep(min(seconds, MAX_SECONDS))
+        finally:
+            profiler.stop()
+        logger.info('Sampling profile: %d samples over %ss', profiler.samples, seconds)
+        return profiler.collapsed()
+    finally:
+        _busy.release()
+
+
+def _on_gevent_event(event):
+    global hub_block_count
+    from gevent.events import EventLoopBlocked
+    if not isinstance(event, EventLoopBlocked):
+        return
+    hub_block_count += 1
+    report = '\n'.join(event.info)
+    logger.warning('Hub blocked for more than %.0fms by %r\n%s', HUB_BLOCK_MS, event.greenlet, report)
+
+
+def start_hub_monitor():
+    """Turn on gevent's blocked-hub monitor for the current hub. Returns False when disabled."""
+    global _monitor_started
+    if HUB_BLOCK_MS <= 0 or _monitor_started:
+        return _monitor_started
+    import gevent
+    import gevent.events
+    gevent.config.monitor_thread = True
+    gevent.config.max_blocking_time = HUB_BLOCK_MS / 1000
+    gevent.config.print_blocking_reports = False   # logged by _on_gevent_event instead
+    # The monitor also offers memory checks, which need psutil; we don't use them.
+    warnings.filterwarnings('ignore', message='Unable to monitor memory usage')
+    gevent.events.subscribers.append(_on_gevent_event)
+    gevent.get_hub().start_periodic_monitoring_thread()
+    _monitor_started = True
+    return True
+
+
+def hub_monitor_stats():
+    return {'enabled': _monitor_started, 'threshold_ms': HUB_BLOCK_MS, 'count': hub_block_count}
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Short per-room buffers of recent broadcasts, replayed to clients that reconnect.
+
+Every message event broadcast to a conversation room is numbered: seq grows by
+one per event in that room, and epoch names the buffer the numbers belong to.
+A reconnecting client sends the last (epoch, seq) it saw per room and gets the
+events after it.  When the buffer cannot answer (the process restarted, the
+room was evicted, or more than REPLAY_BUFFER events happened since) the epoch
+or the oldest kept seq no longer matches and the client falls back to a
+database sync instead.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+REPLAY_BUFFER    = int(os.environ.get('REPLAY_BUFFER', '100'))       # events kept per room
+REPLAY_MAX_ROOMS = int(os.environ.get('REPLAY_MAX_ROOMS', '10000'))  # least recently used rooms evicted
+
+_BOOT = uuid.uuid4().hex[:8]
+
+
+class _Room:
+    __slots__ = ('epoch', 'seq', 'events')
+
+    def __init__(self, epoch, size):
+        self.epoch = epoch
+        self.seq = 0
+        self.events = deque(maxlen=size)   # (seq, event, payload)
+
+
+class ReplayLog:
+    def __init__(self, size=REPLAY_BUFFER, max_rooms=REPLAY_MAX_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self._created = 0
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def _room(self, name):
+        room = self._rooms.get(name)
+        if room is None:
+            self._created += 1
+            room = self._rooms[name] = _Room(f'{_BOOT}.{self._created}', self.size)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+                self._evicted += 1
+        else:
+            self._rooms.move_to_end(name)
+        return room
+
+    def record(self, name, event, payload):
+        """Number an event about to be broadcast to room `name`. Returns the payload with epoch and seq added."""
+        with self._lock:
+            room = self._room(name)
+            room.seq += 1
+            payload = dict(payload, epoch=room.epoch, seq=room.seq)
+            room.events.append((room.seq, event, payload))
+        return payload
+
+    def _unborn(self):
+        # Position handed out for a room with nothing buffered.  A buffer created later
+        # covers everything since, unless some room was evicted meanwhile (maybe this one).
+        return f'{_BOOT}~{self._evicted}'
+
+    def position(self, name):
+        """(epoch, seq) of the latest event in room `name`."""
+        with self._lock:
+            room = self._rooms.get(name)
+            return (room.epoch, room.seq) if room else (self._unborn(), 0)
+
+    def since(self, name, epoch, seq):
+        """
+        Events of room `name` after `seq` as [(event, payload)], or None when the
+        buffer no longer covers them and the caller has to resync from the database.
+        """
+        with self._lock:
+            room = self._rooms.get(name)
+            if epoch == self._unborn() and seq == 0:
+                if room is None:
+                    return []
+            elif room is None or room.epoch != epoch or seq > room.seq:
+                return None
+            if seq == room.seq:
+                return []
+            if not room.events or room.events[0][0] > seq + 1:
+                return None
+            return [(event, payload) for s, event, payload in room.events if s > seq]
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'events': sum(len(r.events) for r in self._rooms.values())}
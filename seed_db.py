@@ -0,0 +1,199 @@
+"""
+测试数据生成工具
+批量生成用户、好友、私聊、群聊（含大群）、消息、收藏和文件记录，用于压测与基准测试。
+所有用户共用同一个密码（只计算一次 argon2 哈希），用户名为 {prefix}{序号:06d}，序号从 1 开始。
+目标数据库与应用一致：DB_PATH / DATABASE_URL / MESSAGE_SHARDS，也可用 --db 指定 SQLite 文件。
+用法: python seed_db.py --users 100000 --groups 10000 --messages 1000000
+"""
+import argparse
+import random
+import time
+
+import database
+import passwords
+
+WORDS = ('你好 今天 开会 收到 明天 项目 进度 文档 已经 更新 一下 看看 没问题 谢谢 周末 '
+         'ok thanks lunch deploy review merge bug fix meeting later tonight check').split()
+BATCH = 10000
+
+
+def _chunks(rows, size=BATCH):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def _text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 18)))
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    start = now - args.days * 86400
+    database.init_db()
+
+    with database.db_conn() as conn:
+        taken = conn.execute('SELECT 1 FROM users WHERE username = ?', (f'{args.prefix}{1:06d}',)).fetchone()
+    if taken:
+        raise SystemExit(f'用户 {args.prefix}000001 已存在，请换一个 --prefix')
+
+    print('计算密码哈希 ...')
+    password_hash = passwords.hash_password(args.password)
+
+    # ── Users ──────────────────────────────────────────────────────────────
+    usernames = [f'{args.prefix}{i:06d}' for i in range(1, args.users + 1)]
+    with database.db_conn() as conn:
+        for chunk in _chunks(usernames):
+            conn.executemany(
+                'INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)',
+                [(u, password_hash, start - rng.random() * 86400) for u in chunk]
+            )
+            conn.commit()
+        by_name = {}
+        for chunk in _chunks(usernames, 500):
+            rows = conn.execute(
+                f'SELECT id, username FROM users WHERE username IN ({", ".join("?" for _ in chunk)})', chunk
+            ).fetchall()
+            by_name.update((r['username'], r['id']) for r in rows)
+    user_ids = [by_name[u] for u in usernames]
+    print(f'用户: {len(user_ids)}')
+
+    # ── Conversations ──────────────────────────────────────────────────────
+    # (name, is_group, creator, members)
+    convs = []
+    pairs = set()
+    for uid in user_ids:
+        for _ in range(args.private_per_user):
+            other = rng.choice(user_ids)
+            pair = (min(uid, other), max(uid, other))
+            if other != uid and pair not in pairs:
+                pairs.add(pair)
+                convs.append((None, 0, uid, list(pair)))
+    for g in range(args.groups):
+        large = g < args.large_groups
+        size = min(len(user_ids), args.large_group_size if large else rng.randint(3, args.group_size))
+        members = rng.sample(user_ids, size)
+        convs.append((f'{"大群" if large else "群聊"}{g + 1}', 1, members[0], members))
+
+    with database.db_conn() as conn:
+        conv_ids = []
+        c = conn.cursor()
+        for name, is_group, creator, _ in convs:
+            c.execute(
+                'INSERT INTO conversations (name, is_group, is_self_chat, created_by, created_at) VALUES (?, ?, 0, ?, ?)',
+                (name, is_group, creator, start)
+            )
+            conv_ids.append(c.lastrowid)
+        conn.commit()
+        member_rows = [
+            (conv_id, uid, start, 'admin' if uid == creator and is_group else 'member')
+            for conv_id, (_, is_group, creator, members) in zip(conv_ids, convs)
+            for uid in members
+        ]
+        for chunk in _chunks(member_rows):
+            conn.executemany(
+                'INSERT INTO conversation_members (conversation_id, user_id, joined_at, role) VALUES (?, ?, ?, ?)', chunk
+            )
+            conn.commit()
+        friend_rows = [(a, b, a, 'accepted', start) for a, b in pairs]
+        for chunk in _chunks(friend_rows):
+            conn.executemany(
+                '''INSERT OR IGNORE INTO friends (requester_id, addressee_id, initiated_by, status, created_at)
+                   VALUES (?, ?, ?, ?, ?)''', chunk
+            )
+            conn.commit()
+    print(f'私聊: {len(pairs)}  群聊: {args.groups}（大群 {args.large_groups}）  成员关系: {len(member_rows)}')
+
+    # ── Messages ───────────────────────────────────────────────────────────
+    # Heavy-tailed activity: a few conversations carry most of the traffic.
+    weights = [rng.paretovariate(1.2) for _ in conv_ids]
+    members_of = {conv_id: conv[3] for conv_id, conv in zip(conv_ids, convs)}
+    step = (now - start) / max(args.messages, 1)
+    next_id = {}
+    favorites = []
+    written = 0
+    while written < args.messages:
+        n = min(BATCH, args.messages - written)
+        targets = rng.choices(conv_ids, weights, k=n)
+        by_shard = {}
+        for i, conv_id in enumerate(targets):
+            ts = start + (written + i) * step + rng.random() * step
+            sender = rng.choice(members_of[conv_id])
+            by_shard.setdefault(database._conv_shard(conv_id), []).append(
+                [conv_id, sender, _text(rng), 'text', ts, ts]
+            )
+        for shard, rows in by_shard.items():
+            with database._shard_conn(shard) as conn:
+                if shard is None:
+                    conn.executemany(
+                        'INSERT INTO messages (conversation_id, sender_id, content, msg_type, timestamp, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                        rows
+                    )
+                else:
+                    # Keep the shard's id % MESSAGE_SHARDS == shard invariant.
+                    if shard not in next_id:
+                        next_id[shard] = database._next_message_id(conn, shard)
+                    for row in rows:
+                        row.insert(0, next_id[shard])
+                        next_id[shard] += database.MESSAGE_SHARDS
+                    conn.executemany(
+                        'INSERT INTO messages (id, conversation_id, sender_id, content, msg_type, timestamp, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        rows
+                    )
+                conn.commit()
+        written += n
+        print(f'\r消息: {written}/{args.messages}', end='', flush=True)
+    print()
+
+    # ── Favorites & files ──────────────────────────────────────────────────
+    fav_count = int(args.messages * args.favorite_ratio)
+    if fav_count:
+        for conn in database._each_message_db():
+            ids = [r['id'] for r in conn.execute('SELECT id FROM messages ORDER BY RANDOM() LIMIT ?',
+                                                 (fav_count,)).fetchall()]
+            conn.executemany(
+                'INSERT OR IGNORE INTO favorite_messages (user_id, message_id, created_at) VALUES (?, ?, ?)',
+                [(rng.choice(user_ids), mid, now - rng.random() * 86400) for mid in ids]
+            )
+            conn.commit()
+            favorites.extend(ids)
+    file_rows = [
+        (uid, f'/static/uploads/seed_{uid}_{k}.bin', rng.randint(1_000, 20_000_000), now - rng.random() * 86400)
+        for uid in user_ids for k in range(args.files_per_user)
+    ]
+    with database.db_conn() as conn:
+        for chunk in _chunks(file_rows):
+            conn.executemany(
+                'INSERT INTO user_files (user_id, file_path, file_size, uploaded_at) VALUES (?, ?, ?, ?)', chunk
+            )
+            conn.commit()
+    print(f'收藏: {len(favorites)}  文件记录: {len(file_rows)}')
+    return user_ids, conv_ids
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description='生成压测/基准测试数据')
+    p.add_argument('--db', help='SQLite 数据库路径（默认使用 database.DB_PATH）')
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--groups', type=int, default=50)
+    p.add_argument('--group-size', type=int, default=50, help='普通群最大人数')
+    p.add_argument('--large-groups', type=int, default=2, help='其中大群数量')
+    p.add_argument('--large-group-size', type=int, default=500)
+    p.add_argument('--private-per-user', type=int, default=3, help='每个用户发起的私聊数')
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--days', type=float, default=30, help='消息时间跨度（天）')
+    p.add_argument('--favorite-ratio', type=float, default=0.001)
+    p.add_argument('--files-per-user', type=int, default=1)
+    p.add_argument('--password', default='loadtest123')
+    p.add_argument('--prefix', default='load')
+    p.add_argument('--seed', type=int, default=42)
+    return p
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    if args.db:
+        database.DB_PATH = args.db
+    t0 = time.time()
+    seed(args)
+    print(f'完成，用时 {time.time() - t0:.1f}s')
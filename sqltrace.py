@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-request SQL tracing, enabled with SQL_TRACE=1.
+
+app.py opens a Trace for every HTTP request and socket event; the cursors in
+db_backends report each statement here with its duration.  The trace lives in
+a context variable, which BoundedPool copies into its worker threads, so
+statements run on the database pool still land in the right trace.
+
+A finished trace is summarised (statement count, total time, slowest
+statements) and statements executed at least N_PLUS_ONE_MIN times with
+different parameters are flagged as N+1 patterns.  Recent summaries and slow
+statements are kept in memory for /api/admin/sql-trace.
+"""
+import contextvars
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+import applog
+
+ENABLED        = os.environ.get('SQL_TRACE', '0') == '1'
+SLOW_MS        = float(os.environ.get('SQL_SLOW_MS', '100'))      # slow-query log threshold
+N_PLUS_ONE_MIN = int(os.environ.get('SQL_N_PLUS_ONE_MIN', '5'))   # repeats before flagging N+1
+KEEP           = 200                                               # summaries / slow queries kept
+
+logger = logging.getLogger('chat.sql')
+
+recent = deque(maxlen=KEEP)
+slow_queries = deque(maxlen=KEEP)
+
+_current = contextvars.ContextVar('sql_trace', default=None)
+_INFRA_FILES = ('db_backends.py', 'sqltrace.py', 'offload.py')
+
+
+def _shorten(sql, limit=300):
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= limit else sql[:limit] + ' …'
+
+
+def _call_site():
+    """The innermost database.py frame issuing the statement, else the first non-infrastructure frame."""
+    frame = sys._getframe(2)
+    fallback = None
+    while frame is not None:
+        name = os.path.basename(frame.f_code.co_filename)
+        if name == 'database.py':
+            return f'{frame.f_code.co_name}:{frame.f_lineno}'
+        if fallback is None and name not in _INFRA_FILES:
+            fallback = f'{name[:-3]}.{frame.f_code.co_name}:{frame.f_lineno}'
+        frame = frame.f_back
+    return fallback or '?'
+
+
+class Trace:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.statements = []   # (sql, params, seconds, call site)
+
+    def summary(self):
+        groups = {}
+        for sql, params, seconds, site in self.statements:
+            g = groups.setdefault(sql, {'count': 0, 'params': set(), 'seconds': 0.0, 'site': site})
+            g['count'] += 1
+            g['seconds'] += seconds
+            try:
+                g['params'].add(params)
+            except TypeError:   # unhashable parameters: count them as distinct
+                g['params'].add(id(params))
+        n_plus_one = [
+            {'sql': _shorten(sql), 'count': g['count'], 'total_ms': round(g['seconds'] * 1000, 2), 'site': g['site']}
+            for sql, g in groups.items()
+            if g['count'] >= N_PLUS_ONE_MIN and len(g['params']) > 1
+        ]
+        n_plus_one.sort(key=lambda p: -p['count'])
+        slowest = sorted(self.statements, key=lambda s: -s[2])[:5]
+        return {
+            'label': self.label,
+            'at': self.started,
+            'queries': len(self.statements),
+            'distinct': len(groups),
+            'total_ms': round(sum(s[2] for s in self.statements) * 1000, 2),
+            'n_plus_one': n_plus_one,
+            'slowest': [{'sql': _shorten(sql), 'ms': round(seconds * 1000, 2), 'site': site}
+                        for sql, _, seconds, site in slowest],
+        }
+
+
+def begin(label):
+    """Start tracing the current request/event. Returns a token for end(), or None when disabled."""
+    if not ENABLED:
+        return None
+    return _current.set(Trace(label))
+
+
+def current():
+    return _current.get()
+
+
+def end(token):
+    """Finish the trace opened by begin(), record and return its summary."""
+    if token is None:
+        return None
+    trace = _current.get()
+    _current.reset(token)
+    if trace is None:
+        return None
+    summary = trace.summary()
+    recent.append(summary)
+    for p in summary['n_plus_one']:
+        logger.warning('N+1 in %s: %dx at %s: %s', trace.label, p['count'], p['site'], p['sql'],
+                       extra=applog.sampled('n_plus_one'))
+    return summary
+
+
+def record(sql, params, seconds):
+    """Called by the db_backends cursors for every statement while tracing is enabled."""
+    trace = _current.get()
+    site = _call_site()
+    if isinstance(params, list):
+        params = tuple(params)
+    if trace is not None:
+        trace.statements.append((sql, params, seconds, site))
+    if seconds * 1000 >= SLOW_MS:
+        label = trace.label if trace is not None else '-'
+        slow_queries.append({'at': time.time(), 'label': label, 'ms': round(seconds * 1000, 2),
+                             'site': site, 'sql': _shorten(sql)})
+        logger.warning('Slow query %.1fms in %s at %s: %s', seconds * 1000, label, site, _shorten(sql),
+                       extra=applog.sampled('slow_query'))
+
+
+def header_value(trace):
+    """Compact X-SQL-Trace header for the current trace."""
+    total = sum(s[2] for s in trace.statements) * 1000
+    summary = trace.summary() if len(trace.statements) >= N_PLUS_ONE_MIN else None
+    n_plus_one = len(summary['n_plus_one']) if summary else 0
+    return f'queries={len(trace.statements)}; time_ms={total:.2f}; n_plus_one={n_plus_one}'
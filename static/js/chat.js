@@ -45,9 +45,39 @@ function setAvatarEl(el, avatarUrl, avatarEmoji, username) {
     }
 }
 
-function renderIcons() {
-    if (window.lucide && typeof window.lucide.createIcons === 'function') {
-        window.lucide.createIcons();
+// Replace <i data-lucide> placeholders with SVGs.  Pass the freshly built
+// nodes as root when possible: without one, the whole document is scanned.
+// With the built sprite (body[data-icon-sprite]) each icon is a <use> of one
+// cached file; otherwise the Lucide runtime draws them.
+const ICON_SPRITE = document.body.dataset.iconSprite || '';
+const SVG_NS = 'http://www.w3.org/2000/svg';
+const ICON_ATTRS = {
+    width: 24, height: 24, viewBox: '0 0 24 24', fill: 'none', stroke: 'currentColor',
+    'stroke-width': 2, 'stroke-linecap': 'round', 'stroke-linejoin': 'round'
+};
+
+function renderIcons(root) {
+    if (!ICON_SPRITE) {
+        if (window.lucide && typeof window.lucide.createIcons === 'function') {
+            window.lucide.createIcons(root ? { root } : undefined);
+        }
+        return;
+    }
+    const scope = root || document;
+    const placeholders = [...scope.querySelectorAll('[data-lucide]')];
+    if (root && root.matches?.('[data-lucide]')) placeholders.push(root);
+    for (const el of placeholders) {
+        const name = el.getAttribute('data-lucide');
+        const svg = document.createElementNS(SVG_NS, 'svg');
+        for (const [key, value] of Object.entries(ICON_ATTRS)) svg.setAttribute(key, value);
+        for (const attr of el.attributes) {
+            if (attr.name !== 'data-lucide' && attr.name !== 'class') svg.setAttribute(attr.name, attr.value);
+        }
+        svg.setAttribute('class', `lucide lucide-${name} ${el.getAttribute('class') || ''}`.trim());
+        const use = document.createElementNS(SVG_NS, 'use');
+        use.setAttribute('href', `${ICON_SPRITE}#${name}`);
+        svg.appendChild(use);
+        el.replaceWith(svg);
     }
 }
 
@@ -67,16 +97,9 @@ function userAvatarHtml(user, className = 'avatar', style = '') {
     return `<span class="${className}"${styleAttr}>${escapeHtml(getAvatarToken(user?.avatar_emoji, user?.username))}</span>`;
 }
 
-function groupAvatarGridHtml(members) {
-    const shown = (members || []).slice(0, 4);
-    if (!shown.length) return '<div class="conv-avatar">群</div>';
-    const cells = shown.map((member) => {
-        if (member.avatar_url) {
-            return `<span class="conv-avatar-cell" style="background-image:url('${escapeAttr(member.avatar_url)}')"></span>`;
-        }
-        return `<span class="conv-avatar-cell-text">${escapeHtml(getAvatarToken(member.avatar_emoji, member.username))}</span>`;
-    }).join('');
-    return `<div class="conv-avatar conv-avatar-group"><div class="conv-avatar-grid">${cells}</div></div>`;
+// Uploaded group avatar, else the server-rendered composite of the first members.
+function groupAvatarUrl(group) {
+    return group.avatar_url || group.avatar_composite || '';
 }
 
 function conversationAvatarHtml(conv) {
@@ -88,10 +111,11 @@ function conversationAvatarHtml(conv) {
         }
         return `<div class="conv-avatar">${escapeHtml(getAvatarToken(other?.avatar_emoji, other?.username || conv.display_name))}</div>`;
     }
-    if (conv.avatar_url) {
-        return `<div class="conv-avatar"><img src="${escapeAttr(conv.avatar_url)}" style="width:100%;height:100%;object-fit:cover;border-radius:50%"></div>`;
+    const url = groupAvatarUrl(conv);
+    if (url) {
+        return `<div class="conv-avatar"><img src="${escapeAttr(url)}" style="width:100%;height:100%;object-fit:cover;border-radius:50%"></div>`;
     }
-    return groupAvatarGridHtml(conv.members || []);
+    return '<div class="conv-avatar">群</div>';
 }
 
 function hideContextMenu() {
@@ -101,13 +125,13 @@ function hideContextMenu() {
 }
 
 function setReplyTo(messageId) {
-    const row = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
-    if (!row) return;
+    const msg = findListedMessage(messageId);
+    if (!msg) return;
 
     replyToId = messageId;
-    const user = row.dataset.senderName;
-    const type = row.dataset.msgType;
-    let text = row.querySelector('.msg-bubble').innerText;
+    const user = msg.sender_name;
+    const type = msg.msg_type || 'text';
+    let text = msg.content || '';
     
     // Clean up text for preview
     if (type === 'image') text = '[图片]';
@@ -148,6 +172,10 @@ function bindContextMenus() {
     document.addEventListener('click', () => hideContextMenu());
     document.addEventListener('contextmenu', (event) => {
         const msgRow = event.target.closest('.msg-row');
+        if (msgRow && msgRow.dataset.pending) {
+            event.preventDefault();
+            return;
+        }
         if (msgRow) {
             event.preventDefault();
             const messageId = Number(msgRow.dataset.messageId);
@@ -159,7 +187,7 @@ function bindContextMenus() {
                 items.push({ icon: 'reply', label: '回复', action: `setReplyTo(${messageId});hideContextMenu();` });
                 items.push({ icon: 'star', label: '收藏', action: `toggleFavoriteMessage(${messageId});hideContextMenu();` });
                 items.push({ icon: 'forward', label: '转发', action: `forwardMessage(${messageId});hideContextMenu();` });
-                items.push({ icon: selectionMode && selectedMessageIds.has(messageId) ? 'square' : 'check-square', label: selectionMode ? (selectedMessageIds.has(messageId) ? '取消选择' : '选择此条') : '进入多选并选择', action: `toggleMessageSelection(${messageId});hideContextMenu();` });
+                items.push({ icon: selectionMode && selectedMessageIds.has(messageId) ? 'square' : 'square-check-big', label: selectionMode ? (selectedMessageIds.has(messageId) ? '取消选择' : '选择此条') : '进入多选并选择', action: `toggleMessageSelection(${messageId});hideContextMenu();` });
                 items.push({ icon: isPinned ? 'pin-off' : 'pin', label: isPinned ? '取消置顶' : '置顶消息', action: `${isPinned ? `unpinMessage(${messageId})` : `pinMessage(${messageId})`};hideContextMenu();` });
             }
             if (isMine && !isRevoked) {
@@ -198,6 +226,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     await loadConversations();
     await loadContacts();
     initSocket();
+    initMessageList();
+    loadOutbox();
     bindContextMenus();
     renderIcons();
 
@@ -278,33 +308,268 @@ function switchSidebarTab(tab) {
     }
 }
 
+// ===== Presence =====
+// Friends and private-chat partners are watched over the socket
+// (presence_subscribe) and kept current by batched `presence` events; one-off
+// lists such as the group member panel are filled from GET /api/presence.
+const PRESENCE_WATCH_MAX = 500;
+const PRESENCE_QUERY_MAX = 200;
+const presenceStates = new Map();   // user id -> {online, last_seen}
+const presenceSources = {};         // 'friends' | 'private' -> user ids
+let presenceWatched = '';
+let presenceSubscribeTimer = null;
+
+function presenceDotHtml(userId) {
+    return `<span class="presence-dot" data-presence-user="${userId}"></span>`;
+}
+
+function presenceLabel(userId) {
+    const state = presenceStates.get(userId);
+    if (!state) return '';
+    if (state.online) return '在线';
+    return state.last_seen ? `最后在线 ${formatTime(state.last_seen)}` : '离线';
+}
+
+function applyPresence(users) {
+    for (const u of users) presenceStates.set(u.user_id, { online: u.online, last_seen: u.last_seen });
+    paintPresence();
+}
+
+function paintPresence(root = document) {
+    root.querySelectorAll('[data-presence-user]').forEach(el => {
+        const userId = Number(el.dataset.presenceUser);
+        const state = presenceStates.get(userId);
+        el.classList.toggle('online', !!(state && state.online));
+        el.title = presenceLabel(userId);
+    });
+    root.querySelectorAll('[data-presence-label]').forEach(el => {
+        el.textContent = presenceLabel(Number(el.dataset.presenceLabel));
+    });
+}
+
+function watchPresence(source, userIds) {
+    presenceSources[source] = userIds;
+    const ids = [...new Set(Object.values(presenceSources).flat())].sort((a, b) => a - b);
+    if (ids.join(',') === presenceWatched) return;
+    presenceWatched = ids.join(',');
+    clearTimeout(presenceSubscribeTimer);
+    presenceSubscribeTimer = setTimeout(subscribePresence, 300);
+}
+
+// Subscriptions live on the socket, so this also runs after every reconnect.
+function subscribePresence() {
+    if (!socket || !socket.connected) return;
+    const ids = presenceWatched ? presenceWatched.split(',').map(Number).slice(0, PRESENCE_WATCH_MAX) : [];
+    socket.emit('presence_subscribe', { user_ids: ids }, (res) => {
+        if (res && res.ok) applyPresence(res.users);
+    });
+}
+
+async function loadPresence(userIds) {
+    const ids = [...new Set(userIds)].slice(0, PRESENCE_QUERY_MAX);
+    if (!ids.length) return;
+    const res = await fetch(`/api/presence?ids=${ids.join(',')}`);
+    const data = await res.json();
+    if (data.ok) applyPresence(data.users);
+}
+
+// ===== Typing =====
+// The input reports typing at most every TYPING_SEND_INTERVAL; the server
+// aggregates reports and sends one `typing` snapshot per conversation when the
+// set of typers changes.  A snapshot older than TYPING_DISPLAY_TTL is ignored
+// in case the final empty one was missed.
+const TYPING_SEND_INTERVAL = 2500;
+const TYPING_DISPLAY_TTL = 8000;
+const typingSnapshots = new Map();   // conversation id -> {users, count, at}
+let typingConvId = null;
+let typingSentAt = 0;
+
+function noteTyping() {
+    if (!currentConvId || !socket) return;
+    if (!document.getElementById('msgInput').value.trim()) {
+        stopTyping();
+        return;
+    }
+    const now = Date.now();
+    if (typingConvId === currentConvId && now - typingSentAt < TYPING_SEND_INTERVAL) return;
+    if (typingConvId !== currentConvId) stopTyping();
+    typingConvId = currentConvId;
+    typingSentAt = now;
+    socket.emit('typing', { conversation_id: currentConvId, typing: true });
+}
+
+// notify=false when the server clears it anyway (the message was sent).
+function stopTyping(notify = true) {
+    if (!typingConvId) return;
+    if (notify && socket) socket.emit('typing', { conversation_id: typingConvId, typing: false });
+    typingConvId = null;
+    typingSentAt = 0;
+}
+
+function onTypingSnapshot(data) {
+    typingSnapshots.set(data.conversation_id, { users: data.users || [], count: data.count || 0, at: Date.now() });
+    if (data.conversation_id === currentConvId) renderTypingIndicator();
+}
+
+function renderTypingIndicator() {
+    const el = document.getElementById('typingIndicator');
+    if (!el) return;
+    const snap = typingSnapshots.get(currentConvId);
+    const fresh = snap && Date.now() - snap.at < TYPING_DISPLAY_TTL;
+    const others = fresh ? snap.users.filter(u => u.id !== currentUser.id) : [];
+    const count = fresh ? snap.count - (snap.users.length - others.length) : 0;
+    if (count <= 0) {
+        el.style.display = 'none';
+        return;
+    }
+    const names = others.map(u => u.name).join('、');
+    el.textContent = !names ? `${count} 人正在输入…`
+        : count > others.length ? `${names} 等 ${count} 人正在输入…` : `${names} 正在输入…`;
+    el.style.display = 'block';
+}
+
+// ===== Room events =====
+// Message events broadcast to a conversation carry {epoch, seq}.  roomPositions
+// keeps the last one applied per conversation; on reconnect the client sends
+// them in `resume` and the server replays the missed events, or lists the
+// conversations to resync from the database when its buffer no longer covers
+// the gap.  Live events arriving before the resume ack are held and applied
+// after the replay, so nothing is applied out of order.
+const RESUME_ACK_TIMEOUT = 10000;
+const roomPositions = {};   // conversation id -> [epoch, seq]
+let resumePending = false;
+let heldRoomEvents = [];
+
+const roomEventHandlers = {
+    new_message: onNewMessage,
+    new_messages: onNewMessages,
+    message_edited: onMessageEdited,
+    message_revoked: onMessageRevoked,
+};
+
+function receiveRoomEvent(event, data) {
+    if (resumePending) {
+        heldRoomEvents.push([event, data]);
+        return;
+    }
+    applyRoomEvent(event, data, false);
+}
+
+function applyRoomEvent(event, data, replayed) {
+    if (data.seq !== undefined) {
+        const seen = roomPositions[data.conversation_id];
+        if (seen && seen[0] === data.epoch && data.seq <= seen[1]) return;   // already applied
+        roomPositions[data.conversation_id] = [data.epoch, data.seq];
+    }
+    roomEventHandlers[event](data, replayed);
+}
+
+function resumeRooms() {
+    // Without a position (nothing received since joining) the server cannot tell what was missed.
+    const unknownCurrent = currentConvId && !roomPositions[currentConvId];
+    resumePending = true;
+    socket.timeout(RESUME_ACK_TIMEOUT).emit('resume', { positions: roomPositions }, (err, res) => {
+        const held = heldRoomEvents;
+        heldRoomEvents = [];
+        resumePending = false;
+        const ok = !err && res && res.ok;
+        if (ok) {
+            for (const events of Object.values(res.replay)) {
+                events.forEach(e => applyRoomEvent(e.event, e.data, true));
+            }
+        }
+        held.forEach(([event, data]) => applyRoomEvent(event, data, false));
+        if (!ok) {
+            if (currentConvId) syncConversation(currentConvId);
+            loadConversations();
+            return;
+        }
+        for (const [convId, position] of Object.entries(res.positions)) {
+            const seen = roomPositions[convId];
+            if (!seen || seen[0] !== position[0] || seen[1] < position[1]) roomPositions[convId] = position;
+        }
+        // Buffer rolled over: other conversations catch up from the cache cursor when opened.
+        if (unknownCurrent || res.resync.includes(currentConvId)) syncConversation(currentConvId);
+        if (res.resync.length || Object.keys(res.replay).length) loadConversations();
+    });
+}
+
+function onNewMessage(msg, replayed) {
+    cacheStoreMessages(msg.conversation_id, [msg]);
+    if (msg.conversation_id === currentConvId) {
+        const autoScroll = shouldScroll();
+        if (!settlePendingMessage(msg)) appendListedMessage(msg);
+        if (msg.sender_id === currentUser.id || autoScroll) {
+            scrollToBottom();
+        }
+    }
+    if (replayed) return;
+    // Toast notification
+    if (notificationsEnabled && msg.sender_id !== currentUser.id) {
+        if (msg.conversation_id !== currentConvId || document.hidden) {
+            showToast(msg.sender_name, msg.content, msg.conversation_id);
+        }
+    }
+    // Update conversation list
+    loadConversations();
+}
+
+// Batched forwards: all copies for one conversation arrive in one event.
+function onNewMessages(data, replayed) {
+    const msgs = data.messages || [];
+    if (!msgs.length) return;
+    cacheStoreMessages(data.conversation_id, msgs);
+    if (data.conversation_id === currentConvId) {
+        const autoScroll = shouldScroll();
+        appendListedMessages(msgs, true);
+        if (msgs[0].sender_id === currentUser.id || autoScroll) {
+            scrollToBottom();
+        }
+    }
+    if (replayed) return;
+    const last = msgs[msgs.length - 1];
+    if (notificationsEnabled && last.sender_id !== currentUser.id) {
+        if (data.conversation_id !== currentConvId || document.hidden) {
+            showToast(last.sender_name, msgs.length > 1 ? `[转发了 ${msgs.length} 条消息]` : last.content,
+                      data.conversation_id);
+        }
+    }
+    loadConversations();
+}
+
+function onMessageRevoked(data) {
+    if (data.conversation_id !== currentConvId) return;
+    applyMessageChange(data.message_id, { is_revoked: 1, content: '消息已撤回', media_url: null });
+}
+
+function onMessageEdited(msg) {
+    applyMessageChange(msg.id, {
+        content: msg.content || '',
+        edited_at: msg.edited_at || Date.now() / 1000,
+    });
+}
+
 // ===== Socket.IO =====
 function initSocket() {
     socket = io();
 
     socket.on('connect', () => {
+        flushOutbox();
         if (currentConvId) {
             socket.emit('join_conversation', { conversation_id: currentConvId });
         }
+        // Replay whatever was broadcast while disconnected.
+        resumeRooms();
+        subscribePresence();
     });
 
-    socket.on('new_message', (msg) => {
-        if (msg.conversation_id === currentConvId) {
-            const autoScroll = shouldScroll();
-            appendMessage(msg);
-            if (msg.sender_id === currentUser.id || autoScroll) {
-                scrollToBottom();
-            }
-        }
-        // Toast notification
-        if (notificationsEnabled && msg.sender_id !== currentUser.id) {
-            if (msg.conversation_id !== currentConvId || document.hidden) {
-                showToast(msg.sender_name, msg.content, msg.conversation_id);
-            }
-        }
-        // Update conversation list
-        loadConversations();
-    });
+    socket.on('presence', (data) => applyPresence(data.users || []));
+    socket.on('typing', onTypingSnapshot);
+    setInterval(renderTypingIndicator, 2000);
+
+    for (const event of Object.keys(roomEventHandlers)) {
+        socket.on(event, (data) => receiveRoomEvent(event, data));
+    }
 
     socket.on('conversation_created', (data) => {
         // Join the new conversation room so we receive messages
@@ -314,32 +579,29 @@ function initSocket() {
         loadConversations();
     });
 
-    socket.on('message_revoked', (data) => {
-        if (data.conversation_id !== currentConvId) return;
-        const row = document.querySelector(`.msg-row[data-message-id="${data.message_id}"]`);
-        if (!row) return;
-        const senderName = data.sender_name || row.dataset.senderName || '该用户';
-        renderRevokedMessageRow(row, senderName);
-    });
-
-    socket.on('message_edited', (msg) => {
-        if (msg.conversation_id !== currentConvId) return;
-        const row = document.querySelector(`.msg-row[data-message-id="${msg.id}"]`);
-        if (!row) return;
-        const bubble = row.querySelector('.msg-bubble');
-        if (bubble) bubble.textContent = msg.content || '';
-        const timeEl = row.querySelector('.msg-time');
-        if (timeEl && !timeEl.querySelector('.msg-edited')) {
-            const edited = document.createElement('span');
-            edited.className = 'msg-edited';
-            edited.textContent = '(已编辑)';
-            timeEl.appendChild(edited);
-        }
-    });
-
     socket.on('group_updated', (data) => {
+        if (Object.keys(data).length === 2 && data.avatar_composite) {
+            // Re-rendered composite only: patch it in rather than reloading the list.
+            const conv = conversations.find(c => c.id === data.conversation_id);
+            if (!conv) return;
+            conv.avatar_composite = data.avatar_composite;
+            renderConversations();
+            const titleAvatarEl = document.getElementById('chatTitleAvatar');
+            if (titleAvatarEl && conv.id === currentConvId && !conv.avatar_url) {
+                titleAvatarEl.innerHTML =
+                    `<img src="${escapeAttr(data.avatar_composite)}" style="width:100%;height:100%;object-fit:cover;border-radius:50%">`;
+            }
+            return;
+        }
         if (data.conversation_id === currentConvId) {
             if (data.name) document.getElementById('chatTitle').textContent = data.name;
+            if (Object.prototype.hasOwnProperty.call(data, 'admins_only')) {
+                const conv = conversations.find(c => c.id === currentConvId);
+                if (conv) {
+                    conv.admins_only = data.admins_only;
+                    applyPostingState(conv);
+                }
+            }
             if (Object.prototype.hasOwnProperty.call(data, 'announcement')) {
                 const el = document.getElementById('groupAnnouncement');
                 if (data.announcement) {
@@ -365,23 +627,44 @@ function initSocket() {
         }
         loadContacts();
     });
+
+    socket.on('server_busy', (data) => {
+        showSimpleToast(data.msg || '服务器繁忙，请稍后重试', 'error');
+    });
+
+    // A connection refused by the server (e.g. shed under load) is not retried
+    // automatically; back off with jitter before trying again.
+    socket.on('connect_error', () => {
+        if (!socket.active) setTimeout(() => socket.connect(), 2000 + Math.random() * 3000);
+    });
 }
 
 // ===== Conversations =====
 async function loadConversations() {
+    if (!conversations.length) {
+        // Show the cached list while the real one loads.
+        const cached = await cacheLoadConversations();
+        if (cached && cached.length && !conversations.length) {
+            conversations = cached;
+            renderConversations();
+        }
+    }
     const res = await fetch('/api/conversations');
     const data = await res.json();
     if (!data.ok) return;
     conversations = data.conversations;
     renderConversations();
+    cacheSaveConversations(conversations);
 }
 
 function renderConversations() {
     const list = document.getElementById('convList');
     if (!conversations.length) {
         list.innerHTML = '<div class="empty-hint">暂无会话，点击上方开始聊天</div>';
+        watchPresence('private', []);
         return;
     }
+    const partners = [];
     list.innerHTML = conversations.map(c => {
         const isActive = c.id === currentConvId;
         const isGroup = c.is_group;
@@ -394,12 +677,14 @@ function renderConversations() {
                                     (lastMsg.msg_type && lastMsg.msg_type !== 'text' ? `[${{'image':'图片','audio':'语音','video':'视频','file':'文件'}[lastMsg.msg_type] || '附件'}]` : lastMsg.content))
                         : '暂无消息';
         const lastTime = lastMsg ? formatTime(lastMsg.timestamp) : '';
+        const partner = !isGroup && !isSelf ? (c.members || []).find(m => m.id !== currentUser.id) : null;
+        if (partner) partners.push(partner.id);
         return `
             <div class="conv-item ${isActive ? 'active' : ''} ${isGroup ? 'group' : ''}"
                  data-conv-id="${c.id}" onclick="openConversation(${c.id})">
                 ${conversationAvatarHtml(c)}
                 <div class="conv-info">
-                    <div class="conv-name">${escapeHtml(c.display_name)}</div>
+                    <div class="conv-name">${partner ? presenceDotHtml(partner.id) : ''}${escapeHtml(c.display_name)}</div>
                     <div class="conv-last">${escapeHtml(lastText)}</div>
                 </div>
                 <div class="conv-time">${lastTime}</div>
@@ -407,10 +692,14 @@ function renderConversations() {
         `;
     }).join('');
     renderIcons();
+    paintPresence(list);
+    watchPresence('private', partners);
 }
 
 async function openConversation(convId) {
+    stopTyping();
     currentConvId = convId;
+    renderTypingIndicator();
     selectionMode = false;
     selectedMessageIds.clear();
     updateSelectionUI();
@@ -433,17 +722,24 @@ async function openConversation(convId) {
                     titleAvatarEl.innerHTML = escapeHtml(getAvatarToken(other.avatar_emoji, other.username || conv.display_name));
                 }
             }
-        } else if (conv.avatar_url) {
-            titleAvatarEl.innerHTML = `<img src="${escapeAttr(conv.avatar_url)}" style="width:100%;height:100%;object-fit:cover;border-radius:50%">`;
+        } else if (groupAvatarUrl(conv)) {
+            titleAvatarEl.innerHTML = `<img src="${escapeAttr(groupAvatarUrl(conv))}" style="width:100%;height:100%;object-fit:cover;border-radius:50%">`;
         } else {
             titleAvatarEl.innerHTML = '群';
         }
     }
     document.getElementById('chatTitle').textContent = conv.display_name;
 
-    const memberNames = conv.members.map(m => m.username).join(', ');
-    document.getElementById('chatMembers').textContent =
-        conv.is_group ? `${conv.members.length}人 · ${memberNames}` : '';
+    const membersEl = document.getElementById('chatMembers');
+    const partner = !conv.is_group && !conv.is_self_chat ? conv.members.find(m => m.id !== currentUser.id) : null;
+    if (partner) {
+        membersEl.dataset.presenceLabel = partner.id;
+        membersEl.textContent = presenceLabel(partner.id);
+    } else {
+        delete membersEl.dataset.presenceLabel;
+        membersEl.textContent = conv.is_group ? `${conv.member_count}人` : '';
+    }
+    applyPostingState(conv);
     const announcementEl = document.getElementById('groupAnnouncement');
     if (conv.is_group && conv.announcement) {
         announcementEl.innerHTML = `<i class="icon" data-lucide="megaphone"></i><span>${escapeHtml(conv.announcement)}</span>`;
@@ -461,31 +757,47 @@ async function openConversation(convId) {
     socket.emit('join_conversation', { conversation_id: convId });
     await loadPinnedMessages();
 
-    // Load messages
+    // Render cached messages straight away and fetch only what changed since;
+    // without a cache, load the newest page.
+    const cached = await cacheLoadConversation(convId, 50);
+    if (currentConvId !== convId) return;
+    if (cached) {
+        document.getElementById('loadMoreBtn').style.display =
+            cached.messages.length >= 50 || !cached.state.oldest_reached ? 'block' : 'none';
+        setListedMessages(withPendingMessages(convId, cached.messages));
+        scrollToBottom();
+    } else if (!await loadLatestMessages(convId)) {
+        return;
+    }
+
+    renderConversations();
+    renderIcons();
+    document.getElementById('msgInput').focus();
+    if (cached) syncConversation(convId);
+}
+
+function canPostIn(conv) {
+    return !conv.admins_only || conv.my_role === 'admin' || conv.created_by === currentUser.id;
+}
+
+function applyPostingState(conv) {
+    const input = document.getElementById('msgInput');
+    const allowed = canPostIn(conv);
+    input.disabled = !allowed;
+    input.placeholder = allowed ? '输入消息… (Enter 发送, Shift+Enter 换行)' : '仅管理员可发言';
+}
+
+async function loadLatestMessages(convId) {
     const res = await fetch(`/api/messages/${convId}`);
     const data = await res.json();
-    if (!data.ok) return;
+    if (!data.ok || currentConvId !== convId) return false;
 
-    const msgContainer = document.getElementById('messages');
     const loadMoreBtn = document.getElementById('loadMoreBtn');
-    msgContainer.innerHTML = '';
-    msgContainer.appendChild(loadMoreBtn);
     loadMoreBtn.style.display = data.messages.length >= 50 ? 'block' : 'none';
-
-    let lastDate = '';
-    data.messages.forEach(msg => {
-        const msgDate = new Date(msg.timestamp * 1000).toLocaleDateString();
-        if (msgDate !== lastDate) {
-            appendTimeDivider(msgDate);
-            lastDate = msgDate;
-        }
-        appendMessage(msg, false);
-    });
-
+    setListedMessages(withPendingMessages(convId, data.messages));
     scrollToBottom();
-    renderConversations();
-    renderIcons();
-    document.getElementById('msgInput').focus();
+    cacheStartConversation(convId, data.messages, data.sync_cursor, data.messages.length < 50);
+    return true;
 }
 
 function updateSelectionUI() {
@@ -540,12 +852,11 @@ async function loadPinnedMessages() {
 }
 
 async function jumpToMessage(messageId) {
-    let row = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
-    if (!row) {
+    if (!findListedMessage(messageId)) {
         const ok = await ensureMessageVisible(messageId);
         if (!ok) return showSimpleToast('无法找到该消息', 'error');
-        row = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
     }
+    const row = revealMessage(messageId);
     if (!row) return;
     row.scrollIntoView({ behavior: 'smooth', block: 'center' });
     row.classList.add('selected');
@@ -601,21 +912,25 @@ async function forwardSelectedMessages() {
     }
     const conversationIds = pickForwardConversations();
     if (!conversationIds.length) return;
-    let total = 0;
-    for (const messageId of selectedMessageIds) {
-        const res = await fetch(`/api/messages/${messageId}/forward`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ conversation_ids: conversationIds })
-        });
-        const data = await res.json();
-        if (data.ok) total += data.forwarded;
+    const res = await fetch('/api/messages/forward', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            message_ids: [...selectedMessageIds],
+            conversation_ids: conversationIds,
+            batch_id: newClientMsgId(),
+        })
+    });
+    const data = await res.json();
+    if (!data.ok) {
+        showSimpleToast(data.msg || '转发失败', 'error');
+        return;
     }
     selectedMessageIds.clear();
     selectionMode = false;
     updateSelectionUI();
     document.querySelectorAll('.msg-row').forEach(row => row.classList.remove('selection-mode', 'selected'));
-    showSimpleToast(`多选转发完成，共 ${total} 条`, 'success');
+    showSimpleToast(`多选转发完成，共 ${data.forwarded} 条`, 'success');
     loadConversations();
 }
 
@@ -626,16 +941,13 @@ async function revokeMessage(messageId) {
         showSimpleToast(data.msg || '撤回失败', 'error');
         return;
     }
-    const row = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
-    if (row) {
-        renderRevokedMessageRow(row, currentUser.username);
-    }
+    applyMessageChange(messageId, { is_revoked: 1, content: '消息已撤回', media_url: null });
 }
 
 async function editMessage(messageId) {
-    const row = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
-    if (!row) return;
-    const oldText = row.querySelector('.msg-bubble')?.textContent || '';
+    const msg = findListedMessage(messageId);
+    if (!msg) return;
+    const oldText = msg.content || '';
     const next = window.prompt('编辑消息', oldText);
     if (next === null) return;
     const content = next.trim();
@@ -651,8 +963,10 @@ async function editMessage(messageId) {
         return;
     }
     if (data.message) {
-        const bubble = row.querySelector('.msg-bubble');
-        if (bubble) bubble.textContent = data.message.content;
+        applyMessageChange(messageId, {
+            content: data.message.content,
+            edited_at: data.message.edited_at || Date.now() / 1000,
+        });
     }
 }
 
@@ -771,8 +1085,7 @@ async function loadFavoritesMore() {
 
 async function ensureMessageVisible(messageId, maxRounds = 20) {
     for (let i = 0; i < maxRounds; i += 1) {
-        const existing = document.querySelector(`.msg-row[data-message-id="${messageId}"]`);
-        if (existing) return true;
+        if (findListedMessage(messageId)) return true;
         const loaded = await loadMore();
         if (!loaded) return false;
     }
@@ -790,38 +1103,605 @@ async function openFavoriteMessage(convId, messageId) {
 
 async function loadMore() {
     if (!currentConvId) return false;
-    const firstMsg = document.querySelector('.msg-row');
+    const convId = currentConvId;
+    const firstMsg = messageList.messages[0];
     if (!firstMsg) return false;
-    const firstTimestamp = firstMsg.dataset.timestamp;
+    const firstTimestamp = firstMsg.timestamp;
+    const loadMoreBtn = document.getElementById('loadMoreBtn');
+
+    const cached = await cacheLoadOlder(convId, firstTimestamp, 50);
+    if (currentConvId !== convId) return false;
+    if (cached && cached.messages.length) {
+        if (cached.messages.length < 50 && cached.state.oldest_reached) loadMoreBtn.style.display = 'none';
+        return prependListedMessages(cached.messages) > 0;
+    }
 
-    const res = await fetch(`/api/messages/${currentConvId}?before=${firstTimestamp}`);
+    const res = await fetch(`/api/messages/${convId}?before=${firstTimestamp}`);
     const data = await res.json();
+    if (currentConvId !== convId) return false;
     if (!data.ok || !data.messages.length) {
-        document.getElementById('loadMoreBtn').style.display = 'none';
+        loadMoreBtn.style.display = 'none';
         return false;
     }
 
-    const msgContainer = document.getElementById('messages');
-    const loadMoreBtn = document.getElementById('loadMoreBtn');
-    const fragment = document.createDocumentFragment();
+    const added = prependListedMessages(data.messages);
+    if (data.messages.length < 50) loadMoreBtn.style.display = 'none';
+    cacheStoreMessages(convId, data.messages, { older: true, oldestReached: data.messages.length < 50 });
+    return added > 0;
+}
+
+// ===== Message list =====
+// Only the rows near the viewport are in the DOM.  Every loaded message (and
+// the date dividers between them) lives in messageList.items; the rows outside
+// the rendered window are replaced by two spacers whose heights come from the
+// measured (or estimated) height of each item.  Rows leaving the window are
+// recycled for the next ones rendered.
+const MSG_OVERSCAN_PX = 800;       // rendered above/below the viewport
+const MSG_ESTIMATED_HEIGHT = 64;   // height assumed for rows not measured yet
+const MSG_GAP = 4;                 // .msg-window gap
+const MSG_POOL_MAX = 60;           // recycled rows kept around
+
+const messageList = {
+    messages: [],        // loaded messages, oldest first
+    items: [],           // { key, kind: 'date' | 'message', text?, msg? }
+    heights: new Map(),  // item key -> measured height including the gap
+    offsets: null,       // offsets[i] = top of items[i]; null when stale
+    nodes: new Map(),    // item key -> element in the window
+    pool: [],            // detached message rows for reuse
+    animateKey: null,    // the one row that plays the fade-in animation
+    frame: 0,
+    observer: null,
+};
 
-    data.messages.forEach(msg => {
-        const row = createMessageElement(msg);
-        fragment.appendChild(row);
-    });
+function initMessageList() {
+    const el = document.getElementById('messages');
+    el.addEventListener('scroll', scheduleMessageRender, { passive: true });
+    window.addEventListener('resize', scheduleMessageRender);
+    if (window.ResizeObserver) {
+        messageList.observer = new ResizeObserver(onMessageRowsResized);
+    }
+}
 
-    msgContainer.insertBefore(fragment, loadMoreBtn.nextSibling);
-    if (data.messages.length < 50) loadMoreBtn.style.display = 'none';
+function messageKey(id) {
+    return `m${id}`;
+}
+
+function rebuildMessageItems() {
+    const items = [];
+    let lastDate = '';
+    for (const msg of messageList.messages) {
+        const msgDate = new Date(msg.timestamp * 1000).toLocaleDateString();
+        if (msgDate !== lastDate) {
+            // Keyed by the message it precedes so the divider keeps its
+            // height and row when older history is prepended.
+            items.push({ key: `d${msg.id}`, kind: 'date', text: msgDate });
+            lastDate = msgDate;
+        }
+        items.push({ key: messageKey(msg.id), kind: 'message', msg });
+    }
+    messageList.items = items;
+    messageList.offsets = null;
+}
+
+function messageOffsets() {
+    if (messageList.offsets) return messageList.offsets;
+    const { items, heights } = messageList;
+    const offsets = new Float64Array(items.length + 1);
+    for (let i = 0; i < items.length; i += 1) {
+        offsets[i + 1] = offsets[i] + (heights.get(items[i].key) ?? MSG_ESTIMATED_HEIGHT);
+    }
+    messageList.offsets = offsets;
+    return offsets;
+}
+
+// Index of the item covering position y (relative to the top of the list).
+function messageIndexAt(offsets, y) {
+    let lo = 0;
+    let hi = offsets.length - 2;
+    if (hi < 0) return 0;
+    while (lo < hi) {
+        const mid = (lo + hi + 1) >> 1;
+        if (offsets[mid] <= y) lo = mid;
+        else hi = mid - 1;
+    }
+    return lo;
+}
+
+function findListedMessage(messageId) {
+    return messageList.messages.find(m => m.id === messageId) || null;
+}
+
+function setListedMessages(messages) {
+    for (const node of messageList.nodes.values()) releaseMessageRow(node);
+    messageList.nodes.clear();
+    messageList.heights.clear();
+    messageList.messages = messages.slice();
+    messageList.animateKey = null;
+    rebuildMessageItems();
+    document.getElementById('messageWindow').textContent = '';
+    renderMessageWindow();
+}
+
+function prependListedMessages(messages) {
+    const known = new Set(messageList.messages.map(m => m.id));
+    const older = messages.filter(m => !known.has(m.id));
+    if (!older.length) return 0;
+    messageList.messages = older.concat(messageList.messages);
+    rebuildMessageItems();
+    renderMessageWindow();
+    return older.length;
+}
+
+function appendListedMessage(msg) {
+    appendListedMessages([msg], true);
+}
+
+function appendListedMessages(messages, animate = false) {
+    let appended = null;
+    for (const msg of messages) {
+        if (findListedMessage(msg.id)) continue;
+        const last = messageList.messages[messageList.messages.length - 1];
+        messageList.messages.push(msg);
+        const msgDate = new Date(msg.timestamp * 1000).toLocaleDateString();
+        if (!last || new Date(last.timestamp * 1000).toLocaleDateString() !== msgDate) {
+            messageList.items.push({ key: `d${msg.id}`, kind: 'date', text: msgDate });
+        }
+        messageList.items.push({ key: messageKey(msg.id), kind: 'message', msg });
+        appended = msg;
+    }
+    if (!appended) return;
+    messageList.offsets = null;
+    if (animate) messageList.animateKey = messageKey(appended.id);
+    renderMessageWindow();
+}
+
+function replaceListedMessage(oldId, msg) {
+    const index = messageList.messages.findIndex(m => m.id === oldId);
+    if (index < 0) return false;
+    if (findListedMessage(msg.id)) messageList.messages.splice(index, 1);
+    else messageList.messages[index] = msg;
+    rebuildMessageItems();
+    renderMessageWindow();
     return true;
 }
 
-// ===== Messages =====
-function appendMessage(msg, animate = true) {
-    const msgContainer = document.getElementById('messages');
-    const row = createMessageElement(msg, animate);
-    msgContainer.appendChild(row);
+function removeListedMessage(messageId) {
+    const index = messageList.messages.findIndex(m => m.id === messageId);
+    if (index < 0) return;
+    messageList.messages.splice(index, 1);
+    rebuildMessageItems();
+    renderMessageWindow();
+}
+
+function updateListedMessage(messageId, changes) {
+    const msg = findListedMessage(messageId);
+    if (!msg) return;
+    Object.assign(msg, changes);
+    const row = messageList.nodes.get(messageKey(messageId));
+    if (row) {
+        fillMessageRow(row, msg, false);
+        renderIcons(row);
+    }
+}
+
+function scheduleMessageRender() {
+    if (messageList.frame) return;
+    messageList.frame = requestAnimationFrame(() => {
+        messageList.frame = 0;
+        renderMessageWindow();
+    });
+}
+
+// The first rendered row still visible at the top of the viewport, with its
+// on-screen position, so the view can be pinned to it across re-renders.
+function captureScrollAnchor(el) {
+    const top = el.getBoundingClientRect().top;
+    for (const node of document.getElementById('messageWindow').children) {
+        const rect = node.getBoundingClientRect();
+        if (rect.bottom > top) return { node, top: rect.top };
+    }
+    return null;
+}
+
+function renderMessageWindow() {
+    const el = document.getElementById('messages');
+    const win = document.getElementById('messageWindow');
+    const topSpacer = document.getElementById('msgTopSpacer');
+    const bottomSpacer = document.getElementById('msgBottomSpacer');
+    if (!el || !win) return;
+    const { items, nodes } = messageList;
+    const anchor = captureScrollAnchor(el);
+
+    let offsets = messageOffsets();
+    const listTop = topSpacer.getBoundingClientRect().top - el.getBoundingClientRect().top + el.scrollTop;
+    const viewTop = el.scrollTop - listTop;
+    const start = items.length ? messageIndexAt(offsets, viewTop - MSG_OVERSCAN_PX) : 0;
+    const end = items.length
+        ? Math.min(items.length, messageIndexAt(offsets, viewTop + el.clientHeight + MSG_OVERSCAN_PX) + 1)
+        : 0;
+
+    const wanted = new Set();
+    for (let i = start; i < end; i += 1) wanted.add(items[i].key);
+    for (const [key, node] of nodes) {
+        if (!wanted.has(key)) {
+            nodes.delete(key);
+            releaseMessageRow(node);
+        }
+    }
+
+    // New rows are built in a fragment so the icon pass only scans them.
+    const fresh = document.createDocumentFragment();
+    const created = [];
+    for (let i = start; i < end; i += 1) {
+        const item = items[i];
+        if (nodes.has(item.key)) continue;
+        const node = createListItemElement(item);
+        nodes.set(item.key, node);
+        fresh.appendChild(node);
+        created.push(item);
+    }
+    if (created.length) renderIcons(fresh);
+
+    let cursor = win.firstChild;
+    for (let i = start; i < end; i += 1) {
+        const node = nodes.get(items[i].key);
+        if (node === cursor) cursor = cursor.nextSibling;
+        else win.insertBefore(node, cursor);
+    }
+
+    let resized = false;
+    for (const item of created) {
+        const node = nodes.get(item.key);
+        const height = node.offsetHeight + MSG_GAP;
+        if (messageList.heights.get(item.key) !== height) {
+            messageList.heights.set(item.key, height);
+            resized = true;
+        }
+        if (messageList.observer) messageList.observer.observe(node);
+    }
+    if (resized) {
+        messageList.offsets = null;
+        offsets = messageOffsets();
+    }
+    const total = offsets[items.length] || 0;
+    topSpacer.style.height = `${offsets[start] || 0}px`;
+    bottomSpacer.style.height = `${Math.max(0, total - (offsets[end] || 0))}px`;
+
+    if (anchor && anchor.node.isConnected) {
+        const shift = anchor.node.getBoundingClientRect().top - anchor.top;
+        if (shift) el.scrollTop += shift;
+    }
+    // Measured rows may be shorter than estimated and leave the window short.
+    if (resized) scheduleMessageRender();
+}
+
+function onMessageRowsResized(entries) {
+    const el = document.getElementById('messages');
+    const viewTop = el.getBoundingClientRect().top;
+    let shift = 0;
+    let changed = false;
+    for (const entry of entries) {
+        const node = entry.target;
+        const key = node.dataset.listKey;
+        if (!node.isConnected || messageList.nodes.get(key) !== node) continue;
+        const height = node.offsetHeight + MSG_GAP;
+        const old = messageList.heights.get(key);
+        if (old === height) continue;
+        messageList.heights.set(key, height);
+        changed = true;
+        // A row above the viewport changing height (an image finishing
+        // loading) would push the visible rows around; compensate.
+        if (old !== undefined && node.getBoundingClientRect().bottom <= viewTop) shift += height - old;
+    }
+    if (!changed) return;
+    messageList.offsets = null;
+    if (shift) el.scrollTop += shift;
+    scheduleMessageRender();
+}
+
+function createListItemElement(item) {
+    if (item.kind === 'date') {
+        const div = document.createElement('div');
+        div.className = 'time-divider';
+        div.dataset.listKey = item.key;
+        div.textContent = item.text;
+        return div;
+    }
+    const row = messageList.pool.pop() || document.createElement('div');
+    const animate = messageList.animateKey === item.key;
+    if (animate) messageList.animateKey = null;
+    fillMessageRow(row, item.msg, animate);
+    row.dataset.listKey = item.key;
+    return row;
+}
+
+function releaseMessageRow(node) {
+    if (messageList.observer) messageList.observer.unobserve(node);
+    node.remove();
+    if (node.classList.contains('msg-row') && messageList.pool.length < MSG_POOL_MAX) {
+        node.textContent = '';
+        messageList.pool.push(node);
+    }
+}
+
+// Scroll the given message into the rendered window and return its row.
+function revealMessage(messageId) {
+    const key = messageKey(messageId);
+    const index = messageList.items.findIndex(item => item.key === key);
+    if (index < 0) return null;
+    if (!messageList.nodes.has(key)) {
+        const el = document.getElementById('messages');
+        const topSpacer = document.getElementById('msgTopSpacer');
+        const listTop = topSpacer.getBoundingClientRect().top - el.getBoundingClientRect().top + el.scrollTop;
+        el.scrollTop = listTop + messageOffsets()[index] - el.clientHeight / 2;
+        renderMessageWindow();
+    }
+    return messageList.nodes.get(key) || null;
+}
+
+// ===== Local cache =====
+// Conversations and message pages are kept in IndexedDB (one database per user)
+// so a conversation renders at once when reopened; afterwards only the changes
+// since its sync cursor are fetched from /api/sync.  The cached messages of a
+// conversation are always one contiguous run ending at the newest message, so
+// older history can be served from the cache until it runs out.
+const CACHE_DB_VERSION = 2;
+const CACHE_MAX_MESSAGES = 1000;   // newest messages kept per conversation
+const SYNC_MAX_PAGES = 5;          // further behind than this: reload instead
+
+let cacheDbPromise = null;
+
+function idbRequest(req) {
+    return new Promise((resolve, reject) => {
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+    });
+}
+
+function cacheDbName() {
+    return `chat-cache-${currentUser.id}`;
+}
+
+function openCache() {
+    if (!window.indexedDB || !currentUser) return Promise.resolve(null);
+    if (!cacheDbPromise) {
+        cacheDbPromise = new Promise((resolve) => {
+            const req = indexedDB.open(cacheDbName(), CACHE_DB_VERSION);
+            req.onupgradeneeded = (event) => {
+                const idb = req.result;
+                if (event.oldVersion < 1) {
+                    idb.createObjectStore('conversations', { keyPath: 'id' });
+                    const messages = idb.createObjectStore('messages', { keyPath: 'id' });
+                    messages.createIndex('conv_ts', ['conversation_id', 'timestamp']);
+                    idb.createObjectStore('sync', { keyPath: 'conversation_id' });
+                }
+                if (event.oldVersion < 2) {
+                    idb.createObjectStore('outbox', { keyPath: 'client_msg_id' });
+                }
+            };
+            req.onsuccess = () => resolve(req.result);
+            // Private mode, no quota, an older tab blocking the upgrade: run uncached.
+            req.onerror = () => resolve(null);
+            req.onblocked = () => resolve(null);
+        });
+    }
+    return cacheDbPromise;
+}
+
+// Run fn(tx) in one transaction; resolves to fn's result once the transaction
+// has completed, or null when the cache is unavailable or anything failed.
+async function cacheRun(stores, mode, fn) {
+    try {
+        const idb = await openCache();
+        if (!idb) return null;
+        const tx = idb.transaction(stores, mode);
+        const done = new Promise((resolve, reject) => {
+            tx.oncomplete = resolve;
+            tx.onerror = tx.onabort = () => reject(tx.error);
+        });
+        const result = await fn(tx);
+        await done;
+        return result;
+    } catch (e) {
+        return null;
+    }
+}
+
+function convMessageRange(convId, upper = Infinity, upperOpen = false) {
+    return IDBKeyRange.bound([convId, -Infinity], [convId, upper], false, upperOpen);
+}
+
+// Up to `limit` cached messages of a conversation (older than `before` if
+// given), oldest first.
+function cacheReadMessages(tx, convId, limit, before = null) {
+    const range = before === null ? convMessageRange(convId) : convMessageRange(convId, before, true);
+    const req = tx.objectStore('messages').index('conv_ts').openCursor(range, 'prev');
+    const rows = [];
+    return new Promise((resolve, reject) => {
+        req.onsuccess = () => {
+            const cursor = req.result;
+            if (!cursor || rows.length >= limit) return resolve(rows.reverse());
+            rows.push(cursor.value);
+            cursor.continue();
+        };
+        req.onerror = () => reject(req.error);
+    });
+}
+
+function cacheLoadConversations() {
+    return cacheRun(['conversations'], 'readonly', async (tx) => {
+        const rows = await idbRequest(tx.objectStore('conversations').getAll());
+        return rows.sort((a, b) => a.position - b.position);
+    });
+}
+
+function cacheSaveConversations(list) {
+    const ids = new Set(list.map(c => c.id));
+    return cacheRun(['conversations', 'sync', 'messages'], 'readwrite', async (tx) => {
+        const store = tx.objectStore('conversations');
+        store.clear();
+        list.forEach((conv, position) => store.put({ ...conv, position }));
+        // Forget the messages of conversations we are no longer in.
+        const synced = await idbRequest(tx.objectStore('sync').getAllKeys());
+        for (const convId of synced) {
+            if (!ids.has(convId)) dropConversationCache(tx, convId);
+        }
+    });
+}
+
+function dropConversationCache(tx, convId) {
+    tx.objectStore('sync').delete(convId);
+    const req = tx.objectStore('messages').index('conv_ts').openKeyCursor(convMessageRange(convId));
+    req.onsuccess = () => {
+        const cursor = req.result;
+        if (!cursor) return;
+        tx.objectStore('messages').delete(cursor.primaryKey);
+        cursor.continue();
+    };
+}
+
+function cacheDropConversation(convId) {
+    return cacheRun(['sync', 'messages'], 'readwrite', tx => dropConversationCache(tx, convId));
+}
+
+// { state, messages } for a conversation with a sync cursor, else null.
+function cacheLoadConversation(convId, limit) {
+    return cacheRun(['sync', 'messages'], 'readonly', async (tx) => {
+        const state = await idbRequest(tx.objectStore('sync').get(convId));
+        if (!state) return null;
+        const messages = await cacheReadMessages(tx, convId, limit);
+        return messages.length ? { state, messages } : null;
+    });
+}
+
+function cacheLoadOlder(convId, before, limit) {
+    return cacheRun(['sync', 'messages'], 'readonly', async (tx) => {
+        const state = await idbRequest(tx.objectStore('sync').get(convId));
+        if (!state) return null;
+        return { state, messages: await cacheReadMessages(tx, convId, limit, before) };
+    });
+}
+
+// Replace a conversation's cache with its newest page.
+function cacheStartConversation(convId, messages, cursor, oldestReached) {
+    if (!cursor) return Promise.resolve(null);
+    return cacheRun(['sync', 'messages'], 'readwrite', (tx) => {
+        dropConversationCache(tx, convId);
+        const store = tx.objectStore('messages');
+        messages.forEach(m => store.put(m));
+        tx.objectStore('sync').put({ conversation_id: convId, cursor, oldest_reached: oldestReached });
+    });
 }
 
+// The `limit` oldest cached messages of a conversation, oldest first.
+function cacheReadOldest(tx, convId, limit) {
+    const req = tx.objectStore('messages').index('conv_ts').openCursor(convMessageRange(convId));
+    const rows = [];
+    return new Promise((resolve, reject) => {
+        req.onsuccess = () => {
+            const cursor = req.result;
+            if (!cursor || rows.length >= limit) return resolve(rows);
+            rows.push(cursor.value);
+            cursor.continue();
+        };
+        req.onerror = () => reject(req.error);
+    });
+}
+
+// Store messages of a cached conversation.  `older` is a page of history just
+// before the oldest cached message; anything else is new or changed messages,
+// of which those older than the cached run are skipped to keep it contiguous.
+function cacheStoreMessages(convId, messages, { cursor = null, older = false, oldestReached = false } = {}) {
+    return cacheRun(['sync', 'messages'], 'readwrite', async (tx) => {
+        const syncStore = tx.objectStore('sync');
+        const store = tx.objectStore('messages');
+        const state = await idbRequest(syncStore.get(convId));
+        if (!state) return;
+        const [first] = await cacheReadOldest(tx, convId, 1);
+        if (older) {
+            if (!first || messages.some(m => m.timestamp >= first.timestamp)) return;
+            messages.forEach(m => store.put(m));
+            if (oldestReached) state.oldest_reached = true;
+        } else {
+            messages.filter(m => !first || m.timestamp >= first.timestamp).forEach(m => store.put(m));
+        }
+        if (cursor) state.cursor = cursor;
+        const count = await idbRequest(store.index('conv_ts').count(convMessageRange(convId)));
+        if (count > CACHE_MAX_MESSAGES) {
+            const stale = await cacheReadOldest(tx, convId, count - CACHE_MAX_MESSAGES);
+            stale.forEach(m => store.delete(m.id));
+            state.oldest_reached = false;
+        }
+        syncStore.put(state);
+    });
+}
+
+function cachePatchMessage(messageId, changes) {
+    return cacheRun(['messages'], 'readwrite', async (tx) => {
+        const store = tx.objectStore('messages');
+        const msg = await idbRequest(store.get(messageId));
+        if (msg) store.put({ ...msg, ...changes });
+    });
+}
+
+async function clearLocalCache() {
+    const idb = await openCache();
+    if (!idb) return;
+    idb.close();
+    cacheDbPromise = null;
+    try {
+        await idbRequest(indexedDB.deleteDatabase(cacheDbName()));
+    } catch (e) {
+        // Nothing to clean up
+    }
+}
+
+// Update the open list and the cache for a change to one message.
+function applyMessageChange(messageId, changes) {
+    updateListedMessage(messageId, changes);
+    cachePatchMessage(messageId, changes);
+}
+
+// Fetch what changed in a cached conversation since its cursor and apply it.
+async function syncConversation(convId) {
+    const cached = await cacheRun(['sync'], 'readonly', tx => idbRequest(tx.objectStore('sync').get(convId)));
+    if (!cached) return;
+    let cursor = cached.cursor;
+    for (let page = 0; page < SYNC_MAX_PAGES; page += 1) {
+        const res = await fetch(`/api/sync?conversation_id=${convId}&since=${encodeURIComponent(cursor)}`);
+        const data = await res.json();
+        if (!data.ok) {
+            if (res.status === 400 || res.status === 403) await cacheDropConversation(convId);
+            return;
+        }
+        cursor = data.cursor;
+        await cacheStoreMessages(convId, data.messages, { cursor });
+        if (convId === currentConvId) applySyncedMessages(data.messages);
+        if (!data.has_more) return;
+    }
+    // Too far behind to replay every change: start over from the newest page.
+    await cacheDropConversation(convId);
+    if (convId === currentConvId) await loadLatestMessages(convId);
+}
+
+function applySyncedMessages(messages) {
+    if (!messages.length) return;
+    const autoScroll = shouldScroll();
+    const last = messageList.messages[messageList.messages.length - 1];
+    const fresh = [];
+    for (const msg of messages) {
+        if (findListedMessage(msg.id)) updateListedMessage(msg.id, msg);
+        else if (settlePendingMessage(msg)) continue;
+        else if (!last || msg.timestamp > last.timestamp) fresh.push(msg);
+    }
+    if (fresh.length) {
+        fresh.sort((a, b) => a.timestamp - b.timestamp);
+        appendListedMessages(fresh);
+        if (autoScroll) scrollToBottom();
+    }
+}
+
+// ===== Messages =====
 function renderRevokedMessageRow(row, senderName) {
     row.classList.remove('mine', 'other', 'selected');
     row.classList.add('revoked');
@@ -829,17 +1709,18 @@ function renderRevokedMessageRow(row, senderName) {
     row.innerHTML = `<div class="msg-revoked-note">${escapeHtml(senderName || '该用户')} 撤回了一条消息</div>`;
 }
 
-function createMessageElement(msg, animate = true) {
+// (Re)fill a message row, which may be a recycled one.
+function fillMessageRow(row, msg, animate = true) {
     const isMine = msg.sender_id === currentUser.id;
-    const row = document.createElement('div');
     row.className = `msg-row ${isMine ? 'mine' : 'other'}`;
+    delete row.dataset.pending;
     row.dataset.messageId = msg.id;
     row.dataset.conversationId = msg.conversation_id;
     row.dataset.timestamp = msg.timestamp;
     row.dataset.msgType = msg.msg_type || 'text';
     row.dataset.senderName = msg.sender_name || '';
     row.dataset.revoked = msg.is_revoked ? '1' : '0';
-    if (!animate) row.style.animation = 'none';
+    row.style.animation = animate ? '' : 'none';
 
     if (msg.is_revoked) {
         renderRevokedMessageRow(row, isMine ? '你' : msg.sender_name);
@@ -882,33 +1763,43 @@ function createMessageElement(msg, animate = true) {
     }
 
     const editedTag = msg.edited_at ? '<span class="msg-edited">(已编辑)</span>' : '';
+    let statusTag = '';
+    if (msg.pending === 'sending') {
+        statusTag = '<span class="msg-status">发送中…</span>';
+    } else if (msg.pending === 'failed') {
+        statusTag = `<span class="msg-status failed">发送失败
+            <a onclick="retryOutbox('${msg.client_msg_id}')">重试</a>
+            <a onclick="discardOutbox('${msg.client_msg_id}')">删除</a></span>`;
+    }
     row.innerHTML = `
         <input type="checkbox" class="msg-select" ${selectedMessageIds.has(msg.id) ? 'checked' : ''}
                onchange="toggleMessageSelection(${msg.id})">
         ${senderHtml}
         <div class="msg-bubble">${replyHtml}${bubbleContent}</div>
-        <div class="msg-time">${timeStr}${editedTag}</div>
+        <div class="msg-time">${timeStr}${editedTag}${statusTag}</div>
     `;
+    if (msg.pending) {
+        row.dataset.pending = msg.pending;
+        row.classList.add(msg.pending === 'failed' ? 'failed' : 'pending');
+    }
     if (selectionMode) {
         row.classList.add('selection-mode');
     }
     if (selectedMessageIds.has(msg.id)) {
         row.classList.add('selected');
     }
-    renderIcons();
     return row;
 }
 
-function appendTimeDivider(text) {
-    const div = document.createElement('div');
-    div.className = 'time-divider';
-    div.textContent = text;
-    document.getElementById('messages').appendChild(div);
-}
-
 function scrollToBottom() {
     const el = document.getElementById('messages');
-    requestAnimationFrame(() => { el.scrollTop = el.scrollHeight; });
+    requestAnimationFrame(() => {
+        // Rows rendered at the bottom replace estimated heights with measured
+        // ones, which moves the bottom; pin it again afterwards.
+        el.scrollTop = el.scrollHeight;
+        renderMessageWindow();
+        el.scrollTop = el.scrollHeight;
+    });
 }
 
 function shouldScroll() {
@@ -917,13 +1808,161 @@ function shouldScroll() {
     return el.scrollHeight - el.scrollTop - el.clientHeight < 100;
 }
 
+// ===== Outbox =====
+// Every outgoing message gets a client_msg_id and waits in the outbox (kept in
+// IndexedDB too, so it survives a reload) until the server acknowledges it.
+// Entries are sent one at a time in order; a timeout, a disconnect or a
+// retryable error resends the same id, which the server stores only once.
+const SEND_ACK_TIMEOUT = 10000;       // ms to wait for the send_message ack
+const SEND_RETRY_MAX_DELAY = 30000;   // retry backoff cap, ms
+const SEND_RETRYABLE = ['rate_limited', 'busy', 'error'];
+
+const outbox = new Map();   // client_msg_id -> { client_msg_id, payload, created_at, status, error }
+let outboxSending = false;
+let outboxRetryTimer = null;
+let outboxRetryDelay = 1000;
+
+function newClientMsgId() {
+    if (window.crypto && typeof crypto.randomUUID === 'function') return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+function pendingMessageId(clientMsgId) {
+    return `pending-${clientMsgId}`;
+}
+
+// Listed stand-in for an outbox entry until the stored message replaces it.
+function pendingMessage(entry) {
+    const p = entry.payload;
+    const original = p.original_message_id ? findListedMessage(p.original_message_id) : null;
+    return {
+        id: pendingMessageId(entry.client_msg_id),
+        conversation_id: p.conversation_id,
+        sender_id: currentUser.id,
+        sender_name: currentUser.username,
+        content: p.content,
+        msg_type: p.msg_type || 'text',
+        media_url: p.media_url || null,
+        original_message_id: p.original_message_id || null,
+        original_content: original?.content,
+        original_sender_name: original?.sender_name,
+        original_msg_type: original?.msg_type,
+        timestamp: entry.created_at,
+        client_msg_id: entry.client_msg_id,
+        pending: entry.status,
+    };
+}
+
+function outboxEntriesFor(convId) {
+    return [...outbox.values()].filter(e => e.payload.conversation_id === convId);
+}
+
+// Loaded messages of a conversation followed by its unsent ones.  Entries the
+// server already stored (the ack was lost) are dropped from the outbox.
+function withPendingMessages(convId, messages) {
+    const stored = new Set(messages.map(m => m.client_msg_id).filter(Boolean));
+    const pending = [];
+    for (const entry of outboxEntriesFor(convId)) {
+        if (stored.has(entry.client_msg_id)) outboxDelete(entry.client_msg_id);
+        else pending.push(pendingMessage(entry));
+    }
+    return messages.concat(pending);
+}
+
+function outboxSave(entry) {
+    cacheRun(['outbox'], 'readwrite', tx => tx.objectStore('outbox').put(entry));
+}
+
+function outboxDelete(clientMsgId) {
+    outbox.delete(clientMsgId);
+    cacheRun(['outbox'], 'readwrite', tx => tx.objectStore('outbox').delete(clientMsgId));
+}
+
+async function loadOutbox() {
+    const saved = await cacheRun(['outbox'], 'readonly', tx => idbRequest(tx.objectStore('outbox').getAll()));
+    (saved || []).sort((a, b) => a.created_at - b.created_at).forEach((entry) => {
+        if (!outbox.has(entry.client_msg_id)) outbox.set(entry.client_msg_id, entry);
+    });
+    flushOutbox();
+}
+
+function queueMessage(payload) {
+    const entry = {
+        client_msg_id: newClientMsgId(),
+        payload,
+        created_at: Date.now() / 1000,
+        status: 'sending',
+        error: null,
+    };
+    payload.client_msg_id = entry.client_msg_id;
+    outbox.set(entry.client_msg_id, entry);
+    outboxSave(entry);
+    if (payload.conversation_id === currentConvId) {
+        appendListedMessage(pendingMessage(entry));
+        scrollToBottom();
+    }
+    flushOutbox();
+}
+
+function flushOutbox() {
+    if (outboxSending || !socket || !socket.connected) return;
+    const entry = [...outbox.values()].find(e => e.status === 'sending');
+    if (!entry) return;
+    outboxSending = true;
+    socket.timeout(SEND_ACK_TIMEOUT).emit('send_message', entry.payload, (err, ack) => {
+        outboxSending = false;
+        if (!outbox.has(entry.client_msg_id)) {
+            flushOutbox();
+        } else if (!err && ack && ack.ok) {
+            outboxRetryDelay = 1000;
+            outboxDelete(entry.client_msg_id);
+            settlePendingMessage(ack.message);
+            flushOutbox();
+        } else if (!err && ack && !SEND_RETRYABLE.includes(ack.code)) {
+            entry.status = 'failed';
+            entry.error = ack.msg || '发送失败';
+            outboxSave(entry);
+            updateListedMessage(pendingMessageId(entry.client_msg_id), { pending: 'failed' });
+            showSimpleToast(entry.error, 'error');
+            flushOutbox();
+        } else {
+            // No ack in time, or asked to back off: resend the same entry later.
+            clearTimeout(outboxRetryTimer);
+            outboxRetryTimer = setTimeout(flushOutbox, outboxRetryDelay);
+            outboxRetryDelay = Math.min(outboxRetryDelay * 2, SEND_RETRY_MAX_DELAY);
+        }
+    });
+}
+
+// Replace the pending row of a stored message; true if there was one.
+function settlePendingMessage(msg) {
+    if (!msg || !msg.client_msg_id || msg.sender_id !== currentUser.id) return false;
+    return replaceListedMessage(pendingMessageId(msg.client_msg_id), msg);
+}
+
+function retryOutbox(clientMsgId) {
+    const entry = outbox.get(clientMsgId);
+    if (!entry) return;
+    entry.status = 'sending';
+    entry.error = null;
+    outboxSave(entry);
+    updateListedMessage(pendingMessageId(clientMsgId), { pending: 'sending' });
+    outboxRetryDelay = 1000;
+    flushOutbox();
+}
+
+function discardOutbox(clientMsgId) {
+    outboxDelete(clientMsgId);
+    removeListedMessage(pendingMessageId(clientMsgId));
+}
+
 // ===== Send =====
 function sendMessage() {
     const input = document.getElementById('msgInput');
     const content = input.value.trim();
     if (!content || !currentConvId) return;
-    socket.emit('send_message', { 
-        conversation_id: currentConvId, 
+    queueMessage({
+        conversation_id: currentConvId,
         content,
         original_message_id: replyToId
     });
@@ -931,6 +1970,7 @@ function sendMessage() {
     input.style.height = 'auto';
     input.focus();
     cancelReply();
+    stopTyping(false);
 }
 
 function handleKey(e) {
@@ -1143,12 +2183,13 @@ function renderFriendsList(friends) {
     const list = document.getElementById('friendsList');
     if (!friends.length) {
         list.innerHTML = '<div class="empty-hint">暂无好友，点击上方添加</div>';
+        watchPresence('friends', []);
         return;
     }
     list.innerHTML = friends.map(f => `
         <div class="contact-item">
             ${userAvatarHtml(f, 'avatar', 'width:34px;height:34px;font-size:13px')}
-            <span class="contact-name">${escapeHtml(f.username)}</span>
+            <span class="contact-name">${presenceDotHtml(f.id)}${escapeHtml(f.username)}</span>
             <div class="contact-actions">
                 <button class="contact-btn chat" onclick="chatWithFriend(${f.id})">发消息</button>
                 <button class="contact-btn remove" onclick="removeFriend(${f.id}, '${encodeURIComponent(f.username)}')">删除</button>
@@ -1156,6 +2197,8 @@ function renderFriendsList(friends) {
         </div>
     `).join('');
     renderIcons();
+    paintPresence(list);
+    watchPresence('friends', friends.map(f => f.id));
 }
 
 async function searchFriendUsers() {
@@ -1277,8 +2320,8 @@ async function renderGroupSettingsPanel() {
         <div class="gsp-section">
             <div class="gsp-section-title">群头像</div>
             <div style="display:flex;align-items:center;gap:10px">
-                ${s.avatar_url
-                    ? `<img src="${escapeAttr(s.avatar_url)}" style="width:40px;height:40px;border-radius:50%;object-fit:cover">`
+                ${groupAvatarUrl(s)
+                    ? `<img src="${escapeAttr(groupAvatarUrl(s))}" style="width:40px;height:40px;border-radius:50%;object-fit:cover">`
                     : `<div class="mini-av" style="width:40px;height:40px">群</div>`}
                 ${isAdmin
                     ? `<label class="avatar-upload-btn">上传群头像
@@ -1296,30 +2339,20 @@ async function renderGroupSettingsPanel() {
             ${isAdmin ? '<button class="gsp-btn" style="margin-top:8px" onclick="saveGroupAnnouncement()">保存公告</button>' : ''}
         </div>
 
+        ${isAdmin ? `
+        <div class="gsp-section">
+            <div class="gsp-section-title">发言权限</div>
+            <label style="display:flex;align-items:center;gap:8px;font-size:13px;color:var(--text-2)">
+                <input type="checkbox" id="gspAdminsOnly" ${s.admins_only ? 'checked' : ''} onchange="saveGroupAdminsOnly(this)">
+                仅群主和管理员可发言
+            </label>
+        </div>` : ''}
+
         <div class="gsp-section">
-            <div class="gsp-section-title">群成员 (${s.members.length})</div>
-            ${s.members.map(m => {
-                const isOwner = m.id === s.created_by;
-                const isMe = m.id === currentUser.id;
-                const canRemove = isAdmin && !isOwner && !isMe;
-                const canSetRole = isCreator && !isOwner && !isMe;
-                return `
-                <div class="gsp-member">
-                                        ${m.avatar_url
-                                                ? `<img src="${escapeAttr(m.avatar_url)}" class="mini-av" style="object-fit:cover">`
-                                                : `<div class="mini-av">${escapeHtml(getAvatarToken(m.avatar_emoji, m.username))}</div>`}
-                    <div class="member-name">${escapeHtml(m.username)}</div>
-                    ${isOwner ? '<span class="role-badge creator">群主</span>' :
-                      m.role === 'admin' ? '<span class="role-badge">管理员</span>' : ''}
-                    ${isMe ? '<span style="font-size:11px;color:var(--text-3)">(我)</span>' : ''}
-                    <div class="member-actions">
-                        ${canSetRole ? (m.role === 'admin'
-                            ? `<button class="gsp-small-btn" onclick="setMemberRole(${m.id}, 'member')">取消管理</button>`
-                            : `<button class="gsp-small-btn" onclick="setMemberRole(${m.id}, 'admin')">设为管理</button>`) : ''}
-                        ${canRemove ? `<button class="gsp-small-btn danger" onclick="removeMember(${m.id})">移除</button>` : ''}
-                    </div>
-                </div>`;
-            }).join('')}
+            <div class="gsp-section-title">群成员 (${s.member_count})</div>
+            <div id="gspMemberList">${s.members.map(m => gspMemberHtml(m, s)).join('')}</div>
+            <button class="gsp-btn" id="gspMoreMembers" style="width:100%;margin-top:6px;${s.has_more_members ? '' : 'display:none'}"
+                    onclick="loadMoreGspMembers()">加载更多成员</button>
             ${isAdmin ? `
             <div class="gsp-add-member">
                 <div class="gsp-section-title" style="margin-bottom:6px">添加成员</div>
@@ -1348,7 +2381,73 @@ async function renderGroupSettingsPanel() {
             <button class="gsp-btn danger" style="width:100%" onclick="leaveGroupConv()">退出群聊</button>
         </div>
     `;
+    gspSettings = s;
     renderIcons();
+    paintPresence(body);
+    loadPresence(s.members.map(m => m.id));
+}
+
+let gspSettings = null;
+
+function gspMemberHtml(m, s) {
+    const isAdmin = s.my_role === 'admin';
+    const isCreator = s.created_by === currentUser.id;
+    const isOwner = m.id === s.created_by;
+    const isMe = m.id === currentUser.id;
+    const canRemove = isAdmin && !isOwner && !isMe;
+    const canSetRole = isCreator && !isOwner && !isMe;
+    return `
+        <div class="gsp-member">
+            ${m.avatar_url
+                ? `<img src="${escapeAttr(m.avatar_url)}" class="mini-av" style="object-fit:cover">`
+                : `<div class="mini-av">${escapeHtml(getAvatarToken(m.avatar_emoji, m.username))}</div>`}
+            <div class="member-name">${presenceDotHtml(m.id)}${escapeHtml(m.username)}</div>
+            ${isOwner ? '<span class="role-badge creator">群主</span>' :
+              m.role === 'admin' ? '<span class="role-badge">管理员</span>' : ''}
+            ${isMe ? '<span style="font-size:11px;color:var(--text-3)">(我)</span>' : ''}
+            <div class="member-actions">
+                ${canSetRole ? (m.role === 'admin'
+                    ? `<button class="gsp-small-btn" onclick="setMemberRole(${m.id}, 'member')">取消管理</button>`
+                    : `<button class="gsp-small-btn" onclick="setMemberRole(${m.id}, 'admin')">设为管理</button>`) : ''}
+                ${canRemove ? `<button class="gsp-small-btn danger" onclick="removeMember(${m.id})">移除</button>` : ''}
+            </div>
+        </div>`;
+}
+
+// Member lists are paged in user id order; each page continues after the last id shown.
+async function loadMoreGspMembers() {
+    const s = gspSettings;
+    if (!s || !s.members.length) return;
+    const convId = currentConvId;
+    const after = s.members[s.members.length - 1].id;
+    const res = await fetch(`/api/conversations/${convId}/members?after=${after}`);
+    const data = await res.json();
+    if (!data.ok || convId !== currentConvId || s !== gspSettings) return;
+    s.members.push(...data.members);
+    const list = document.getElementById('gspMemberList');
+    list.insertAdjacentHTML('beforeend', data.members.map(m => gspMemberHtml(m, s)).join(''));
+    const transfer = document.getElementById('gspTransferSelect');
+    if (transfer) {
+        transfer.insertAdjacentHTML('beforeend', data.members.filter(m => m.id !== currentUser.id).map(m =>
+            `<option value="${m.id}">${escapeHtml(m.username)}</option>`).join(''));
+    }
+    document.getElementById('gspMoreMembers').style.display = data.has_more ? '' : 'none';
+    paintPresence(list);
+    loadPresence(data.members.map(m => m.id));
+}
+
+async function saveGroupAdminsOnly(checkbox) {
+    const res = await fetch(`/api/conversations/${currentConvId}/admins-only`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ enabled: checkbox.checked })
+    });
+    const data = await res.json();
+    if (!data.ok) {
+        checkbox.checked = !checkbox.checked;
+        return showSimpleToast(data.msg || '设置失败', 'error');
+    }
+    showSimpleToast(checkbox.checked ? '已开启仅管理员发言' : '已关闭仅管理员发言', 'success');
 }
 
 let gspSelectedMemberId = null;
@@ -1709,7 +2808,7 @@ async function uploadAndSendFile(file) {
     const res = await fetch('/api/upload', { method: 'POST', body: formData });
     const data = await res.json();
     if (!data.ok) { showSimpleToast(data.msg || '上传失败', 'error'); return; }
-    socket.emit('send_message', {
+    queueMessage({
         conversation_id: currentConvId,
         content: data.filename || file.name,
         msg_type: data.msg_type,
@@ -1752,7 +2851,7 @@ async function startRecordingInternal() {
             const res = await fetch('/api/upload', { method: 'POST', body: formData });
             const data = await res.json();
             if (!data.ok) { showSimpleToast(data.msg || '上传失败', 'error'); return; }
-            socket.emit('send_message', {
+            queueMessage({
                 conversation_id: currentConvId,
                 content: '语音消息',
                 msg_type: 'audio',
@@ -1975,6 +3074,7 @@ function showSimpleToast(msg, type) {
 // ===== Auth =====
 async function doLogout() {
     await fetch('/api/logout', { method: 'POST' });
+    await clearLocalCache();
     window.location.href = '/login';
 }
 
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures.  Every test gets its own database directory; the module-level
+state database.py keeps (backend, init flag, shard bookkeeping) is reset so
+tests never see each other's files.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Cheap argon2 parameters: the tests check behaviour, not hashing cost.
+os.environ.setdefault('ARGON2_TIME_COST', '1')
+os.environ.setdefault('ARGON2_MEMORY_KIB', '1024')
+os.environ.setdefault('ARGON2_PARALLELISM', '1')
+
+import pytest
+
+import database
+import db_backends
+
+
+def _reset(monkeypatch, tmp_path, shards=0):
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'chat.db'))
+    monkeypatch.setattr(database, 'ARCHIVE_DIR', str(tmp_path / 'archives'))
+    monkeypatch.setattr(database, '_archive_list', None)
+    monkeypatch.setattr(database, 'MESSAGE_SHARDS', shards)
+    monkeypatch.setattr(database, '_legacy_max_id', 0)
+    monkeypatch.setattr(database, '_backend', None)
+    monkeypatch.setattr(database, '_db_initialized', False)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """database module on a fresh single-file SQLite database."""
+    _reset(monkeypatch, tmp_path)
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def sharded_db(tmp_path, monkeypatch):
+    """database module with MESSAGE_SHARDS=3."""
+    _reset(monkeypatch, tmp_path, shards=3)
+    database.init_db()
+    return database
+
+
+@pytest.fixture(params=[0, 3], ids=['unsharded', 'sharded'])
+def any_db(request, tmp_path, monkeypatch):
+    """Like `db`, once unsharded and once with MESSAGE_SHARDS=3."""
+    _reset(monkeypatch, tmp_path, shards=request.param)
+    database.init_db()
+    return database
+
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    """
+    TEST_DATABASE_URL if set (a throwaway database: it is wiped before each
+    test), else a temporary local cluster started with initdb/pg_ctl from PATH
+    and stopped after the session.  Skips when neither is available.
+    """
+    if db_backends.psycopg2 is None:
+        pytest.skip('psycopg2 not installed')
+    url = os.environ.get('TEST_DATABASE_URL', '')
+    if url:
+        yield url
+        return
+    initdb, pg_ctl = shutil.which('initdb'), shutil.which('pg_ctl')
+    if not (initdb and pg_ctl):
+        pytest.skip('TEST_DATABASE_URL not set and no initdb/pg_ctl on PATH')
+    data = tmp_path_factory.mktemp('pgdata')
+    sockets = tempfile.mkdtemp(prefix='pg')   # unix socket paths must stay short
+    subprocess.run([initdb, '-D', str(data), '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                   check=True, capture_output=True)
+    subprocess.run([pg_ctl, '-D', str(data), '-l', str(data / 'server.log'), '-w',
+                    '-o', f"-k {sockets} -c listen_addresses='' -F", 'start'],
+                   check=True, capture_output=True)
+    try:
+        yield f'postgresql://postgres@/postgres?host={sockets}'
+    finally:
+        subprocess.run([pg_ctl, '-D', str(data), '-m', 'immediate', 'stop'], capture_output=True)
+        shutil.rmtree(sockets, ignore_errors=True)
+
+
+@pytest.fixture
+def postgres_backend(postgres_url):
+    backend = db_backends.PostgresBackend(postgres_url)
+    # Every test starts from an empty schema.
+    conn = backend.connect()
+    conn._raw.cursor().execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+    conn.commit()
+    conn.close()
+    yield backend
+    backend._pool.closeall()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def backend_db(request, tmp_path, monkeypatch):
+    """database module on each storage backend (PostgreSQL: see postgres_url)."""
+    _reset(monkeypatch, tmp_path)
+    if request.param == 'postgres':
+        monkeypatch.setattr(database, '_backend', request.getfixturevalue('postgres_backend'))
+    database.init_db()
+    return database
+
+
+def make_user(db, name):
+    ok, msg = db.create_user(name, 'pass1234')
+    assert ok, msg
+    return db.verify_user(name, 'pass1234')['id']
+
+
+def make_friends(db, a, b):
+    """Accepted friendship between a and b, via the normal request flow."""
+    assert db.send_friend_request(a, b)[0]
+    request_id = db.get_friend_requests(b)[0]['id']
+    assert db.accept_friend_request(request_id, b)[0]
+
+
+@pytest.fixture
+def app_module(db, tmp_path, monkeypatch):
+    """The Flask app on the `db` database, background loops not started, rate limits off."""
+    monkeypatch.chdir(tmp_path)   # logs/ is created relative to the working directory
+    import app as app_module
+    monkeypatch.setattr(app_module, '_background_started', True)
+    monkeypatch.setattr(app_module.limiter, 'enabled', False)
+    app_module.app.config['TESTING'] = True
+    return app_module
+
+
+@pytest.fixture
+def admin_client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s['is_admin'] = True
+    return client
+
+
+# Same-origin header the CSRF check wants on API writes.
+ORIGIN = {'Origin': 'http://localhost'}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import time
+
+import pytest
+
+from conftest import make_user
+
+DAY = 86400
+
+
+def _group_with_history(db, ages_days):
+    """A group with one message per age (in days), oldest first. Returns (conv_id, owner, [message ids])."""
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    conv_id = db.create_group_conversation('g', alice, [bob])
+    now = time.time()
+    ids = []
+    for i, age in enumerate(ages_days):
+        msg = db.save_message(conv_id, alice, f'm{i}')
+        ts = now - age * DAY
+        with db.msg_conn(conv_id) as conn:
+            conn.execute('UPDATE messages SET timestamp = ?, updated_at = ? WHERE id = ?', (ts, ts, msg['id']))
+            conn.commit()
+        ids.append(msg['id'])
+    return conv_id, alice, ids
+
+
+def _archive_all(db, days):
+    db.update_system_setting('archive_after_days', str(days))
+    while db.archive_cold_messages(batch_size=7):
+        pass
+
+
+def _page_through(db, conv_id, limit):
+    seen, before = [], None
+    while True:
+        page = db.get_messages(conv_id, limit=limit, before=before)
+        if not page:
+            return seen
+        seen = [m['content'] for m in page] + seen
+        before = page[0]['timestamp']
+
+
+def test_history_pages_into_the_archives(any_db):
+    db = any_db
+    conv_id, _, _ = _group_with_history(db, [100 - i for i in range(20)] + [1, 0.5])
+    _archive_all(db, 30)
+    assert _page_through(db, conv_id, 5) == [f'm{i}' for i in range(22)]
+
+
+def test_old_pinned_message_does_not_hide_archived_history(any_db):
+    db = any_db
+    # m0 is the oldest message and stays hot because it is pinned.
+    conv_id, alice, ids = _group_with_history(db, [100] + [90 - i for i in range(19)] + [1, 0.5])
+    assert db.pin_message(conv_id, ids[0], alice)[0]
+    _archive_all(db, 30)
+    with db.msg_conn(conv_id) as conn:
+        hot = conn.execute('SELECT COUNT(*) FROM messages WHERE conversation_id = ?', (conv_id,)).fetchone()[0]
+    assert hot == 3
+    expected = [f'm{i}' for i in range(22)]
+    for limit in (2, 3, 5, 50):
+        assert _page_through(db, conv_id, limit) == expected
+
+
+def test_full_hot_page_with_old_favorite_merges_archived_rows(db):
+    # The newest page is full but ends on a favorited message older than archived ones.
+    conv_id, alice, ids = _group_with_history(db, [100, 60, 50, 1])
+    assert db.toggle_favorite_message(alice, ids[0])[0]
+    _archive_all(db, 30)
+    page = db.get_messages(conv_id, limit=2)
+    assert [m['content'] for m in page] == ['m2', 'm3']
+
+
+def test_retention_overrides_apply_to_hot_and_archived_rows(db):
+    conv_keep, alice, _ = _group_with_history(db, [100, 40, 1])
+    conv_short = db.create_group_conversation('short', alice, [])
+    for age in (100, 40, 1):
+        msg = db.save_message(conv_short, alice, 'x')
+        with db.msg_conn(conv_short) as conn:
+            conn.execute('UPDATE messages SET timestamp = ? WHERE id = ?', (time.time() - age * DAY, msg['id']))
+            conn.commit()
+    _archive_all(db, 30)
+    db.set_conversation_retention(conv_keep, 0)      # keep forever
+    db.set_conversation_retention(conv_short, 10)
+    db.update_system_setting('message_retention_days', '50')
+    while db.purge_expired_messages(batch_size=10):
+        pass
+    assert [m['content'] for m in db.get_messages(conv_keep)] == ['m0', 'm1', 'm2']
+    assert len(db.get_messages(conv_short)) == 1
+
+
+def test_message_count_includes_archived_messages(any_db):
+    db = any_db
+    conv_id, alice, ids = _group_with_history(db, [100, 90, 80, 1])
+    assert db.get_admin_stats()['message_count'] == 4
+    _archive_all(db, 30)
+    stats = db.get_admin_stats()
+    assert (stats['message_count'], stats['hot_message_count'], stats['archived_message_count']) == (4, 1, 3)
+    db.update_system_setting('message_retention_days', '85')
+    while db.purge_expired_messages():
+        pass
+    stats = db.get_admin_stats()
+    assert (stats['message_count'], stats['archived_message_count']) == (2, 1)
+
+
+def test_forwards_of_archived_messages_keep_their_original(any_db):
+    db = any_db
+    conv_id, alice, ids = _group_with_history(db, [100, 1])
+    target = db.create_group_conversation('target', alice, [])
+    original = db.get_messages_by_ids([ids[0]])[ids[0]]
+    forwarded = db.forward_messages(alice, [original], [conv_id, target], 'k1')
+    _archive_all(db, 30)
+    assert db.get_messages_by_ids([ids[0]]) == {}          # the original is archived now
+    for conv in (conv_id, target):
+        fwd = [m for m in db.get_messages(conv) if m['original_message_id'] == ids[0]]
+        assert [(m['original_content'], m['original_sender_name']) for m in fwd] == [('m0', 'alice')]
+    # A forward that is itself archived resolves its archived original too.
+    with db.msg_conn(target) as conn:
+        conn.execute('UPDATE messages SET timestamp = ? WHERE id = ?',
+                     (time.time() - 50 * DAY, forwarded[target][0]['id']))
+        conn.commit()
+    _archive_all(db, 30)
+    fwd = db.get_messages(target)[0]
+    assert fwd['id'] == forwarded[target][0]['id'] and fwd['original_content'] == 'm0'
+
+
+def test_reads_open_archives_read_only(db, monkeypatch):
+    conv_id, _, _ = _group_with_history(db, [100, 1])
+    _archive_all(db, 30)
+    monkeypatch.setattr(db, '_create_archive_schema', lambda conn: pytest.fail('schema touched on read'))
+    assert [m['content'] for m in db.get_messages(conv_id)] == ['m0', 'm1']
+    assert db.get_admin_stats()['archived_message_count'] == 1
+    (month_key, _), = db._list_archives()
+    arc = db._open_archive(month_key)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            arc.execute('DELETE FROM archived_messages')
+    finally:
+        arc.close()
+
+
+def test_archive_list_is_cached_until_an_archive_changes(db, monkeypatch):
+    conv_id, _, _ = _group_with_history(db, [100, 1])
+    assert db._list_archives() == []
+    listings = []
+    real_listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda p: listings.append(p) or real_listdir(p))
+    _archive_all(db, 30)
+    for _ in range(3):
+        db.get_messages(conv_id)
+        db.get_admin_stats()
+    assert len(listings) == 1 and len(db._list_archives()) == 1
+    db.update_system_setting('message_retention_days', '50')
+    while db.purge_expired_messages():
+        pass
+    assert db._list_archives() == []
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Backend conformance: the same database.py calls must behave alike on SQLite
+and PostgreSQL.  The `backend_db` cases run on PostgreSQL at TEST_DATABASE_URL
+or on a temporary local cluster (see conftest.postgres_url); the translate()
+tests need no server.
+"""
+import sqlite3
+
+import db_backends
+from conftest import make_friends, make_user
+
+
+# ── SQLite → PostgreSQL rewriting ────────────────────────────────────────────
+
+def test_placeholders_and_percent_signs():
+    sql, _ = db_backends.translate("SELECT * FROM t WHERE a = ? AND b LIKE '%?%' AND c % 2 = ?")
+    assert sql == "SELECT * FROM t WHERE a = %s AND b ILIKE '%%?%%' AND c %% 2 = %s"
+
+
+def test_schema_types_and_escape():
+    sql, _ = db_backends.translate(
+        'CREATE TABLE IF NOT EXISTS conf_types (id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL)')
+    assert 'BIGSERIAL PRIMARY KEY' in sql and 'DOUBLE PRECISION' in sql
+    sql, _ = db_backends.translate('ALTER TABLE conf_types ADD COLUMN note TEXT')
+    assert 'ADD COLUMN IF NOT EXISTS note' in sql
+    sql, _ = db_backends.translate('SELECT id FROM conf_types WHERE note LIKE ? ESCAPE "\\"')
+    assert "ILIKE %s ESCAPE '\\'" in sql
+
+
+def test_insert_or_ignore_and_replace():
+    db_backends.translate('''CREATE TABLE IF NOT EXISTS conf_kv (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (scope, key)
+    )''')
+    sql, returns_id = db_backends.translate('INSERT OR IGNORE INTO conf_kv (scope, key, value) VALUES (?, ?, ?)')
+    assert sql.endswith('ON CONFLICT DO NOTHING') and not returns_id
+    sql, _ = db_backends.translate('INSERT OR REPLACE INTO conf_kv (scope, key, value) VALUES (?, ?, ?)')
+    assert sql == ('INSERT INTO conf_kv (scope, key, value) VALUES (%s, %s, %s) '
+                   'ON CONFLICT (scope, key) DO UPDATE SET value = EXCLUDED.value')
+
+
+def test_translation_does_not_depend_on_call_order():
+    insert = 'INSERT INTO conf_order (name) VALUES (?)'
+    # Translated (and cached) before the table is known: no id to return yet ...
+    assert db_backends.translate(insert) == ('INSERT INTO conf_order (name) VALUES (%s)', False)
+    db_backends.translate('CREATE TABLE IF NOT EXISTS conf_order (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)')
+    # ... which must not stick once it is.
+    assert db_backends.translate(insert) == ('INSERT INTO conf_order (name) VALUES (%s) RETURNING id', True)
+    # A cache miss gives the same answer as a hit.
+    db_backends._translate.cache_clear()
+    assert db_backends.translate(insert) == ('INSERT INTO conf_order (name) VALUES (%s) RETURNING id', True)
+
+
+def test_begin_write_on_sqlite_takes_the_write_lock(tmp_path):
+    path = str(tmp_path / 'lock.db')
+    first = sqlite3.connect(path, timeout=0)
+    second = sqlite3.connect(path, timeout=0)
+    try:
+        first.execute('CREATE TABLE t (x)')
+        first.commit()
+        db_backends.begin_write(first, 'scope', 1)
+        assert first.in_transaction
+        try:
+            db_backends.begin_write(second)
+        except sqlite3.OperationalError as e:
+            assert 'locked' in str(e)
+        else:
+            raise AssertionError('second writer was not blocked')
+    finally:
+        first.close()
+        second.close()
+
+
+# ── database.py on every backend ─────────────────────────────────────────────
+
+def test_users_and_login(backend_db):
+    db = backend_db
+    assert db.create_user('Alice', 'pass1234')[0]
+    assert db.create_user('Alice', 'other')[0] is False
+    user = db.verify_user('Alice', 'pass1234')
+    assert user and user['username'] == 'Alice'
+    assert db.verify_user('Alice', 'wrong') is None
+    # LIKE is case-insensitive on both backends.
+    assert [u['username'] for u in db.search_users('ali')] == ['Alice']
+
+
+def test_conversations_are_created_once(backend_db):
+    db = backend_db
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    make_friends(db, alice, bob)
+    first = db.create_private_conversation(alice, bob)
+    assert db.create_private_conversation(bob, alice) == first
+    assert db.create_self_conversation(alice) == db.create_self_conversation(alice)
+    group = db.create_group_conversation('g', alice, [bob])
+    ids = {c['id'] for c in db.get_user_conversations(bob)}
+    assert {first, group} <= ids
+
+
+def test_messages_roundtrip_and_sync(backend_db):
+    db = backend_db
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    group = db.create_group_conversation('g', alice, [bob])
+    cursor = db.current_sync_cursor()
+    sent = [db.save_message(group, alice, f'hi {i}', client_msg_id=f'c{i}') for i in range(3)]
+    assert len({m['id'] for m in sent}) == 3
+    assert db.save_message(group, alice, 'hi 0', client_msg_id='c0')['duplicate']
+    assert [m['content'] for m in db.get_messages(group)] == ['hi 0', 'hi 1', 'hi 2']
+    changes, _, has_more = db.get_message_changes(group, cursor)
+    assert [m['id'] for m in changes] == [m['id'] for m in sent] and not has_more
+    assert db.toggle_favorite_message(bob, sent[1]['id']) == (True, True)
+    assert db.toggle_favorite_message(bob, sent[1]['id']) == (True, False)
+
+
+def test_settings_upsert_quota_and_counters(backend_db):
+    db = backend_db
+    db.update_system_setting('system_name', 'one')
+    db.update_system_setting('system_name', 'two')
+    assert db.get_system_settings()['system_name'] == 'two'
+
+    alice = make_user(db, 'alice')
+    db.set_user_quota(alice, 1)
+    assert db.record_file_upload(alice, '/static/uploads/a.bin', 600 * 1024)
+    assert not db.record_file_upload(alice, '/static/uploads/b.bin', 600 * 1024)
+    assert db.get_user_storage_info(alice)['used_bytes'] == 600 * 1024
+
+    group = db.create_group_conversation('g', alice, [])
+    db.save_message(group, alice, 'x')
+    stats = db.get_admin_stats()
+    assert (stats['user_count'], stats['group_count'], stats['message_count']) == (1, 1, 1)
+
+
+def test_user_deletion_job(backend_db):
+    db = backend_db
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    group = db.create_group_conversation('g', alice, [bob])
+    db.save_message(group, alice, 'bye')
+    assert db.tombstone_user(alice)
+    while db.run_deletion_step(chunk=1):
+        pass
+    assert db.get_user_by_id(alice) is None
+    assert db.get_messages(group) == []
+    assert db.get_user_conversations(bob)[0]['id'] == group
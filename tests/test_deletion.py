@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import time
+
+from conftest import make_friends, make_user
+
+
+def _run_jobs(db):
+    while db.run_deletion_step(chunk=2):
+        pass
+    return db.get_deletion_jobs()
+
+
+def _age(db, conv_id, message_id, days):
+    with db.msg_conn(conv_id) as conn:
+        conn.execute('UPDATE messages SET timestamp = ? WHERE id = ?', (time.time() - days * 86400, message_id))
+        conn.commit()
+
+
+def test_user_deletion_removes_hot_and_archived_messages(any_db):
+    db = any_db
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    group = db.create_group_conversation('g', alice, [bob])
+    for i in range(5):
+        _age(db, group, db.save_message(group, alice, f'old {i}')['id'], 100)
+    db.save_message(group, alice, 'recent')
+    kept = db.save_message(group, bob, 'from bob')
+    _age(db, group, kept['id'], 100)
+    db.update_system_setting('archive_after_days', '30')
+    while db.archive_cold_messages():
+        pass
+
+    assert db.tombstone_user(alice)
+    jobs = _run_jobs(db)
+    assert all(j['status'] == 'done' for j in jobs)
+    assert db.get_user_by_id(alice) is None
+    assert [m['content'] for m in db.get_messages(group)] == ['from bob']
+    stats = db.get_admin_stats()
+    assert (stats['message_count'], stats['archived_message_count']) == (1, 1)
+
+
+def test_group_deletion_removes_archived_messages(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    group = db.create_group_conversation('g', alice, [bob])
+    other = db.create_group_conversation('h', alice, [bob])
+    for conv_id in (group, other):
+        _age(db, conv_id, db.save_message(conv_id, alice, 'old')['id'], 100)
+    db.update_system_setting('archive_after_days', '30')
+    while db.archive_cold_messages():
+        pass
+    assert db.tombstone_group(group)
+    _run_jobs(db)
+    assert db.get_admin_stats()['archived_message_count'] == 1
+    assert [m['content'] for m in db.get_messages(other)] == ['old']
+
+
+def test_deleted_user_cannot_be_added_back(db):
+    alice, bob, carol = make_user(db, 'alice'), make_user(db, 'bob'), make_user(db, 'carol')
+    make_friends(db, alice, bob)
+    group = db.create_group_conversation('g', alice, [bob])
+    assert db.tombstone_user(bob)
+
+    assert db.add_group_member(group, alice, bob) == (False, '用户不存在')
+    assert db.send_friend_request(alice, bob)[0] is False
+    new_group = db.create_group_conversation('h', alice, [bob, carol])
+    members = {m['id'] for m in db.get_group_members_page(new_group, 50, 0)}
+    assert members == {alice, carol}
+
+    jobs = _run_jobs(db)
+    assert all(j['status'] == 'done' for j in jobs)
+    assert db.get_user_by_id(bob) is None
+
+
+def test_final_step_clears_memberships_that_raced_the_tombstone(db):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    group = db.create_group_conversation('g', alice, [])
+    assert db.tombstone_user(bob)
+    # As if an add had committed between the tombstone and the job.
+    with db.db_conn() as conn:
+        conn.execute('INSERT INTO conversation_members (conversation_id, user_id, joined_at) VALUES (?, ?, ?)',
+                     (group, bob, time.time()))
+        conn.commit()
+    jobs = _run_jobs(db)
+    assert jobs[0]['status'] == 'done', jobs
+    assert db.get_user_by_id(bob) is None
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from fanout import FanoutQueue
+
+
+def _queue(slice_size=2, max_pending=3):
+    sent = []
+    queue = FanoutQueue(lambda event, payload, sids: sent.append((payload, sids)),
+                        slice_size=slice_size, max_pending=max_pending)
+    return queue, sent
+
+
+def _drain(queue):
+    while queue.step():
+        pass
+
+
+def test_slices_serve_rooms_round_robin():
+    queue, sent = _queue()
+    queue.submit('big', 'new_message', 'b', ['s1', 's2', 's3', 's4', 's5'])
+    queue.submit('small', 'new_message', 's', ['t1'])
+    assert queue.step() == 3
+    assert sent == [('b', ['s1', 's2']), ('s', ['t1'])]
+    assert not queue.queued('small') and queue.queued('big')
+    assert queue.step() == 2 and queue.step() == 1 and queue.step() == 0
+    assert sent[2:] == [('b', ['s3', 's4']), ('b', ['s5'])]
+    assert queue.stats() == {'rooms': 0, 'pending': 0, 'delivered': 6}
+
+
+def test_events_of_one_room_keep_their_order():
+    queue, sent = _queue()
+    queue.submit('room', 'new_message', 1, ['a', 'b', 'c'])
+    queue.submit('room', 'message_edited', 2, ['a'])
+    queue.submit('room', 'new_message', 3, ['a', 'b'])
+    _drain(queue)
+    assert sent == [(1, ['a', 'b']), (1, ['c']), (2, ['a']), (3, ['a', 'b'])]
+
+
+def test_pending_counts_broadcasts_until_fully_delivered():
+    queue, _ = _queue(slice_size=2, max_pending=3)
+    for i in range(3):
+        queue.submit(f'room{i}', 'new_message', i, ['a', 'b', 'c'])
+    assert queue.pending == 3 and queue.saturated()
+    queue.step()                       # one slice each, nothing finished
+    assert queue.pending == 3 and queue.saturated()
+    queue.step()
+    assert queue.pending == 0 and not queue.saturated()
+
+
+def test_empty_broadcast_is_dropped_without_sending():
+    queue, sent = _queue()
+    queue.submit('room', 'new_message', 1, [])
+    assert queue.step() == 0 and sent == [] and queue.pending == 0
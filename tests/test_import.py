@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+from conftest import ORIGIN
+
+
+def _import(client, body, content_type):
+    r = client.post('/api/admin/users/import', data=body, buffered=True,
+                    headers={**ORIGIN, 'Content-Type': content_type})
+    return [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+
+
+def _users(n, prefix='u'):
+    return [{'username': f'{prefix}{i:03d}', 'password': 'pass1234'} for i in range(n)]
+
+
+def test_csv_ndjson_and_json_imports(admin_client, db):
+    out = _import(admin_client, 'username,password,quota_mb\nc1,pass1234,\nc2,pass1234,500\nc1,pass1234,\nc3,pw,\n',
+                  'text/csv')
+    assert out[-1] == {'done': True, 'created': 2, 'failed': 2}
+    assert db.get_user_storage_info(db.verify_user('c2', 'pass1234')['id'])['quota_mb'] == 500
+
+    body = '\n'.join(json.dumps(u) for u in _users(70, 'n')) + '\n'
+    assert _import(admin_client, body, 'application/x-ndjson')[-1] == {'done': True, 'created': 70, 'failed': 0}
+
+    out = _import(admin_client, json.dumps(_users(3, 'j') + [5]), 'application/json')
+    assert out[-1] == {'done': True, 'created': 3, 'failed': 1}
+    assert {'line': 4, 'username': '', 'ok': False, 'msg': '格式错误'} in out
+
+
+def test_malformed_json_array_keeps_the_rows_before_the_error(admin_client):
+    body = json.dumps(_users(2))[:-1] + ', {"username": "broken"'
+    out = _import(admin_client, body, 'application/json')
+    rows = {r['line']: r['ok'] for r in out[:-1]}
+    assert rows == {1: True, 2: True, 3: False}
+    assert out[-1] == {'done': True, 'created': 2, 'failed': 1}
+
+
+def test_oversized_records_are_refused(admin_client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'IMPORT_RECORD_MAX', 100)
+    big = {'username': 'big', 'password': 'x' * 500}
+    out = _import(admin_client, json.dumps(_users(1) + [big]), 'application/json')
+    assert out[-1] == {'done': True, 'created': 1, 'failed': 1}
+    out = _import(admin_client, json.dumps(big) + '\n', 'application/x-ndjson')
+    assert out[-1] == {'done': True, 'created': 0, 'failed': 1}
+
+
+@pytest.mark.parametrize('chunk', [1, 2, 7, 64 * 1024])
+def test_json_array_is_parsed_incrementally(app_module, monkeypatch, chunk):
+    monkeypatch.setattr(app_module, 'IMPORT_READ_CHUNK', chunk)
+    items = [{'username': 'a', 'n': 12345}, 678, 'x y', [1, {'b': None}], 1.5e3, True]
+    text = ' [ ' + ' ,\n'.join(json.dumps(i) for i in items) + ' ] trailing'
+    assert list(app_module._json_array_items(io.StringIO(text))) == items
+    assert list(app_module._json_array_items(io.StringIO('[]'))) == []
+    for bad in ('', '{}', '[1 2]', '[1,', '[{"a": 1}'):
+        with pytest.raises(ValueError):
+            list(app_module._json_array_items(io.StringIO(bad)))
+
+
+def test_import_lock_is_released_when_the_body_is_never_read(admin_client, app_module):
+    r = admin_client.post('/api/admin/users/import', data=json.dumps(_users(1)), buffered=False,
+                          headers={**ORIGIN, 'Content-Type': 'application/json'})
+    assert app_module._import_running.locked()
+    busy = admin_client.post('/api/admin/users/import', data='[]',
+                             headers={**ORIGIN, 'Content-Type': 'application/json'})
+    assert busy.get_json()['ok'] is False
+    r.close()   # e.g. the client went away before the first chunk
+    assert not app_module._import_running.locked()
+    assert _import(admin_client, json.dumps(_users(1, 'v')), 'application/json')[-1]['created'] == 1
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import gevent
+import pytest
+
+from offload import BoundedPool, PoolBusy, PoolTimeout
+
+
+@pytest.fixture
+def make_pool():
+    def make(size=1, max_pending=2, deadline=None):
+        pool = BoundedPool('test', size, max_pending, deadline=deadline)
+        pool.start()
+        return pool
+    return make
+
+
+def _blocker():
+    gate = threading.Event()
+    return gate, lambda value=None: gate.wait(5) and value
+
+
+def _settle(pool, pending=0):
+    for _ in range(200):
+        if pool.pending == pending:
+            return
+        gevent.sleep(0.01)
+    assert pool.pending == pending
+
+
+def test_not_started_calls_inline():
+    pool = BoundedPool('test', 1, 0)
+    assert pool.run(threading.get_ident) == threading.get_ident()
+    assert pool.map(lambda x: x * 2, [1, 2]) == [2, 4]
+
+
+def test_runs_on_a_worker_thread_and_reraises(make_pool):
+    pool = make_pool()
+    assert pool.run(threading.get_ident) != threading.get_ident()
+    with pytest.raises(ZeroDivisionError):
+        pool.run(lambda: 1 / 0)
+    _settle(pool)
+
+
+def test_sheds_load_past_max_pending(make_pool):
+    pool = make_pool(size=1, max_pending=2)
+    gate, blocked = _blocker()
+    callers = [gevent.spawn(pool.run, blocked, i) for i in range(2)]
+    gevent.sleep(0.05)
+    assert pool.pending == 2
+    with pytest.raises(PoolBusy):
+        pool.run(blocked)
+    assert pool.rejected == 1
+    gate.set()
+    assert [c.get(timeout=5) for c in callers] == [0, 1]
+    _settle(pool)
+
+
+def test_deadline_gives_up_but_keeps_the_slot(make_pool):
+    pool = make_pool(size=1, max_pending=2, deadline=0.05)
+    gate, blocked = _blocker()
+    with pytest.raises(PoolTimeout) as exc:
+        pool.run(blocked)
+    assert isinstance(exc.value, PoolBusy) and pool.timeouts == 1
+    assert pool.pending == 1        # the worker is still busy with it
+    gate.set()
+    _settle(pool)
+
+
+def test_map_keeps_order_and_refuses_oversized_batches(make_pool):
+    pool = make_pool(size=2, max_pending=3)
+    assert pool.map(lambda x: (time.sleep(0.01 * (3 - x)), x)[1], [0, 1, 2]) == [0, 1, 2]
+    with pytest.raises(PoolBusy):
+        pool.map(lambda x: x, range(4))
+    assert pool.pending == 0 and pool.rejected == 1
+    with pytest.raises(ValueError):
+        pool.map(int, ['1', 'x'])
+    _settle(pool)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import passwords
+from offload import PoolBusy
+from conftest import make_user
+
+
+def _stored_hash(db, user_id):
+    with db.db_conn() as conn:
+        return conn.execute('SELECT password_hash FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+
+
+def test_login_survives_a_rehash_that_cannot_be_scheduled(db, monkeypatch):
+    uid = make_user(db, 'alice')
+    before = _stored_hash(db, uid)
+    monkeypatch.setattr(passwords, 'verify_password', lambda h, p: (True, True))
+    real_hash = passwords.hash_password
+
+    def busy(password):
+        raise PoolBusy('argon2')
+    monkeypatch.setattr(passwords, 'hash_password', busy)
+    user = db.verify_user('alice', 'pass1234')
+    assert user is not None and user['id'] == uid
+    assert _stored_hash(db, uid) == before
+
+    # The next login gets the rehash done.
+    monkeypatch.setattr(passwords, 'hash_password', real_hash)
+    assert db.verify_user('alice', 'pass1234')['id'] == uid
+    assert _stored_hash(db, uid) != before
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from presence import Presence
+
+T0 = 1000.0
+
+
+def _presence():
+    presence = Presence(grace=15, max_watch=3)
+    presence.watch('sid-a', [1, 2])
+    presence.watch('sid-b', [2])
+    return presence
+
+
+def test_online_is_batched_per_watching_socket():
+    presence = _presence()
+    presence.connected(1)
+    presence.connected(2)
+    batches, went_offline = presence.flush(now=T0)
+    assert went_offline == []
+    assert {sid: [u['user_id'] for u in ups] for sid, ups in batches.items()} == {'sid-a': [1, 2], 'sid-b': [2]}
+    assert presence.flush(now=T0 + 1) == ({}, [])
+
+
+def test_offline_only_after_the_grace_period():
+    presence = _presence()
+    presence.connected(1)
+    presence.flush(now=T0)
+    presence.disconnected(1, now=T0 + 1)
+    assert presence.flush(now=T0 + 15.9) == ({}, [])
+    assert presence.status([1])[1]['online']
+    batches, went_offline = presence.flush(now=T0 + 16)
+    assert batches == {'sid-a': [{'user_id': 1, 'online': False, 'last_seen': T0 + 1}]}
+    assert went_offline == [(1, T0 + 1)]
+    assert presence.status([1]) == {1: {'online': False, 'last_seen': T0 + 1}}
+
+
+def test_reconnect_within_grace_is_never_reported():
+    presence = _presence()
+    presence.connected(1)
+    presence.flush(now=T0)
+    presence.disconnected(1, now=T0 + 1)
+    presence.connected(1)
+    assert presence.flush(now=T0 + 100) == ({}, [])
+
+
+def test_flip_and_flip_back_between_flushes_is_not_reported():
+    presence = _presence()
+    presence.connected(1)
+    presence.flush(now=T0)
+    presence.disconnected(1, now=T0)
+    assert presence.flush(now=T0 + 15)[1] == [(1, T0)]   # went offline, watchers told
+    presence.connected(1)
+    presence.disconnected(1, now=T0 + 16)
+    # Online again, then offline for good before the next flush reports anything.
+    batches, _ = presence.flush(now=T0 + 40)
+    assert batches == {}
+
+
+def test_watch_is_capped_and_replaced():
+    presence = _presence()
+    assert presence.watch('sid-a', [5, 5, 6, 7, 8, 9]) == [5, 6, 7]
+    presence.connected(1)
+    presence.connected(5)
+    batches, _ = presence.flush(now=T0)
+    assert {sid: [u['user_id'] for u in ups] for sid, ups in batches.items()} == {'sid-a': [5]}
+    presence.unwatch('sid-a')
+    presence.disconnected(5, now=T0)
+    assert presence.flush(now=T0 + 15)[0] == {}
+    assert presence.stats() == {'online': 1, 'leaving': 0, 'watching': 1}
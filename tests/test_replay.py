@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from conftest import ORIGIN, make_user
+from replay import ReplayLog
+
+
+def _record(log, room, n):
+    return [log.record(room, 'new_message', {'id': i}) for i in range(n)]
+
+
+def test_replays_events_within_the_buffer():
+    log = ReplayLog(size=5)
+    events = _record(log, 'conv_1', 3)
+    epoch = events[0]['epoch']
+    assert [e['seq'] for e in events] == [1, 2, 3]
+    assert log.position('conv_1') == (epoch, 3)
+    assert [p['id'] for _, p in log.since('conv_1', epoch, 1)] == [1, 2]
+    assert log.since('conv_1', epoch, 3) == []
+
+
+def test_gap_rolled_out_of_the_ring_needs_a_resync():
+    log = ReplayLog(size=3)
+    epoch = _record(log, 'conv_1', 5)[0]['epoch']
+    assert log.since('conv_1', epoch, 1) is None              # seq 2 is gone
+    assert [p['seq'] for _, p in log.since('conv_1', epoch, 2)] == [3, 4, 5]
+    assert log.since('conv_1', epoch, 6) is None              # ahead of the buffer
+
+
+def test_unknown_or_evicted_epoch_needs_a_resync():
+    log = ReplayLog(size=5, max_rooms=1)
+    old = _record(log, 'conv_1', 2)[0]['epoch']
+    assert log.since('conv_1', 'someone-else.1', 1) is None
+    _record(log, 'conv_2', 1)                                  # evicts conv_1
+    assert log.since('conv_1', old, 2) is None
+    new = _record(log, 'conv_1', 1)[0]['epoch']
+    assert new != old and log.since('conv_1', old, 2) is None
+
+
+def test_position_of_an_empty_room():
+    log = ReplayLog(size=5, max_rooms=2)
+    epoch, seq = log.position('conv_1')
+    assert seq == 0 and log.since('conv_1', epoch, 0) == []
+    # The buffer created later covers everything since the client was told "nothing yet" ...
+    _record(log, 'conv_1', 2)
+    assert [p['seq'] for _, p in log.since('conv_1', epoch, 0)] == [1, 2]
+    # ... unless a room was evicted in between, which may have been this one.
+    epoch, _ = log.position('conv_9')
+    _record(log, 'conv_2', 1)
+    _record(log, 'conv_3', 1)
+    _record(log, 'conv_9', 1)
+    assert log.since('conv_9', epoch, 0) is None
+
+
+@pytest.fixture
+def client_socket(app_module, db, monkeypatch):
+    monkeypatch.setattr(app_module, 'replay_log', ReplayLog(size=3))
+    monkeypatch.setattr(app_module, 'user_msg_timestamps', {})
+    alice = make_user(db, 'alice')
+    conv_id = db.create_group_conversation('g', alice, [])
+    client = app_module.app.test_client()
+    assert client.post('/api/login', json={'username': 'alice', 'password': 'pass1234'},
+                       headers=ORIGIN).get_json()['ok']
+    sio = app_module.socketio.test_client(app_module.app, flask_test_client=client)
+    yield sio, conv_id
+    sio.disconnect()
+
+
+def test_resume(client_socket):
+    sio, conv_id = client_socket
+    key = str(conv_id)
+    start = sio.emit('resume', {'positions': {}}, callback=True)['positions'][key]
+    for i in range(2):
+        assert sio.emit('send_message', {'conversation_id': conv_id, 'content': f'm{i}'}, callback=True)['ok']
+    ack = sio.emit('resume', {'positions': {key: start}}, callback=True)
+    assert [e['data']['content'] for e in ack['replay'][key]] == ['m0', 'm1']
+    assert ack['resync'] == [] and ack['positions'][key][1] == 2
+
+    ack = sio.emit('resume', {'positions': {key: ack['positions'][key]}}, callback=True)
+    assert ack['replay'] == {} and ack['resync'] == []
+    # Rolled out of the 3-event ring, a foreign epoch, and a malformed position all resync.
+    for i in range(3):
+        sio.emit('send_message', {'conversation_id': conv_id, 'content': f'x{i}'}, callback=True)
+    for seen in ([start[0], 1], ['other.1', 1], 'junk'):
+        ack = sio.emit('resume', {'positions': {key: seen}}, callback=True)
+        assert ack['resync'] == [conv_id] and ack['replay'] == {}
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from conftest import ORIGIN, make_user
+
+
+@pytest.fixture
+def sender(app_module, db, monkeypatch):
+    """(Socket.IO test client logged in as alice, alice's id, a group alice is in)."""
+    monkeypatch.setattr(app_module, 'user_msg_timestamps', {})
+    alice = make_user(db, 'alice')
+    conv_id = db.create_group_conversation('g', alice, [make_user(db, 'bob')])
+    client = app_module.app.test_client()
+    assert client.post('/api/login', json={'username': 'alice', 'password': 'pass1234'},
+                       headers=ORIGIN).get_json()['ok']
+    sio = app_module.socketio.test_client(app_module.app, flask_test_client=client)
+    assert sio.is_connected()
+    yield sio, alice, conv_id
+    sio.disconnect()
+
+
+def _send(sio, conv_id, content, client_msg_id):
+    return sio.emit('send_message', {'conversation_id': conv_id, 'content': content,
+                                     'client_msg_id': client_msg_id}, callback=True)
+
+
+def test_resend_of_a_stored_message_is_acked_before_any_limit(sender, app_module, db, monkeypatch):
+    sio, alice, conv_id = sender
+    first = _send(sio, conv_id, 'hello', 'c1')
+    assert first['ok'] and not first['duplicate']
+    # Rate limit used up, fanout saturated, posting no longer allowed, length limit lowered:
+    # the resend is still acknowledged with the stored message and does not count.
+    app_module.user_msg_timestamps[alice] = [time.time()] * 6
+    monkeypatch.setattr(app_module.fanout, 'saturated', lambda: True)
+    monkeypatch.setattr(app_module, '_room_size', lambda conv: 10 ** 6)
+    assert db.set_group_admins_only(conv_id, alice, True)[0]
+    db.update_system_setting('max_message_length', '1')
+    again = _send(sio, conv_id, 'hello', 'c1')
+    assert again['ok'] and again['duplicate']
+    assert again['message']['id'] == first['message']['id']
+    assert len(app_module.user_msg_timestamps[alice]) == 6
+    assert _send(sio, conv_id, 'new', 'c2')['code'] == 'rate_limited'
+
+
+def test_resend_is_not_broadcast_again(sender, app_module, db):
+    sio, alice, conv_id = sender
+    sio.get_received()
+    assert not _send(sio, conv_id, 'hello', 'c1')['duplicate']
+    assert [p['name'] for p in sio.get_received()].count('new_message') == 1
+    app_module.user_msg_timestamps.clear()
+    assert _send(sio, conv_id, 'hello', 'c1')['duplicate']
+    assert [p['name'] for p in sio.get_received()].count('new_message') == 0
+    assert len(db.get_messages(conv_id)) == 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+from conftest import make_user
+
+SHARDS = 3
+
+
+def _groups(db, n):
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    return alice, bob, [db.create_group_conversation(f'g{i}', alice, [bob]) for i in range(n)]
+
+
+def _core_message_count(db):
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_messages_are_stored_in_their_conversation_shard(sharded_db):
+    db = sharded_db
+    alice, _, convs = _groups(db, SHARDS)
+    for conv_id in convs:
+        msg = db.save_message(conv_id, alice, f'hello {conv_id}')
+        assert msg['id'] % SHARDS == conv_id % SHARDS
+        assert db.get_message_by_id(msg['id'])['content'] == f'hello {conv_id}'
+        assert [m['content'] for m in db.get_messages(conv_id)] == [f'hello {conv_id}']
+    assert _core_message_count(db) == 0
+
+
+def test_forward_favorite_and_pin_across_shards(sharded_db):
+    db = sharded_db
+    alice, bob, convs = _groups(db, 2)
+    src, dst = convs
+    assert src % SHARDS != dst % SHARDS
+    original = db.get_message_by_id(db.save_message(src, alice, 'original')['id'])
+    copies = db.forward_messages(alice, [original], [dst], 'k1')[dst]
+    assert copies[0]['id'] % SHARDS == dst % SHARDS
+    forwarded = db.get_messages(dst)[0]
+    assert forwarded['original_content'] == 'original'
+    # Retrying the same batch inserts nothing new.
+    assert db.forward_messages(alice, [original], [dst], 'k1')[dst][0]['duplicate']
+    assert len(db.get_messages(dst)) == 1
+
+    assert db.toggle_favorite_message(bob, original['id']) == (True, True)
+    assert db.toggle_favorite_message(bob, copies[0]['id']) == (True, True)
+    favorites = db.get_favorite_messages(bob)['items']
+    assert {f['id'] for f in favorites} == {original['id'], copies[0]['id']}
+    assert db.pin_message(src, original['id'], alice)[0]
+    assert [p['message_id'] for p in db.get_pinned_messages(src)] == [original['id']]
+
+
+def test_cross_shard_originals_are_resolved_in_one_batch(sharded_db, monkeypatch):
+    db = sharded_db
+    alice, _, convs = _groups(db, 2)
+    src, dst = convs
+    originals = [db.get_message_by_id(db.save_message(src, alice, f'o{i}')['id']) for i in range(5)]
+    db.forward_messages(alice, originals, [dst], 'k1')
+    calls = []
+    real = db.get_messages_by_ids
+    monkeypatch.setattr(db, 'get_messages_by_ids', lambda ids: calls.append(set(ids)) or real(ids))
+    monkeypatch.setattr(db, 'get_message_by_id', lambda i: pytest.fail('per-message lookup'))
+    page = db.get_messages(dst)
+    assert [m['original_content'] for m in page] == [f'o{i}' for i in range(5)]
+    assert calls == [{o['id'] for o in originals}]
+
+
+def test_existing_messages_move_into_shards_on_first_sharded_start(db, monkeypatch):
+    alice, bob, convs = _groups(db, 4)
+    old = {c: db.save_message(c, alice, f'old {c}') for c in convs}
+    assert db.toggle_favorite_message(bob, old[convs[0]]['id'])[0]
+    assert db.pin_message(convs[1], old[convs[1]]['id'], alice)[0]
+
+    monkeypatch.setattr(db, 'MESSAGE_SHARDS', SHARDS)
+    monkeypatch.setattr(db, '_db_initialized', False)
+    db.init_db()
+    assert _core_message_count(db) == 0
+    assert db._legacy_max_id == max(m['id'] for m in old.values())
+    for conv_id, msg in old.items():
+        assert db.get_message_by_id(msg['id'])['content'] == f'old {conv_id}'
+        assert [m['content'] for m in db.get_messages(conv_id)] == [f'old {conv_id}']
+    assert len(db.get_favorite_messages(bob)['items']) == 1
+    assert len(db.get_pinned_messages(convs[1])) == 1
+    assert db.revoke_message(old[convs[2]]['id'], alice)[0]
+
+    new = db.save_message(convs[0], alice, 'new')
+    assert new['id'] > db._legacy_max_id and new['id'] % SHARDS == convs[0] % SHARDS
+
+    monkeypatch.setattr(db, 'MESSAGE_SHARDS', SHARDS - 1)
+    monkeypatch.setattr(db, '_db_initialized', False)
+    with pytest.raises(RuntimeError):
+        db.init_db()
+
+
+def test_stats_add_up_message_counts_over_shards(sharded_db):
+    db = sharded_db
+    alice, _, convs = _groups(db, SHARDS)
+    for conv_id in convs:
+        db.save_message(conv_id, alice, 'x')
+    assert db.get_admin_stats()['message_count'] == SHARDS
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+def test_stats_history_returns_rolled_up_buckets(admin_client, db):
+    db.rollup_stats()
+    r = admin_client.get('/api/admin/stats/history?granularity=hour&hours=48').get_json()
+    assert r['ok'] and r['granularity'] == 'hour' and isinstance(r['history'], list)
+
+
+@pytest.mark.parametrize('hours', ['nan', 'inf', '-inf', '-1', '0', 'abc'])
+def test_stats_history_rejects_bad_ranges(admin_client, hours):
+    r = admin_client.get(f'/api/admin/stats/history?hours={hours}').get_json()
+    assert r == {'ok': False, 'msg': '无效的时间范围'}
+
+
+def test_stats_history_rejects_unknown_granularity(admin_client):
+    assert admin_client.get('/api/admin/stats/history?granularity=year').get_json()['msg'] == '无效的时间粒度'
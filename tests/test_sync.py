@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from conftest import ORIGIN, make_user
+
+
+def _sync_all(db, conv_id, cursor, limit):
+    """Follow has_more to the end. Returns (ids in order, final cursor)."""
+    seen = []
+    while True:
+        msgs, cursor, has_more = db.get_message_changes(conv_id, cursor, limit=limit)
+        seen += [m['id'] for m in msgs]
+        if not has_more:
+            return seen, cursor
+
+
+def _stamp(db, conv_id, message_id, updated_at):
+    with db.msg_conn(conv_id) as conn:
+        conn.execute('UPDATE messages SET updated_at = ? WHERE id = ?', (updated_at, message_id))
+        conn.commit()
+
+
+def test_inserts_edits_and_revokes_since_the_cursor(any_db):
+    db = any_db
+    alice, bob = make_user(db, 'alice'), make_user(db, 'bob')
+    conv_id = db.create_group_conversation('g', alice, [bob])
+    old = db.save_message(conv_id, alice, 'before')
+    _stamp(db, conv_id, old['id'], time.time() - 60)
+    untouched = db.save_message(conv_id, alice, 'untouched')
+    _stamp(db, conv_id, untouched['id'], time.time() - 60)
+    cursor = db.encode_cursor(time.time() - 30, 0)
+
+    new = db.save_message(conv_id, bob, 'new')
+    assert db.edit_message(old['id'], alice, 'edited')[0]
+    msgs, _, has_more = db.get_message_changes(conv_id, cursor)
+    assert not has_more
+    assert [(m['id'], m['content']) for m in msgs] == [(new['id'], 'new'), (old['id'], 'edited')]
+    assert db.revoke_message(new['id'], bob)[0]
+    msgs, _, _ = db.get_message_changes(conv_id, cursor)
+    assert [(m['id'], m['is_revoked']) for m in msgs] == [(old['id'], 0), (new['id'], 1)]
+
+
+def test_paging_over_equal_timestamps_has_no_gaps(any_db):
+    db = any_db
+    alice = make_user(db, 'alice')
+    conv_id = db.create_group_conversation('g', alice, [])
+    stamp = time.time() - 100
+    ids = []
+    for i in range(7):
+        msg = db.save_message(conv_id, alice, f'm{i}')
+        _stamp(db, conv_id, msg['id'], stamp + (i // 3))   # runs of three equal updated_at
+        ids.append(msg['id'])
+    seen, cursor = _sync_all(db, conv_id, db.encode_cursor(0, 0), limit=2)
+    assert seen == ids
+    # Everything older than the settle window is behind the final cursor.
+    assert db.get_message_changes(conv_id, cursor)[0] == []
+
+
+def test_cursor_stays_behind_the_settle_window(any_db):
+    db = any_db
+    alice = make_user(db, 'alice')
+    conv_id = db.create_group_conversation('g', alice, [])
+    first = db.save_message(conv_id, alice, 'first')
+    _, cursor, _ = db.get_message_changes(conv_id, db.current_sync_cursor())
+    assert db.decode_cursor(cursor)[0] <= time.time() - db.SYNC_SETTLE
+    # A write stamped just before the previous sync, committed after it.
+    late = db.save_message(conv_id, alice, 'late')
+    _stamp(db, conv_id, late['id'], time.time() - db.SYNC_SETTLE / 2)
+    ids = [m['id'] for m in db.get_message_changes(conv_id, cursor)[0]]
+    assert late['id'] in ids and first['id'] in ids
+
+
+def test_malformed_cursors(db):
+    alice = make_user(db, 'alice')
+    conv_id = db.create_group_conversation('g', alice, [])
+    for bad in ('', 'not base64!', db.encode_cursor(1.0, 'x').replace('=', '')):
+        with pytest.raises(ValueError):
+            db.get_message_changes(conv_id, bad)
+
+
+def test_sync_endpoint(app_module, db):
+    client = app_module.app.test_client()
+    for name in ('alice', 'bob'):
+        client.post('/api/register', json={'username': name, 'password': 'pass1234'}, headers=ORIGIN)
+    assert client.post('/api/login', json={'username': 'alice', 'password': 'pass1234'}, headers=ORIGIN).get_json()['ok']
+    alice = db.verify_user('alice', 'pass1234')['id']
+    conv_id = db.create_group_conversation('g', alice, [])
+    page = client.get(f'/api/messages/{conv_id}').get_json()
+    db.save_message(conv_id, alice, 'hi')
+    r = client.get(f'/api/sync?conversation_id={conv_id}&since={page["sync_cursor"]}').get_json()
+    assert r['ok'] and [m['content'] for m in r['messages']] == ['hi'] and r['cursor']
+    assert client.get(f'/api/sync?conversation_id={conv_id}&since=bogus').status_code == 400
+    other = db.create_group_conversation('h', db.verify_user('bob', 'pass1234')['id'], [])
+    assert client.get(f'/api/sync?conversation_id={other}&since={page["sync_cursor"]}').status_code == 403
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from typing_state import TYPING_MAX_NAMES, TYPING_THROTTLE, TYPING_TTL, TypingTracker
+
+T0 = 1000.0
+
+
+def _small(conv_id):
+    return 2
+
+
+def _names(snapshots):
+    return {conv: [u['name'] for u in snap['users']] for conv, snap in snapshots}
+
+
+def test_snapshot_only_when_typers_change():
+    tracker = TypingTracker()
+    assert tracker.start(1, 10, 'alice', now=T0)
+    assert not tracker.start(1, 10, 'alice', now=T0 + TYPING_THROTTLE / 2)   # throttled
+    assert _names(tracker.flush(_small, now=T0)) == {1: ['alice']}
+    assert tracker.start(1, 10, 'alice', now=T0 + TYPING_THROTTLE)          # refresh, same set
+    assert tracker.flush(_small, now=T0 + TYPING_THROTTLE) == []
+    tracker.stop(1, 10)
+    assert tracker.flush(_small, now=T0 + TYPING_THROTTLE) == [(1, {'conversation_id': 1, 'users': [], 'count': 0})]
+
+
+def test_typers_expire_after_the_ttl_of_their_last_report():
+    tracker = TypingTracker()
+    tracker.start(1, 10, 'alice', now=T0)
+    tracker.start(1, 11, 'bob', now=T0 + 3)
+    tracker.flush(_small, now=T0 + 3)
+    assert tracker.flush(_small, now=T0 + TYPING_TTL - 0.1) == []
+    assert _names(tracker.flush(_small, now=T0 + TYPING_TTL)) == {1: ['bob']}
+    assert _names(tracker.flush(_small, now=T0 + 3 + TYPING_TTL)) == {1: []}
+    assert tracker.stats() == {'conversations': 0, 'typers': 0}
+
+
+def test_snapshot_names_a_few_and_counts_the_rest():
+    tracker = TypingTracker()
+    for uid in range(TYPING_MAX_NAMES + 2):
+        tracker.start(1, uid, f'u{uid}', now=T0)
+    (conv, snap), = tracker.flush(_small, now=T0)
+    assert len(snap['users']) == TYPING_MAX_NAMES and snap['count'] == TYPING_MAX_NAMES + 2
+
+
+def test_large_rooms_are_deferred_to_their_interval():
+    tracker = TypingTracker(large_room=100, large_interval=5)
+    sizes = {1: 500, 2: 2}
+    tracker.start(1, 10, 'alice', now=T0)
+    assert _names(tracker.flush(sizes.get, now=T0)) == {1: ['alice']}
+    tracker.start(1, 11, 'bob', now=T0 + 1)
+    tracker.start(2, 12, 'carol', now=T0 + 1)
+    assert _names(tracker.flush(sizes.get, now=T0 + 1)) == {2: ['carol']}   # the large room waits
+    assert tracker.flush(sizes.get, now=T0 + 4.9) == []
+    assert _names(tracker.flush(sizes.get, now=T0 + 5)) == {1: ['alice', 'bob']}
+
+
+def test_large_room_interval_zero_sends_nothing():
+    tracker = TypingTracker(large_room=100, large_interval=0)
+    tracker.start(1, 10, 'alice', now=T0)
+    assert tracker.flush(lambda conv: 500, now=T0) == []
+    assert tracker.flush(lambda conv: 500, now=T0 + 100) == []
+    # The room shrinking below the threshold gets snapshots again.
+    tracker.start(1, 11, 'bob', now=T0 + 101)
+    assert _names(tracker.flush(_small, now=T0 + 101)) == {1: ['bob']}
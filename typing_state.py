@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+"X is typing…" state per conversation, sent to the conv_{id} rooms as snapshots.
+
+Clients report typing at most every few seconds; anything faster than
+TYPING_THROTTLE per user and conversation is dropped here without touching
+the database.  A typer expires TYPING_TTL seconds after its last accepted
+report, or at once when it stops or sends the message.
+
+Nothing is emitted per keystroke: every TYPING_FLUSH seconds flush() returns
+one "who is typing" snapshot for each conversation whose set of typers
+changed.  Rooms with more than TYPING_LARGE_ROOM sockets get a snapshot at
+most every TYPING_LARGE_INTERVAL seconds; with TYPING_LARGE_INTERVAL=0 they
+get none at all.
+"""
+import os
+import threading
+import time
+
+TYPING_THROTTLE       = 2.0    # seconds between accepted reports per user and conversation
+TYPING_TTL            = 6.0    # seconds a report keeps the user listed as typing
+TYPING_FLUSH          = 1.0    # seconds between snapshots
+TYPING_MAX_NAMES      = 3      # typers named in a snapshot; the rest are only counted
+TYPING_LARGE_ROOM     = int(os.environ.get('TYPING_LARGE_ROOM', '100'))          # sockets
+TYPING_LARGE_INTERVAL = float(os.environ.get('TYPING_LARGE_INTERVAL', '5'))      # seconds, 0 = off
+
+
+class TypingTracker:
+    def __init__(self, large_room=TYPING_LARGE_ROOM, large_interval=TYPING_LARGE_INTERVAL):
+        self.large_room = large_room
+        self.large_interval = large_interval
+        self._typers = {}      # conversation id -> {user id: [username, last accepted report]}
+        self._dirty = set()    # conversations whose typers changed since their last snapshot
+        self._last_sent = {}   # conversation id -> when its last snapshot went out
+        self._lock = threading.Lock()
+
+    def start(self, conversation_id, user_id, username, now=None):
+        """A typing report. Returns False when it was throttled."""
+        now = now or time.time()
+        with self._lock:
+            typers = self._typers.setdefault(conversation_id, {})
+            entry = typers.get(user_id)
+            if entry and now - entry[1] < TYPING_THROTTLE:
+                return False
+            if entry is None:
+                self._dirty.add(conversation_id)
+            typers[user_id] = [username, now]
+            return True
+
+    def stop(self, conversation_id, user_id):
+        with self._lock:
+            typers = self._typers.get(conversation_id)
+            if typers and typers.pop(user_id, None) is not None:
+                self._dirty.add(conversation_id)
+
+    def flush(self, room_size, now=None):
+        """
+        Expire stale typers and return [(conversation_id, snapshot)] for the
+        conversations due an update.  room_size(conversation_id) -> sockets in its room.
+        """
+        now = now or time.time()
+        snapshots = []
+        with self._lock:
+            for conv_id, typers in list(self._typers.items()):
+                for uid, (_, at) in list(typers.items()):
+                    if now - at >= TYPING_TTL:
+                        del typers[uid]
+                        self._dirty.add(conv_id)
+                if not typers:
+                    del self._typers[conv_id]
+            for conv_id in list(self._dirty):
+                if room_size(conv_id) > self.large_room:
+                    if not self.large_interval:
+                        self._dirty.discard(conv_id)
+                        continue
+                    if now - self._last_sent.get(conv_id, 0) < self.large_interval:
+                        continue   # stays dirty until its interval is up
+                self._dirty.discard(conv_id)
+                typers = self._typers.get(conv_id, {})
+                snapshots.append((conv_id, {
+                    'conversation_id': conv_id,
+                    'users': [{'id': uid, 'name': name}
+                              for uid, (name, _) in list(typers.items())[:TYPING_MAX_NAMES]],
+                    'count': len(typers),
+                }))
+                if typers:
+                    self._last_sent[conv_id] = now
+                else:
+                    self._last_sent.pop(conv_id, None)
+        return snapshots
+
+    def stats(self):
+        with self._lock:
+            return {'conversations': len(self._typers), 'typers': sum(len(t) for t in self._typers.values())}